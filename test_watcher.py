@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+
+"""
+Regression tests for watcher.py, nothing here talks to Slack, Google or iCloud
+
+Usage:
+    python -m unittest test_watcher
+"""
+
+import datetime
+import json
+import os
+import Queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+
+import bottle
+import watcher
+from watcher import Current, DatabaseWriter, Manager, Pokemon, PokemonWebServer, SpawnAnalytics, StaticMapRenderer, TraceLocationProvider
+
+PHONE = [ 40.7580, -73.9855 ]
+
+def quiet():
+    Current.debug = False
+    Current.testing = True
+    Current.enableSlack = False
+    Current.enableGoogleAndICloud = False
+    Current.enableTextMessages = False
+    Current.phoneCoord = list(PHONE)
+
+def makeMessage(name="Snorlax", iv=100.0, ts=None, text=None):
+    """ A slack message shaped like the ones the pokemon bot posted """
+    return {
+        "type"        : "message",
+        "subtype"     : "bot_message",
+        "bot_id"      : "B0PKMN",
+        "username"    : name,
+        "ts"          : "%.6f" % ( time.time() if ts is None else ts ),
+        "text"        : "%s (%s%%)" % ( name, iv ),
+        "attachments" : [ { "text" : text if text is not None else "%s (%s%%) until 12:00:00PM\n<http://maps.google.com/maps?q=%f,%f|Open in Google Maps>" % ( name, iv, PHONE[0], PHONE[1] ) } ]
+    }
+
+def makeDatabase(path):
+    conn = sqlite3.connect(path)
+    watcher.migrateDatabase(conn)
+    return conn
+
+def makeManager():
+    return Manager(None, None, Queue.Queue(), None, TraceLocationProvider([ ( 0, PHONE[0], PHONE[1] ) ]))
+
+def makePokemon(name, offset=.001, text=None, timeReceived=None, iv=None):
+    coords = [ PHONE[0] + offset, PHONE[1] ]
+    link = "<http://maps.google.com/maps?q=%f,%f|Open in Google Maps>" % ( coords[0], coords[1] )
+    if iv is not None:
+        link = "%s (%s%%) until 12:00:00PM\n%s" % ( name.capitalize(), iv, link )
+    return Pokemon(time.time() if timeReceived is None else timeReceived, name, coords, text, link)
+
+class ParseAttachmentTest(unittest.TestCase):
+    link = "<http://maps.google.com/maps?q=40.758000,-73.985500|Open in Google Maps>"
+
+    def assertParsed(self, text, species, iv):
+        attachment = watcher.parseAttachment(text)
+        self.assertEqual(attachment.species, species)
+        self.assertEqual(attachment.iv, iv)
+        self.assertEqual(attachment.coords, [ 40.758, -73.9855 ])
+        self.assertEqual(attachment.coordStr, "40.758000,-73.985500")
+
+    def testUsualLayout(self):
+        self.assertParsed("Snorlax (95.6%) until 04:12:33PM\n" + self.link, "snorlax", 95.6)
+
+    def testLinkFirst(self):
+        self.assertParsed(self.link + " Snorlax (100%)", "snorlax", 100.0)
+
+    def testIvOnNextLine(self):
+        self.assertParsed("Snorlax until 04:12:33PM\n(91.1%) " + self.link, "snorlax", 91.1)
+        self.assertParsed("Snorlax until 04:12:33PM\n" + self.link + "\n(91.1%)", "snorlax", 91.1)
+
+    def testNoIv(self):
+        self.assertParsed("Pidgey until 04:12:33PM\n" + self.link, "pidgey", None)
+
+class RulesReloadTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+        self.tmpDir = tempfile.mkdtemp()
+        self.savedRulesFile = watcher.rulesFile
+        watcher.rulesFile = os.path.join(self.tmpDir, "rules.json")
+        watcher.rules = None
+
+    def tearDown(self):
+        watcher.rulesFile = self.savedRulesFile
+        watcher.rules = None
+        watcher.rulesFailedStamp = None
+        shutil.rmtree(self.tmpDir)
+
+    def writeRules(self, config):
+        with open(watcher.rulesFile, "w") as f:
+            json.dump(config, f)
+
+    def testReloadMovesPokemonBetweenTables(self):
+        mgr = makeManager()
+        mgr.potentiallyAddPokemonToManager(makePokemon("snorlax"), resolveNow=False)
+        mgr.potentiallyAddPokemonToManager(makePokemon("pidgey", offset=.002), resolveNow=False)
+        mgr.tick()
+        snap = mgr.publish()
+        self.assertEqual([ mon.name for mon in snap.active ], [ "snorlax" ])
+        self.assertEqual([ mon.name for mon in snap.nearby ], [ "pidgey" ])
+
+        self.writeRules({ "alwaysText" : [ "pidgey" ] })
+        mgr.tick()
+        snap = mgr.publish()
+        self.assertEqual([ mon.name for mon in snap.active ], [ "pidgey" ])
+        self.assertEqual([ mon.name for mon in snap.nearby ], [ "snorlax" ])
+        self.assertEqual(len(mgr.distances), 1)
+        self.assertEqual(len(mgr.byId), 2)
+
+    def testBrokenFileIsOnlyTriedOnce(self):
+        realLoadRules = watcher.loadRules
+        loads = []
+
+        def countingLoadRules(previous=None):
+            loads.append(previous)
+            return realLoadRules(previous)
+
+        watcher.loadRules = countingLoadRules
+        try:
+            self.assertIsNone(watcher.getRules().source)
+            del loads[:]
+            with open(watcher.rulesFile, "w") as f:
+                f.write("{ not json")
+            for i in xrange(3):
+                self.assertFalse(watcher.reloadRulesIfChanged())
+            self.assertEqual(len(loads), 1)
+            self.assertIsNone(watcher.getRules().source)
+
+            self.writeRules({ "alwaysText" : [ "pidgey" ] })
+            self.assertTrue(watcher.reloadRulesIfChanged())
+            self.assertFalse(watcher.reloadRulesIfChanged())
+            self.assertEqual(len(loads), 2)
+            self.assertEqual(watcher.getRules().source, watcher.rulesFile)
+        finally:
+            watcher.loadRules = realLoadRules
+
+class ManagerLoopTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+
+    def testFailingRefreshDoesNotSpin(self):
+        mgr = makeManager()
+        mgr.potentiallyAddPokemonToManager(makePokemon("snorlax"), resolveNow=False)
+        calls = []
+
+        def failingUpdateAll():
+            calls.append(time.time())
+            raise TypeError("unsupported operand type(s) for *: 'NoneType' and 'int'")
+
+        mgr.updateAll = failingUpdateAll
+        mgr.start()
+        try:
+            time.sleep(.5)
+        finally:
+            mgr.stop()
+            mgr.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(mgr.schedulerStats["ticks"], 0)
+        self.assertGreater(mgr.lastUpdated, 0)
+
+class TextMessageTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+        Current.enableTextMessages = True
+        self.sent = []
+        self.realSend = watcher.sendTextMessageViaEmail
+        watcher.sendTextMessageViaEmail = lambda subject, message, link, key=None, recipient=None: self.sent.append(subject)
+
+    def tearDown(self):
+        watcher.sendTextMessageViaEmail = self.realSend
+        Current.enableTextMessages = False
+
+    def testReachableSpawnIsTexted(self):
+        mgr = makeManager()
+        mgr.potentiallyAddPokemonToManager(makePokemon("snorlax", text="Snorlax (100%)", iv=100), resolveNow=False)
+        self.assertEqual(self.sent, [ "snorlax" ])
+
+    def testUnreachableSpawnIsNotTexted(self):
+        # about 0.7 miles away with 10 seconds left, no one gets there in time
+        mgr = makeManager()
+        pm = makePokemon("snorlax", offset=.01, text="Snorlax (100%)", iv=100, timeReceived=time.time() - watcher.despawnSeconds + 10)
+        mgr.potentiallyAddPokemonToManager(pm, resolveNow=False)
+        self.assertFalse(pm.isReachable())
+        self.assertEqual(self.sent, [])
+
+class DatabaseWriterTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+        self.tmpDir = tempfile.mkdtemp()
+        self.conn = makeDatabase(os.path.join(self.tmpDir, "events.db"))
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmpDir)
+
+    def row(self, eventTime, notes="Snorlax (100%)"):
+        # link is the attachment text, as eventRow stores it
+        return ( eventTime, "Snorlax", "Snorlax (100.0%) until 12:00:00PM\n<http://maps.google.com/maps?q=40.758,-73.985|Open in Google Maps>", PHONE[0], PHONE[1], notes )
+
+    def eventTimes(self):
+        return [ row[0] for row in self.conn.execute("select time from event order by time") ]
+
+    def testBadRowIsSkippedWithoutDuplicates(self):
+        writer = DatabaseWriter(self.conn, commitRows=1000)
+        for eventTime in ( 1001, 1002, 1003 ):
+            writer.add(self.row(eventTime))
+        writer.add(self.row(1004, notes={ "not" : "bindable" }))
+        writer.add(self.row(1005))
+        self.assertEqual(writer.flush(), 4)
+        self.assertEqual(writer.rowsDropped, 1)
+
+        writer.add(self.row(1006))
+        writer.flush()
+        self.assertEqual(self.eventTimes(), [ 1001, 1002, 1003, 1005, 1006 ])
+
+    def testItemIsPassedOnWhenItCantBeSaved(self):
+        writer = DatabaseWriter(self.conn, commitRows=1)
+        parsed = watcher.parseSlackItem(makeMessage())
+        parsed[0]["ts"] = "not a time"
+        self.assertIs(writer(parsed), parsed)
+        self.assertEqual(self.eventTimes(), [])
+
+    def testMessageWithoutUsername(self):
+        message = makeMessage()
+        del message["username"]
+        parsed = watcher.parseSlackItem(message)
+        self.assertEqual(watcher.buildPokemon(parsed).getName(), "snorlax")
+
+        writer = DatabaseWriter(self.conn, commitRows=1)
+        writer(parsed)
+        self.assertEqual(writer.rowsWritten, 1)
+        self.assertEqual(self.conn.execute("select type from event").fetchall(), [ ( "snorlax", ) ])
+        self.assertEqual(self.conn.execute("select species, count from species_hourly").fetchall(), [ ( "snorlax", 1 ) ])
+
+    def testAnalyticsFailureLeavesNoHalfWrittenBatch(self):
+        realApply = SpawnAnalytics.apply
+        calls = []
+
+        def failingApply(conn, rows):
+            # the aggregates are updated, then it fails, as if the last statement had
+            realApply(conn, rows)
+            calls.append(len(rows))
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("disk I/O error")
+
+        writer = DatabaseWriter(self.conn, commitRows=1000)
+        for eventTime in xrange(1001, 1011):
+            writer.add(self.row(eventTime))
+        SpawnAnalytics.apply = staticmethod(failingApply)
+        try:
+            self.assertEqual(writer.flush(), 10)
+        finally:
+            SpawnAnalytics.apply = staticmethod(realApply)
+
+        self.assertEqual(calls, [ 10, 10 ])
+        self.assertEqual(self.eventTimes(), range(1001, 1011))
+        self.assertEqual(self.conn.execute("select sum(count) from species_hourly").fetchone()[0], 10)
+        self.assertEqual(self.conn.execute("select sum(count) from cell_density").fetchone()[0], 10)
+        self.assertEqual(self.conn.execute("select sum(count) from iv_histogram").fetchone()[0], 10)
+
+    def testWriteToDatabaseRollsBack(self):
+        realApply = SpawnAnalytics.apply
+
+        def failingApply(conn, rows):
+            realApply(conn, rows)
+            raise sqlite3.OperationalError("disk I/O error")
+
+        SpawnAnalytics.apply = staticmethod(failingApply)
+        try:
+            parsed = watcher.parseSlackItem(makeMessage(ts=1001))
+            self.assertRaises(sqlite3.OperationalError, watcher.writeToDatabase, self.conn, parsed[0], parsed[1])
+        finally:
+            SpawnAnalytics.apply = staticmethod(realApply)
+        self.conn.commit()
+        self.assertEqual(self.eventTimes(), [])
+        self.assertEqual(self.conn.execute("select count(*) from species_hourly").fetchone()[0], 0)
+
+def get(handler, etag=None, *args, **query):
+    """ Calls a route function the way bottle would, returns ( status, etag, body ) """
+    environ = { "REQUEST_METHOD" : "GET", "PATH_INFO" : "/", "QUERY_STRING" : urllib.urlencode(query) }
+    if etag is not None:
+        environ["HTTP_IF_NONE_MATCH"] = etag
+    bottle.request.bind(environ)
+    bottle.response.bind()
+    try:
+        result = handler(*args)
+    except bottle.HTTPResponse as ex:
+        result = ex
+    if isinstance(result, bottle.HTTPResponse):
+        return result.status_code, result.headers.get("ETag"), result.body
+    return bottle.response.status_code, bottle.response.headers.get("ETag"), result
+
+class ConditionalGetTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+        self.mgr = makeManager()
+        self.mgr.potentiallyAddPokemonToManager(makePokemon("snorlax"), resolveNow=False)
+        self.mgr.potentiallyAddPokemonToManager(makePokemon("pidgey", offset=.002), resolveNow=False)
+        self.savedMgr = PokemonWebServer.mgr
+        PokemonWebServer.mgr = self.mgr
+        PokemonWebServer.pageCache = None
+        PokemonWebServer.apiCache = {}
+        # stay clear of a minute boundary, a new minute is meant to be a change
+        if time.time() % 60 > 55:
+            time.sleep(60 - time.time() % 60)
+
+    def tearDown(self):
+        PokemonWebServer.mgr = self.savedMgr
+        PokemonWebServer.pageCache = None
+        PokemonWebServer.apiCache = {}
+
+    def testIdleTickIsNotAChange(self):
+        self.mgr.tick()
+        first = self.mgr.publish()
+        status, etag, body = get(PokemonWebServer.apiSnapshot, None, "active")
+        self.assertEqual(status, 200)
+        pageStatus, pageEtag, html = get(PokemonWebServer.pokemon.im_func)
+        self.assertEqual(pageStatus, 200)
+
+        self.assertEqual(get(PokemonWebServer.pokemon.im_func, pageEtag)[0], 304)
+
+        # nothing moved and nothing arrived, a few seconds later
+        self.mgr.tick()
+        self.mgr.lastUpdated = self.mgr.lastUpdated + 5
+        self.assertIs(self.mgr.publish(), first)
+        self.assertEqual(get(PokemonWebServer.apiSnapshot, etag, "active")[0], 304)
+
+        # but the page says when the next refresh is due
+        pageStatus, newPageEtag, html = get(PokemonWebServer.pokemon.im_func, pageEtag)
+        self.assertEqual(pageStatus, 200)
+        self.assertNotEqual(newPageEtag, pageEtag)
+        nextUpdate = datetime.datetime.fromtimestamp(self.mgr.lastUpdated + watcher.managerRefreshTime).strftime("%I:%M:%S%p")
+        self.assertIn("next update at %s" % nextUpdate, html)
+
+        # a removal is
+        self.mgr.removePokemonById(first.active[0].id)
+        second = self.mgr.publish()
+        self.assertEqual(second.generation, first.generation + 1)
+        status, newEtag, body = get(PokemonWebServer.apiSnapshot, etag, "active")
+        self.assertEqual(status, 200)
+        self.assertNotEqual(newEtag, etag)
+        self.assertEqual(json.loads(body)["active"], [])
+
+class RemoveTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+        self.webQueue = watcher.WakeupQueue()
+        self.mgr = Manager(None, self.webQueue, Queue.Queue(), None, TraceLocationProvider([ ( 0, PHONE[0], PHONE[1] ) ]))
+        self.savedMgr = PokemonWebServer.mgr
+        self.savedQueue = PokemonWebServer.webToManagerQueue
+        PokemonWebServer.mgr = self.mgr
+        PokemonWebServer.webToManagerQueue = self.webQueue
+
+    def tearDown(self):
+        self.mgr.stop()
+        self.mgr.join(5)
+        PokemonWebServer.mgr = self.savedMgr
+        PokemonWebServer.webToManagerQueue = self.savedQueue
+
+    def testRemoveWaitsOnlyForTheManager(self):
+        pm = makePokemon("snorlax")
+        self.mgr.potentiallyAddPokemonToManager(pm, resolveNow=False)
+        self.mgr.start()
+        waitFor(lambda: self.mgr.getSnapshot().generation > 0)
+        remove = PokemonWebServer.remove.im_func
+
+        # nothing on the page changes, but the manager says it is done
+        started = time.time()
+        self.assertEqual(get(remove, None, "no-such-id")[0], 302)
+        self.assertLess(time.time() - started, .5)
+
+        self.assertEqual(get(remove, None, pm.getId())[0], 302)
+        self.assertIsNone(self.mgr.getPokemonById(pm.getId()))
+        self.assertEqual(self.mgr.getSnapshot().active, ())
+
+class QueryValidationTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+        self.tmpDir = tempfile.mkdtemp()
+        self.savedDbname = watcher.dbname
+        watcher.dbname = os.path.join(self.tmpDir, "events.db")
+        self.savedQueue = PokemonWebServer.webToManagerQueue
+        PokemonWebServer.webToManagerQueue = Queue.Queue()
+
+    def tearDown(self):
+        watcher.dbname = self.savedDbname
+        PokemonWebServer.webToManagerQueue = self.savedQueue
+        shutil.rmtree(self.tmpDir)
+
+    def testLocation(self):
+        location = PokemonWebServer.location.im_func
+        for query in ( {}, { "lat" : "40.7" }, { "lat" : "abc", "long" : "-73.9" }, { "lat" : "nan", "long" : "-73.9" }, { "lat" : "91", "long" : "-73.9" } ):
+            self.assertEqual(get(location, **query)[0], 400, query)
+        self.assertTrue(PokemonWebServer.webToManagerQueue.empty())
+        self.assertEqual(get(location, lat="40.7", long="-73.9")[0], 200)
+        self.assertEqual(PokemonWebServer.webToManagerQueue.get_nowait(), ( "location", [ 40.7, -73.9 ] ))
+
+    def testAnalytics(self):
+        analytics = PokemonWebServer.apiAnalytics.im_func
+        self.assertEqual(get(analytics)[0], 503)
+        self.assertFalse(os.path.exists(watcher.dbname))
+
+        conn = makeDatabase(watcher.dbname)
+        conn.execute("insert into species_hourly ( species, hour, count ) values ( 'snorlax', 13, 2 )")
+        conn.commit()
+        conn.close()
+        for query in ( { "from" : "abc", "to" : "3" }, { "from" : "24", "to" : "3" }, { "from" : "18" }, { "limit" : "0" }, { "limit" : "ten" } ):
+            self.assertEqual(get(analytics, **query)[0], 400, query)
+        status, etag, body = get(analytics, **{ "from" : "12", "to" : "14" })
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["topSpecies"], [ [ "snorlax", 2 ] ])
+
+class SingletonTest(unittest.TestCase):
+    def setUp(self):
+        self.realClient = watcher.DistanceMatrixClient
+        self.savedClient = watcher.distanceMatrix
+        watcher.distanceMatrix = None
+
+    def tearDown(self):
+        watcher.DistanceMatrixClient = self.realClient
+        watcher.distanceMatrix = self.savedClient
+
+    def testFirstUseFromManyThreads(self):
+        created = []
+
+        class SlowClient(object):
+            def __init__(self):
+                time.sleep(.05) # long enough for every thread to find there is none yet
+                created.append(self)
+
+        watcher.DistanceMatrixClient = SlowClient
+        clients = []
+        threads = [ threading.Thread(target=lambda: clients.append(watcher.getDistanceMatrixClient())) for i in xrange(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(clients), 8)
+        self.assertTrue(all(client is created[0] for client in clients))
+
+class FlakySession(object):
+    """ Stands in for requests.Session, the first get() fails and the rest return a png """
+    def __init__(self):
+        self.gets = 0
+
+    def get(self, url, timeout=None):
+        self.gets = self.gets + 1
+        if self.gets == 1:
+            raise IOError("connection reset")
+        return FakeResponse("\x89PNG " + url)
+
+    def close(self):
+        pass
+
+class FakeResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+def waitFor(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(.01)
+
+class StaticMapRendererTest(unittest.TestCase):
+    def setUp(self):
+        quiet()
+
+    def testFailedDownloadIsRetried(self):
+        renderer = StaticMapRenderer()
+        renderer.session = FlakySession()
+        renderer.start()
+        url = StaticMapRenderer.buildUrl("40.758000,-73.985500", [ ( None, "40.758000,-73.985500" ) ])
+        renderer.request(url)
+        waitFor(lambda: renderer.getStats()["errors"] == 1)
+        self.assertIsNone(renderer.getCurrent())
+
+        # the phone hasn't moved, so the next refresh asks for the same map
+        renderer.request(url)
+        waitFor(lambda: renderer.getCurrent() is not None)
+        self.assertEqual(renderer.session.gets, 2)
+        self.assertEqual(renderer.getCurrent()[1], "\x89PNG " + url)
+
+if __name__ == "__main__":
+    unittest.main()
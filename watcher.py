@@ -14,12 +14,20 @@ Anyway, the slack channel is no longer posting updates, so this is just a collec
 on how to connect to Slack, Google Maps, iCLoud and bottle.
 """
 
+import bisect
+import collections
 import datetime
+import fcntl
+import hashlib
+import heapq
 import json
 import os
 import Queue
 import re
+import select
 import smtplib
+import socket
+import SocketServer
 import sqlite3
 import string
 import sys
@@ -30,14 +38,21 @@ import urllib
 import uuid
 
 import bottle
-from bottle import static_file, redirect, post, route, request, template
-from math import radians, cos, sin, asin, sqrt
+import requests
+from bottle import redirect, post, route, request, response, HTTPResponse, SimpleTemplate
+from math import radians, cos, sin, asin, sqrt, floor
 from operator import methodcaller
 from pyicloud import PyiCloudService
 from pprint import pprint
 from slackclient import SlackClient
 from urlparse import parse_qs
 from urlparse import urlparse
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # DistanceBatch falls back to scalar haversine without it
 
 # Load below values from JSON
 global configuration
@@ -54,6 +69,9 @@ icloudDevice = u'' # the device ID of your apple device that you want to alert
 mailname = "" # your sms username
 mailpass = "" # your sms password
 vtext    = "" # The vtext address you want to send the message to
+smtpHost = "smtp.gmail.com"
+smtpPort = 587
+smtpStartTls = True # point smtpHost/smtpPort at a local server (and turn this off) for testing
 
 # Texting configuration
 criticalTextMaxDistance = 2 # miles as the crow flies
@@ -61,8 +79,25 @@ perfectTextMaxDistance  = 3 # miles as the crow flies
 alwaysTextMaxDistance   = 4 # miles as the crow flies
 textEarly = 9  # military time
 textLate  = 23 # military time
+perfectIV = 90 # percent, anything at or above this is "perfect"
+
+# Texts go out from a dispatcher thread over one SMTP session, see NotificationDispatcher
+textCoalesceSeconds    = 5     # alerts arriving this close together go out as a single text
+textMinInterval        = 30    # seconds, at least this long between texts, anything in between waits and is coalesced
+textDedupeSeconds      = 900   # the same species at the same spot is only texted once in this window
+textDedupeQuantization = 0.001 # degrees (~.07 miles), spots closer than this are the same spot
+smtpIdleSeconds        = 120   # the session is closed after this long without a text, and reopened on demand
 textAlways = False
 
+# Texting rules (the lists and distances below) can instead be read from this JSON file, it is re-read
+# whenever it changes, see watcher_rules.example.json.  Without it the settings in this file are used.
+rulesFile = "watcher_rules.json"
+
+# Other people alerted from the same slack feed, each with their own location, rules and text address, see
+# watcher_subscribers.example.json.  The phone, rules and vtext above are the owner's, who also gets the dashboard.
+subscribersFile    = "watcher_subscribers.json"
+subscriberCellSize = 0.05 # degrees (~3.5 miles), about as far as anyone is texted for, so a spawn only visits a few cells
+
 global populateDB, criticalList, notifyList, alwaysTextList, webserverPort, managerRefreshTime
 # text me these at any hour of the day, as long as they are within a ce
 alwaysTextList  = [ "gyrados", "muk" ]
@@ -79,13 +114,79 @@ criticalList    = [ "snorlax", "dragonite", "lapras", "venasaur", "slowbro", "gr
 # Add to active but do not text me
 noTextList      = [ "charmander", "slowpoke", "squirtle", "bulbasaur", "poliwag", "magikarp", "victreebel", "machamp", "vileplume" ]
 
+# Spawns despawn this many seconds after they are reported
+despawnSeconds = 900
+
 # Nearby limit (in miles)
 global NEARBY_LIMIT
 NEARBY_LIMIT = 1.0
 
+# Size (in degrees of lat/long) of a spatial index cell, .01 is roughly .7 miles north/south
+spatialCellSize = 0.01
+
 populateDB         = True
 webserverPort      = 9432
+webServerBackend   = "threadpool" # "threadpool", "threaded" (a thread per request), "wsgiref" (single threaded), or another bottle server name ("paste", "cherrypy", ...)
+webServerWorkers   = 16 # threadpool size, half of it can be held by /api/stream clients
+sseKeepAlive       = 15  # seconds between keep-alive comments on /api/stream
+sseBacklog         = 100 # deltas buffered per stream client before it is sent a full resync instead
 managerRefreshTime = 30
+managerErrorDelay  = 0.1 # seconds the manager loop pauses after an error, so one that repeats can't spin it
+metricsEnabled     = True # counters and timers for /metrics, False turns every update into a flag check
+
+# Phone location polling, see AdaptiveLocationPoller
+locationFastSeconds     = 10   # while moving quickly, or while a critical pokemon is active
+locationNormalSeconds   = 30
+locationSlowSeconds     = 300  # once the last few fixes haven't moved
+locationStationaryMiles = 0.03 # fixes within this of each other count as standing still
+locationHistory         = 4    # fixes kept to judge speed and standing still
+locationRefreshMiles    = 0.1  # moving this far since the last refresh triggers one early
+locationRetrySeconds    = 5    # first retry after a failed fix, doubling each failure up to locationMaxBackoff
+locationMaxBackoff      = 600
+locationTraceFile       = None # replay a GPS trace (lines of seconds,lat,long) instead of asking iCloud, for testing
+ingestQueueSize    = 1000 # max items waiting between each ingest stage
+
+# Event table writes are grouped, a commit happens every dbCommitRows rows or dbCommitSeconds, whichever is first
+dbCommitRows    = 100
+dbCommitSeconds = 0.25
+dbPragmas       = [ "journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY" ]
+
+# Schema changes, applied in order to any database whose user_version is behind
+schemaMigrations = [
+    ( 1, "create table if not exists event ( time integer, type text, lat real, long real, link text, notes text )" ),
+    ( 2, "create index if not exists event_time on event ( time )" ),
+    ( 3, "create index if not exists event_lat_long on event ( lat, long )" ), # bounding box lookups
+    # aggregates kept up to date by every insert, see SpawnAnalytics
+    ( 4, "create table if not exists species_hourly ( species text, hour integer, count integer, primary key ( species, hour ) )" ),
+    ( 5, "create table if not exists cell_density ( species text, cellLat integer, cellLong integer, hour integer, count integer, primary key ( species, cellLat, cellLong, hour ) )" ),
+    ( 6, "create table if not exists iv_histogram ( species text, bucket integer, count integer, primary key ( species, bucket ) )" ),
+    ( 7, lambda conn: SpawnAnalytics.rebuild(conn) ), # existing events
+]
+
+# Spawn analytics, events are counted per analyticsCellSize cell and per analyticsIvBucket percent of IV
+analyticsCellSize = 0.01 # degrees, ~.7 miles north/south
+analyticsIvBucket = 5
+
+# Google distance matrix, point the URL at a local server for testing
+distanceMatrixUrl       = "https://maps.googleapis.com/maps/api/distancematrix/json"
+distanceMatrixBatchSize = 25 # max destinations google accepts per request
+googlePoolSize          = 4  # keep-alive connections kept open to google
+googleTimeout           = 10 # seconds
+distanceMatrixMaxPerRefresh = 100 # remote lookups per refresh, highest priority first, the rest wait for the next refresh
+
+# Static map of the phone and active pokemon, shown on the dashboard as /current.png
+staticMapUrl          = "https://maps.googleapis.com/maps/api/staticmap"
+staticMapQuantization = 0.0005 # degrees (~.03 miles), the phone moving less than this doesn't redraw the map
+staticMapCacheSize    = 16     # rendered maps kept in memory, so going back to an earlier view costs nothing
+
+# The fastest we could possibly get anywhere (mph).  An active spawn further away than it could be reached at this
+# speed before it despawns is dropped without asking google, no later move can make it reachable again.
+reachSpeed = 40
+
+# Distance matrix result cache, lookups from (roughly) the same spot to the same spawn reuse the last answer
+distanceCacheQuantization = 0.002 # degrees, origin and destination are snapped to cells this size (~.14 miles)
+distanceCacheTTL          = 300   # seconds
+distanceCacheSize         = 5000  # entries, least recently used are evicted first
 
 class Current(object):
     testing = False
@@ -112,41 +213,692 @@ class Current(object):
     def getDebug():
         return Current.debug
 
-def sendTextMessageViaEmail(subject, message, link):
+##########################################################################
+# Metrics, served at /metrics in the Prometheus text format
 
-    # The URI here is bizarre.  This allows you to open google maps directly from a link in chrome (and safari I think)
-    myLink = link.replace("|Open in Google Maps>", "").replace("<http://maps.google.com/maps?q=", "comgooglemaps://?q=")
+class NullTimer(object):
+    """ What Histogram.time() hands out while metricsEnabled is off """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+nullTimer = NullTimer()
 
-    msg = """From: %s
+class MetricTimer(object):
+    __slots__ = "histogram started".split()
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.started = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.started)
+        return False
+
+class Counter(object):
+    __slots__ = "name labels value lock".split()
+    kind = "counter"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if not metricsEnabled:
+            return
+        with self.lock:
+            self.value = self.value + amount
+
+    def samples(self):
+        return [ ( self.name, self.labels, self.value ) ]
+
+class Gauge(object):
+    """ Either set() as things change, or given a func that is called on every scrape """
+    __slots__ = "name labels value func".split()
+    kind = "gauge"
+
+    def __init__(self, name, labels, func=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        if metricsEnabled:
+            self.value = value
+
+    def samples(self):
+        return [ ( self.name, self.labels, self.func() if self.func is not None else self.value ) ]
+
+class Histogram(object):
+    """ Observations (seconds, usually) counted into buckets, use observe() or "with histogram.time():" """
+    __slots__ = "name labels buckets counts total count lock".split()
+    kind = "histogram"
+    defaultBuckets = ( .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10 )
+
+    def __init__(self, name, labels, buckets=None):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(buckets or Histogram.defaultBuckets)
+        self.counts = [ 0 ] * ( len(self.buckets) + 1 ) # the last one is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        if not metricsEnabled:
+            return
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] = self.counts[idx] + 1
+            self.total = self.total + value
+            self.count = self.count + 1
+
+    def time(self):
+        if not metricsEnabled:
+            return nullTimer
+        return MetricTimer(self)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+            count = self.count
+        res = []
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets + ( "+Inf", ), counts):
+            cumulative = cumulative + bucketCount
+            res.append(( self.name + "_bucket", self.labels + ( ( "le", str(bound) ), ), cumulative ))
+        res.append(( self.name + "_sum", self.labels, total ))
+        res.append(( self.name + "_count", self.labels, count ))
+        return res
+
+class MetricsRegistry(object):
+    """ Every metric, by name and labels.  Asking for one that exists returns it, so callers can just ask """
+    __slots__ = "metrics help lock".split()
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict() # ( name, labels ) -> metric
+        self.help = {} # name -> ( kind, help )
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, help, labels, *args):
+        key = ( name, tuple(sorted(labels.items())) )
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(name, key[1], *args)
+                self.help[name] = ( cls.kind, help )
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, func=None, **labels):
+        metric = self.register(Gauge, name, help, labels, func)
+        if func is not None:
+            metric.func = func # a new web server (tests, benchmarks) brings new objects to read from
+        return metric
+
+    def histogram(self, name, help, buckets=None, **labels):
+        return self.register(Histogram, name, help, labels, buckets)
+
+    @staticmethod
+    def formatLabels(labels):
+        if not labels:
+            return ""
+        escaped = [ "%s=\"%s\"" % ( key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") ) for key, value in labels ]
+        return "{%s}" % ",".join(escaped)
+
+    def render(self):
+        with self.lock:
+            byName = collections.OrderedDict()
+            for ( name, _ ), metric in self.metrics.items():
+                byName.setdefault(name, []).append(metric)
+        lines = []
+        for name, group in byName.items():
+            kind, help = self.help[name]
+            lines.append("# HELP %s %s" % ( name, help ))
+            lines.append("# TYPE %s %s" % ( name, kind ))
+            for metric in group:
+                try:
+                    samples = metric.samples()
+                except Exception as ex:
+                    print "Error reading metric %s: %s" % ( name, str(ex) )
+                    continue
+                for sampleName, labels, value in samples:
+                    lines.append("%s%s %s" % ( sampleName, MetricsRegistry.formatLabels(labels), repr(float(value)) ))
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+class MetricsPlugin(object):
+    """ Bottle plugin timing every web handler, labelled with its route """
+    name = "metrics"
+    api = 2
+
+    def apply(self, callback, route):
+        histogram = metrics.histogram("watcher_web_request_seconds", "Time spent in each web handler", route=route.rule)
+
+        def wrapper(*args, **kw):
+            if not metricsEnabled:
+                return callback(*args, **kw)
+            with histogram.time():
+                return callback(*args, **kw)
+        return wrapper
+
+bottle.install(MetricsPlugin())
+
+metricSlackMessages  = metrics.counter("watcher_slack_messages_total", "Slack messages read by mainLoop", result="submitted")
+metricSlackSkipped   = metrics.counter("watcher_slack_messages_total", "Slack messages read by mainLoop", result="skipped")
+metricSlackBatch     = metrics.histogram("watcher_slack_batch_seconds", "Time to hand one rtm_read batch to the ingest pipeline")
+metricTick           = metrics.histogram("watcher_tick_seconds", "Full manager refreshes")
+metricUpdatePhases   = dict([ ( phase, metrics.histogram("watcher_update_phase_seconds", "Each phase of a manager refresh", phase=phase) ) for phase in ( "distances", "expire", "staticmap" ) ])
+metricGoogle         = dict([ ( api, metrics.histogram("watcher_google_request_seconds", "Google API requests", api=api) ) for api in ( "distancematrix", "staticmap" ) ])
+metricGoogleErrors   = dict([ ( api, metrics.counter("watcher_google_errors_total", "Failed google API requests", api=api) ) for api in ( "distancematrix", "staticmap" ) ])
+metricLocation       = metrics.histogram("watcher_location_request_seconds", "Phone location requests (iCloud)")
+metricLocationErrors = metrics.counter("watcher_location_errors_total", "Failed phone location requests")
+metricSmtp           = metrics.histogram("watcher_smtp_send_seconds", "SMTP sends, including any reconnect")
+metricSmtpErrors     = metrics.counter("watcher_smtp_errors_total", "Failed SMTP sends")
+metricSmtpConnects   = metrics.counter("watcher_smtp_connections_total", "SMTP connections opened")
+metricSubscriberAlerts = metrics.counter("watcher_subscriber_alerts_total", "Texts queued for subscribers")
+
+def sendTextMessageViaEmail(subject, message, link, key=None, recipient=None):
+    """ Queues a text (to vtext unless recipient is given), key identifies the spawn for deduplication.  Returns False if it was a duplicate """
+    return getNotificationDispatcher().submit(subject, message, link, key, recipient)
+
+def formatTextMessage(alerts):
+    """ The email for one or more alerts to the same recipient, a single alert looks just like the texts always have """
+    # The URI here is bizarre.  This allows you to open google maps directly from a link in chrome (and safari I think)
+    links = [ alert.link.replace("|Open in Google Maps>", "").replace("<http://maps.google.com/maps?q=", "comgooglemaps://?q=") for alert in alerts ]
+    if len(alerts) == 1:
+        subject = alerts[0].message
+        body = links[0]
+    else:
+        subject = "%d spawns: %s" % ( len(alerts), ", ".join([ alert.subject for alert in alerts ]) )
+        body = "\n\n".join([ "%s\n%s" % ( alert.message, link ) for alert, link in zip(alerts, links) ])
+
+    return """From: %s
 To: %s
 Subject: %s
 
 %s
-""" % (mailname, vtext, message, myLink)
+""" % (mailname, alerts[0].recipient or vtext, subject, body)
+
+class SmtpSession(object):
+    """ One SMTP connection, opened on first use and reopened (once per send) if the server dropped it """
+    __slots__ = "host port startTls user password server lastUsed connections".split()
+
+    def __init__(self, host=None, port=None, startTls=None, user=None, password=None):
+        self.host = host if host is not None else smtpHost
+        self.port = port if port is not None else smtpPort
+        self.startTls = startTls if startTls is not None else smtpStartTls
+        self.user = user if user is not None else mailname
+        self.password = password if password is not None else mailpass
+        self.server = None
+        self.lastUsed = 0
+        self.connections = 0
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port)
+        if self.startTls:
+            server.starttls()
+        if self.user:
+            server.login(self.user, self.password)
+        self.server = server
+        self.connections = self.connections + 1
+        metricSmtpConnects.inc()
+
+    def send(self, sender, recipient, msg):
+        with metricSmtp.time():
+            for attempt in ( 1, 2 ):
+                try:
+                    if self.server is None:
+                        self.connect()
+                    self.server.sendmail(sender, recipient, msg)
+                    self.lastUsed = time.time()
+                    return
+                except ( smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.error ):
+                    # most likely the server timed out our idle session, reconnect and try once more
+                    self.close()
+                    if attempt == 2:
+                        metricSmtpErrors.inc()
+                        raise
+
+    def closeIfIdle(self, idleSeconds):
+        if self.server is not None and time.time() - self.lastUsed > idleSeconds:
+            self.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+TextAlert = collections.namedtuple("TextAlert", "subject message link key created recipient")
+
+class NotificationDispatcher(threading.Thread):
+    """
+    Sends texts from its own thread, so whoever decides to text (the manager) never waits on SMTP.
+    Alerts for a spawn already texted within dedupeSeconds are dropped, alerts arriving within
+    coalesceSeconds of each other, or while waiting out minInterval since the last text, go out as one.
+    """
+    STOP = object()
+
+    def __init__(self, session=None, coalesceSeconds=None, minInterval=None, dedupeSeconds=None):
+        threading.Thread.__init__(self, name="notify")
+        self.setDaemon(True)
+        self.session = session if session is not None else SmtpSession()
+        self.coalesceSeconds = coalesceSeconds if coalesceSeconds is not None else textCoalesceSeconds
+        self.minInterval = minInterval if minInterval is not None else textMinInterval
+        self.dedupeSeconds = dedupeSeconds if dedupeSeconds is not None else textDedupeSeconds
+        self.pending = Queue.Queue()
+        self.lock = threading.Lock()
+        self.recent = collections.OrderedDict() # dedupe key -> time it was queued, oldest first
+        self.lastSent = 0
+        self.stats = { "submitted" : 0, "duplicates" : 0, "texts" : 0, "alertsSent" : 0, "failures" : 0, "dropped" : 0 }
 
-    print "SENDING: %s" % msg
+    @staticmethod
+    def spawnKey(name, coords):
+        """ Species and location, snapped to textDedupeQuantization """
+        return ( name, int(floor(coords[0] / textDedupeQuantization)), int(floor(coords[1] / textDedupeQuantization)) )
+
+    def submit(self, subject, message, link, key=None, recipient=None):
+        now = time.time()
+        if key is not None and recipient is not None:
+            key = ( recipient, key ) # everyone gets their own text for the same spawn
+        with self.lock:
+            self.stats["submitted"] = self.stats["submitted"] + 1
+            while self.recent and self.recent.itervalues().next() < now - self.dedupeSeconds:
+                self.recent.popitem(last=False)
+            if key is not None:
+                if key in self.recent:
+                    self.stats["duplicates"] = self.stats["duplicates"] + 1
+                    return False
+                self.recent[key] = now
+        self.pending.put(TextAlert(subject, message, link, key, now, recipient))
+        return True
 
-    server = smtplib.SMTP('smtp.gmail.com', 587)
-    server.starttls()
-    server.login(mailname,mailpass)
-    server.sendmail(mailname, vtext, msg)
-    server.quit()
+    def stop(self, timeout=None):
+        """ Sends whatever is queued (ignoring the coalesce window and rate limit) then closes the session """
+        self.pending.put(NotificationDispatcher.STOP)
+        self.join(timeout)
 
-def shouldSendText(pm, distance, hr=datetime.datetime.now().hour):
-    if pm.getName() in alwaysTextList and distance < alwaysTextMaxDistance:
-        return True
+    def run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self.pending.get(True, smtpIdleSeconds)
+            except Queue.Empty:
+                self.session.closeIfIdle(smtpIdleSeconds)
+                continue
+            if first is NotificationDispatcher.STOP:
+                break
+
+            # collect everything that arrives within the window, and while the rate limit holds us back
+            batch = [ first ]
+            sendAt = max(first.created + self.coalesceSeconds, self.lastSent + self.minInterval)
+            while True:
+                timeout = sendAt - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    alert = self.pending.get(True, timeout)
+                except Queue.Empty:
+                    break
+                if alert is NotificationDispatcher.STOP:
+                    stopping = True
+                    break
+                batch.append(alert)
+
+            byRecipient = collections.OrderedDict()
+            for alert in batch:
+                byRecipient.setdefault(alert.recipient, []).append(alert)
+            for alerts in byRecipient.itervalues():
+                self.sendBatch(alerts)
+        self.session.close()
+
+    def sendBatch(self, batch):
+        """ batch is alerts for one recipient """
+        msg = formatTextMessage(batch)
+        if Current.debug:
+            print "SENDING: %s" % msg
+        for attempt in range(3):
+            try:
+                self.session.send(mailname, batch[0].recipient or vtext, msg)
+                with self.lock:
+                    self.stats["texts"] = self.stats["texts"] + 1
+                    self.stats["alertsSent"] = self.stats["alertsSent"] + len(batch)
+                self.lastSent = time.time()
+                return True
+            except Exception as ex:
+                print "Failed to send text, attempt %d" % ( attempt + 1 )
+                traceback.print_exc()
+                with self.lock:
+                    self.stats["failures"] = self.stats["failures"] + 1
+                time.sleep(2 ** attempt)
+        with self.lock:
+            self.stats["dropped"] = self.stats["dropped"] + len(batch)
+        return False
 
-    # if critical and perfect, text at any time
-    if pm.getCritical() and pm.getPerfect():
-        return True
+    def getStats(self):
+        with self.lock:
+            res = dict(self.stats)
+        res["connections"] = self.session.connections
+        res["queued"] = self.pending.qsize()
+        return res
+
+# Guards creating the process wide singletons below, their first use can come from the manager, the ingest
+# stages and the web workers at once, and a second copy would be orphaned along with whatever was queued on it
+singletonLock = threading.RLock()
+
+notificationDispatcher = None
+
+def getNotificationDispatcher():
+    """ The process wide dispatcher, started on first use """
+    global notificationDispatcher
+    if notificationDispatcher is None:
+        with singletonLock:
+            if notificationDispatcher is None:
+                dispatcher = NotificationDispatcher()
+                dispatcher.start()
+                notificationDispatcher = dispatcher
+    return notificationDispatcher
+
+def shouldSendText(pm, distance, hr=None):
+    """ hr is the hour of the day, now if not given """
+    if hr is None:
+        hr = datetime.datetime.now().hour
+    return getRules().shouldSendText(pm, distance, hr)
+
+SpeciesRule = collections.namedtuple("SpeciesRule", "notify critical noText alwaysText alwaysTextDistance perfectTextDistance criticalTextDistance")
+
+class NotificationRules(object):
+    """
+    The texting and highlighting policy, compiled once into a table of SpeciesRule keyed by lowercase
+    name, so classifying a spawn is one dict lookup and a comparison against its parsed IV.
+    """
+    __slots__ = "species default perfectIV textEarly textLate lists maxDistance source mtime version".split()
+
+    listKeys = ( "alwaysText", "alwaysTextIfPerfect", "perfectText", "critical", "noText" )
+    distanceKeys = ( "alwaysText", "perfectText", "criticalText" )
+
+    def __init__(self, config, source=None, mtime=None, version=1):
+        unknown = set(config.keys()) - set(NotificationRules.listKeys + ( "distances", "perfectIV", "textHours", "species" ))
+        if unknown:
+            raise Exception("Unknown keys in rules: %s" % sorted(unknown))
+
+        self.source = source
+        self.mtime = mtime
+        self.version = version
+        self.lists = dict([ ( key, frozenset([ name.lower() for name in config.get(key, ()) ]) ) for key in NotificationRules.listKeys ])
+        notify = frozenset().union(*self.lists.values())
+
+        distances = NotificationRules.checkDistances(config.get("distances", {}), "distances")
+        overrides = dict([ ( name.lower(), NotificationRules.checkDistances(value, name) ) for name, value in config.get("species", {}).items() ])
+
+        self.species = {}
+        for name in notify | frozenset(overrides.keys()):
+            limits = dict(distances)
+            limits.update(overrides.get(name, {}))
+            self.species[name] = SpeciesRule(name in notify, name in self.lists["critical"], name in self.lists["noText"], name in self.lists["alwaysText"],
+                limits["alwaysText"], limits["perfectText"], limits["criticalText"])
+        self.default = SpeciesRule(False, False, False, False, distances["alwaysText"], distances["perfectText"], distances["criticalText"])
+        # nothing further away than this can ever be texted
+        self.maxDistance = max([ max(rule.alwaysTextDistance, rule.perfectTextDistance, rule.criticalTextDistance) for rule in self.species.values() + [ self.default ] ])
+
+        self.perfectIV = float(config.get("perfectIV", perfectIV))
+        self.textEarly, self.textLate = [ int(hour) for hour in config.get("textHours", [ textEarly, textLate ]) ]
+
+    @staticmethod
+    def checkDistances(value, where):
+        if not isinstance(value, dict) or set(value.keys()) - set(NotificationRules.distanceKeys):
+            raise Exception("Rules for %s should only set %s" % ( where, ", ".join(NotificationRules.distanceKeys) ))
+        res = dict([ ( key, float(miles) ) for key, miles in value.items() ])
+        if where == "distances":
+            for key, miles in zip(NotificationRules.distanceKeys, ( alwaysTextMaxDistance, perfectTextMaxDistance, criticalTextMaxDistance )):
+                res.setdefault(key, miles)
+        return res
 
-    elif hr >= textEarly and hr <= textLate:
-        #print "Inside early/late! isPerfect=%s, isCritical=%s" % ( pm.getPerfect(), pm.getCritical() )
-        if pm.getPerfect() and distance < perfectTextMaxDistance:
+    @staticmethod
+    def defaultConfig():
+        """ The rules as configured by the module level lists """
+        return {
+            "alwaysText"          : alwaysTextList,
+            "alwaysTextIfPerfect" : alwaysTextIfPerfectList,
+            "perfectText"         : perfectTextList,
+            "critical"            : criticalList,
+            "noText"              : noTextList,
+            "distances"           : { "alwaysText" : alwaysTextMaxDistance, "perfectText" : perfectTextMaxDistance, "criticalText" : criticalTextMaxDistance },
+            "perfectIV"           : perfectIV,
+            "textHours"           : [ textEarly, textLate ]
+        }
+
+    def lookup(self, name):
+        return self.species.get(name, self.default)
+
+    def isPerfect(self, iv):
+        return iv is not None and iv >= self.perfectIV
+
+    def getNotifyList(self):
+        return sorted([ name for name, rule in self.species.iteritems() if rule.notify ])
+
+    def shouldSendText(self, pm, distance, hr):
+        """ For the owner, pm has already been classified against these rules """
+        return self.shouldText(self.lookup(pm.getName()), pm.getCritical(), pm.getPerfect(), distance, hr)
+
+    def shouldAlert(self, pm, distance, hr):
+        """
+        For a Subscriber, whose rules pm was not classified against.  Unlike the owner's texts, critical
+        and perfect spawns are only sent within maxDistance too, so subscribers can be found by location.
+        """
+        rule = self.lookup(pm.getName())
+        return rule.notify and distance < self.maxDistance and self.shouldText(rule, rule.critical, self.isPerfect(pm.iv), distance, hr)
+
+    def shouldText(self, rule, critical, perfect, distance, hr):
+        if rule.alwaysText and distance < rule.alwaysTextDistance:
             return True
-        elif pm.getCritical() and distance < criticalTextMaxDistance:
+
+        # if critical and perfect, text at any time
+        if critical and perfect:
             return True
-    return False
+
+        elif hr >= self.textEarly and hr <= self.textLate:
+            if perfect and distance < rule.perfectTextDistance:
+                return True
+            elif critical and distance < rule.criticalTextDistance:
+                return True
+        return False
+
+rules = None
+rulesFailedStamp = None # ( mtime, size ) of a rulesFile that didn't load, so it isn't retried until it changes
+
+def getRules():
+    """ The current rules, loaded from rulesFile on first use """
+    global rules
+    if rules is None:
+        with singletonLock:
+            if rules is None:
+                rules = loadRules()
+    return rules
+
+def loadRules(previous=None):
+    """ Compiles rulesFile, or the module level settings when there is no such file """
+    if not os.path.exists(rulesFile):
+        return NotificationRules(NotificationRules.defaultConfig(), version=1 if previous is None else previous.version + 1)
+    mtime = os.path.getmtime(rulesFile)
+    with open(rulesFile) as f:
+        config = json.load(f)
+    return NotificationRules(config, source=rulesFile, mtime=mtime, version=1 if previous is None else previous.version + 1)
+
+def reloadRulesIfChanged():
+    """ Swaps in a fresh NotificationRules if rulesFile appeared, changed or went away, returns True if it did """
+    global rules, rulesFailedStamp
+    current = getRules()
+    exists = os.path.exists(rulesFile)
+    if not exists:
+        rulesFailedStamp = None
+        if current.source is None:
+            return False
+    else:
+        stat = os.stat(rulesFile)
+        stamp = ( stat.st_mtime, stat.st_size )
+        if stamp == rulesFailedStamp:
+            return False
+        if current.source is not None and stat.st_mtime == current.mtime:
+            return False
+    try:
+        rules = loadRules(current)
+    except Exception as ex:
+        # keep the rules we have rather than run without any, and don't retry until the file changes again
+        print "Failed to load %s, keeping the previous rules" % rulesFile
+        traceback.print_exc()
+        rulesFailedStamp = stamp if exists else None
+        return False
+    rulesFailedStamp = None
+    print "Loaded rules version %d from %s" % ( rules.version, rules.source or "watcher.py" )
+    return True
+
+class Subscriber(object):
+    """ Someone else alerted from this feed: where they are, what they want texted, and where to """
+    __slots__ = "name coords rules recipient enableTexts lastMoved alerts".split()
+
+    def __init__(self, name, rules, recipient, coords=None, enableTexts=True):
+        self.name = name
+        self.rules = rules
+        self.recipient = recipient
+        self.coords = coords
+        self.enableTexts = enableTexts
+        self.lastMoved = None
+        self.alerts = 0
+
+    def getCoords(self):
+        return self.coords
+
+    @staticmethod
+    def fromConfig(config, baseDir=""):
+        """ One entry of subscribersFile, "rules" is a rules file (relative to subscribersFile) or the rules themselves """
+        unknown = set(config.keys()) - set([ "name", "text", "location", "rules", "texts" ])
+        if unknown:
+            raise Exception("Unknown keys for subscriber %s: %s" % ( config.get("name"), sorted(unknown) ))
+        rulesConfig = config.get("rules")
+        source = None
+        if rulesConfig is None:
+            rulesConfig = NotificationRules.defaultConfig()
+        elif not isinstance(rulesConfig, dict):
+            source = os.path.join(baseDir, rulesConfig)
+            with open(source) as f:
+                rulesConfig = json.load(f)
+        location = config.get("location")
+        return Subscriber(config["name"], NotificationRules(rulesConfig, source=source), config["text"],
+            [ float(location[0]), float(location[1]) ] if location else None, bool(config.get("texts", True)))
+
+class SubscriberRegistry(object):
+    """
+    Everyone to fan new spawns out to, in a SpatialIndex by where they are.  A spawn is only checked
+    against the subscribers within maxRadius of it (the furthest anyone's rules text for), so the cost
+    of a spawn grows with the people near it rather than with everyone.  Also the ingest stage handler
+    that does the fanning out, it passes each Pokemon on to the manager unchanged.
+    """
+    __slots__ = "byName index maxRadius lock spawns candidates alerts".split()
+
+    def __init__(self, subscribers=(), cellSize=None):
+        self.byName = collections.OrderedDict()
+        self.index = SpatialIndex(cellSize if cellSize is not None else subscriberCellSize)
+        self.maxRadius = 0.0
+        self.lock = threading.Lock()
+        self.spawns = 0
+        self.candidates = 0 # subscribers the index returned, summed over spawns
+        self.alerts = 0
+        for subscriber in subscribers:
+            self.add(subscriber)
+
+    def __len__(self):
+        return len(self.byName)
+
+    def add(self, subscriber):
+        with self.lock:
+            if subscriber.name in self.byName:
+                raise Exception("Duplicate subscriber %s" % subscriber.name)
+            self.byName[subscriber.name] = subscriber
+            if subscriber.coords is not None:
+                self.index.add(subscriber)
+            self.maxRadius = max(self.maxRadius, subscriber.rules.maxDistance)
+
+    def get(self, name):
+        return self.byName.get(name)
+
+    def move(self, name, coords, now=None):
+        """ A new location for name, returns False if there is no such subscriber """
+        with self.lock:
+            subscriber = self.byName.get(name)
+            if subscriber is None:
+                return False
+            # the index buckets by coordinate, take it out before the coordinate changes
+            if subscriber.coords is not None:
+                self.index.remove(subscriber)
+            subscriber.coords = [ float(coords[0]), float(coords[1]) ]
+            subscriber.lastMoved = now if now is not None else time.time()
+            self.index.add(subscriber)
+        return True
+
+    def match(self, pm, hr=None):
+        """ ( subscriber, distance ) for everyone whose rules say to text them about pm """
+        if hr is None:
+            hr = datetime.datetime.now().hour
+        with self.lock:
+            nearby = self.index.within(pm.getCoords(), self.maxRadius)
+        self.spawns = self.spawns + 1
+        self.candidates = self.candidates + len(nearby)
+        return [ ( subscriber, distance ) for subscriber, distance in nearby if subscriber.rules.shouldAlert(pm, distance, hr) ]
+
+    def __call__(self, pm):
+        if pm.getText() is None:
+            return pm
+        for subscriber, distance in self.match(pm):
+            if not subscriber.enableTexts:
+                continue
+            if sendTextMessageViaEmail(pm.getName(), pm.getText(), pm.getLink(), NotificationDispatcher.spawnKey(pm.getName(), pm.getCoords()), subscriber.recipient):
+                subscriber.alerts = subscriber.alerts + 1
+                self.alerts = self.alerts + 1
+                metricSubscriberAlerts.inc()
+        return pm
+
+    def stats(self):
+        return { "subscribers" : len(self.byName), "located" : len(self.index), "spawns" : self.spawns, "candidates" : self.candidates, "alerts" : self.alerts }
+
+subscribers = None
+
+def getSubscribers():
+    """ The subscribers from subscribersFile, loaded on first use, empty without one """
+    global subscribers
+    if subscribers is None:
+        with singletonLock:
+            if subscribers is None:
+                subscribers = loadSubscribers()
+    return subscribers
+
+def loadSubscribers(path=None):
+    path = path if path is not None else subscribersFile
+    if not os.path.exists(path):
+        return SubscriberRegistry()
+    with open(path) as f:
+        config = json.load(f)
+    baseDir = os.path.dirname(path)
+    registry = SubscriberRegistry([ Subscriber.fromConfig(entry, baseDir) for entry in config.get("subscribers", []) ])
+    print "Loaded %d subscribers from %s" % ( len(registry), path )
+    return registry
 
 def haversine(lat1, lat2, lon1, lon2):
     # convert decimal degrees to radians
@@ -159,21 +911,727 @@ def haversine(lat1, lat2, lon1, lon2):
     miles = ( 6367 * c ) * 0.62137 # convert to miles, because 'merica
     return miles
 
+def haversineMany(lat, lon, lats, lons):
+    """ Vectorized haversine from a single point to arrays of points (all in radians), returns miles """
+    a = numpy.sin((lats - lat) / 2) ** 2 + cos(lat) * numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2
+    return ( 6367 * 2 * numpy.arcsin(numpy.sqrt(a)) ) * 0.62137
+
+class DistanceBatch(object):
+    """
+    Keeps the coordinates of tracked pokemon in contiguous arrays, so a single refresh computes the
+    distance from the phone to every pokemon, and how far the phone moved since each pokemon's last
+    google check, then writes both back as crowDistance / movedDistance.
+    """
+    __slots__ = "lat lon checkLat checkLon members slots free size".split()
+
+    def __init__(self, capacity=64):
+        self.members = []
+        self.slots = {}
+        self.free = []
+        self.size = 0
+        if numpy is not None:
+            self.lat = numpy.full(capacity, numpy.nan)
+            self.lon = numpy.full(capacity, numpy.nan)
+            self.checkLat = numpy.full(capacity, numpy.nan)
+            self.checkLon = numpy.full(capacity, numpy.nan)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def grow(self):
+        for name in ( "lat", "lon", "checkLat", "checkLon" ):
+            old = getattr(self, name)
+            new = numpy.full(len(old) * 2, numpy.nan)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, pm):
+        if pm.getId() in self.slots:
+            return
+        if self.free:
+            slot = self.free.pop()
+            self.members[slot] = pm
+        else:
+            slot = self.size
+            self.size = self.size + 1
+            self.members.append(pm)
+            if numpy is not None and slot >= len(self.lat):
+                self.grow()
+        self.slots[pm.getId()] = slot
+        if numpy is not None:
+            coords = pm.getCoords()
+            self.lat[slot] = radians(coords[0])
+            self.lon[slot] = radians(coords[1])
+        self.markChecked(pm)
+
+    def remove(self, pm):
+        slot = self.slots.pop(pm.getId(), None)
+        if slot is None:
+            return False
+        self.members[slot] = None
+        if numpy is not None:
+            self.lat[slot] = self.lon[slot] = numpy.nan
+            self.checkLat[slot] = self.checkLon[slot] = numpy.nan
+        self.free.append(slot)
+        return True
+
+    def markChecked(self, pm):
+        """ Call after pm.lastCoordCheck changes (i.e. a google lookup) """
+        slot = self.slots.get(pm.getId())
+        if slot is None or numpy is None:
+            return
+        check = pm.lastCoordCheck
+        if check is None:
+            self.checkLat[slot] = self.checkLon[slot] = numpy.nan
+        else:
+            self.checkLat[slot] = radians(check[0])
+            self.checkLon[slot] = radians(check[1])
+
+    def refresh(self, phoneCoord):
+        """ Computes crowDistance and movedDistance for every member in one pass """
+        if phoneCoord is None or not self.slots:
+            return 0
+
+        size = self.size
+        members = self.members[:size]
+        if numpy is None:
+            for pm in members:
+                if pm is not None:
+                    pm.crowDistance = haversine(phoneCoord[0], pm.coords[0], phoneCoord[1], pm.coords[1])
+                    check = pm.lastCoordCheck
+                    pm.movedDistance = None if check is None else haversine(phoneCoord[0], check[0], phoneCoord[1], check[1])
+            return len(self.slots)
+
+        lat = radians(phoneCoord[0])
+        lon = radians(phoneCoord[1])
+        crow = haversineMany(lat, lon, self.lat[:size], self.lon[:size]).tolist()
+        moved = haversineMany(lat, lon, self.checkLat[:size], self.checkLon[:size]).tolist()
+        for idx, pm in enumerate(members):
+            if pm is not None:
+                pm.crowDistance = crow[idx]
+                movedDistance = moved[idx]
+                pm.movedDistance = None if movedDistance != movedDistance else movedDistance # NaN means never checked
+        return len(self.slots)
+
+class SpatialIndex(object):
+    """ Grid bucketed index of pokemon by coordinate, radius queries only visit the cells that can match """
+    __slots__ = "cellSize cells count".split()
+
+    def __init__(self, cellSize=None):
+        self.cellSize = cellSize if cellSize is not None else spatialCellSize
+        self.cells = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for bucket in self.cells.itervalues():
+            for pm in bucket:
+                yield pm
+
+    def cellFor(self, coords):
+        return ( int(floor(coords[0] / self.cellSize)), int(floor(coords[1] / self.cellSize)) )
+
+    def add(self, pm):
+        bucket = self.cells.setdefault(self.cellFor(pm.getCoords()), set())
+        if pm not in bucket:
+            bucket.add(pm)
+            self.count = self.count + 1
+
+    def remove(self, pm):
+        key = self.cellFor(pm.getCoords())
+        bucket = self.cells.get(key)
+        if bucket is None or pm not in bucket:
+            return False
+        bucket.remove(pm)
+        self.count = self.count - 1
+        if not bucket:
+            del self.cells[key]
+        return True
+
+    def within(self, coord, radius):
+        """ Returns ( pokemon, distance ) for everything within radius miles of coord """
+        if coord is None or self.count == 0:
+            return []
+
+        # one degree of latitude is ~69 miles, longitude shrinks by cos(lat)
+        latDelta = radius / 69.0
+        lonDelta = radius / max(69.0 * cos(radians(coord[0])), 0.01)
+        minLat, minLon = self.cellFor([ coord[0] - latDelta, coord[1] - lonDelta ])
+        maxLat, maxLon = self.cellFor([ coord[0] + latDelta, coord[1] + lonDelta ])
+
+        if ( maxLat - minLat + 1 ) * ( maxLon - minLon + 1 ) > len(self.cells):
+            # the search box covers more cells than we have populated, just walk the populated ones
+            buckets = [ bucket for key, bucket in self.cells.iteritems() if minLat <= key[0] <= maxLat and minLon <= key[1] <= maxLon ]
+        else:
+            buckets = [ self.cells[(x, y)] for x in xrange(minLat, maxLat + 1) for y in xrange(minLon, maxLon + 1) if (x, y) in self.cells ]
+
+        candidates = [ pm for bucket in buckets for pm in bucket ]
+        if numpy is not None and len(candidates) > 32:
+            coords = numpy.radians(numpy.array([ pm.getCoords() for pm in candidates ], dtype=float))
+            distances = haversineMany(radians(coord[0]), radians(coord[1]), coords[:, 0], coords[:, 1]).tolist()
+        else:
+            distances = [ haversine(coord[0], pm.coords[0], coord[1], pm.coords[1]) for pm in candidates ]
+        return [ ( pm, distance ) for pm, distance in zip(candidates, distances) if distance < radius ]
+
+class ExpiryHeap(object):
+    """
+    Min-heap of ( deadline, id, pokemon ) where the deadline is when the pokemon despawns, or becomes
+    unreachable given its timeToTarget.  Re-pushing a pokemon with a new deadline leaves the old entry
+    behind, stale entries are skipped when they reach the top.
+    """
+    __slots__ = "heap deadlines".split()
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def push(self, pm):
+        """ (Re)schedules pm, a no-op if its deadline has not changed """
+        deadline = pm.getExpiryTime()
+        if self.deadlines.get(pm.getId()) == deadline:
+            return
+        self.deadlines[pm.getId()] = deadline
+        heapq.heappush(self.heap, ( deadline, pm.getId(), pm ))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.compact()
+
+    def discard(self, pm):
+        self.deadlines.pop(pm.getId(), None)
+
+    def compact(self):
+        self.heap = [ entry for entry in self.heap if self.deadlines.get(entry[1]) == entry[0] ]
+        heapq.heapify(self.heap)
+
+    def nextDeadline(self):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def popExpired(self, now):
+        """ Removes and returns every pokemon whose deadline is at or before now """
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, idVal, pm = heapq.heappop(self.heap)
+            if self.deadlines.get(idVal) != deadline:
+                continue # stale, it was rescheduled or discarded
+            del self.deadlines[idVal]
+            expired.append(pm)
+        return expired
+
+class DistanceCache(object):
+    """
+    LRU cache of ( distance, time ) keyed on the quantized ( origin, destination ), entries expire after ttl
+    seconds.  Keeps hit/miss counters, plus the time spent on misses so the time saved by hits can be estimated.
+    """
+    __slots__ = "entries lock quantization ttl maxSize hits misses expired evictions missSeconds missCount".split()
+
+    def __init__(self, quantization=None, ttl=None, maxSize=None):
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.quantization = quantization if quantization is not None else distanceCacheQuantization
+        self.ttl = ttl if ttl is not None else distanceCacheTTL
+        self.maxSize = maxSize if maxSize is not None else distanceCacheSize
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.missSeconds = 0.0 # time spent resolving misses remotely
+        self.missCount = 0     # how many elements that time covered
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cellFor(self, coords):
+        return ( int(round(coords[0] / self.quantization)), int(round(coords[1] / self.quantization)) )
+
+    def keyFor(self, origin, destination):
+        return ( self.cellFor(origin), self.cellFor(destination) )
+
+    def get(self, origin, destination, now=None):
+        """ Returns ( distance, time ) or None """
+        key = self.keyFor(origin, destination)
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and now - entry[2] > self.ttl:
+                self.expired = self.expired + 1
+                entry = None
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            self.entries[key] = entry # re-insert as most recently used
+            self.hits = self.hits + 1
+            return entry[0], entry[1]
+
+    def put(self, origin, destination, distance, timeTo, now=None):
+        key = self.keyFor(origin, destination)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = ( distance, timeTo, time.time() if now is None else now )
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+    def recordMissLatency(self, seconds, count):
+        with self.lock:
+            self.missSeconds = self.missSeconds + seconds
+            self.missCount = self.missCount + count
+
+    def getSecondsSaved(self):
+        """ Estimated remote time avoided, hits times the average per-element miss latency """
+        if self.missCount == 0:
+            return 0.0
+        return self.hits * ( self.missSeconds / self.missCount )
+
+    def stats(self):
+        return {
+            "size"         : len(self.entries),
+            "hits"         : self.hits,
+            "misses"       : self.misses,
+            "expired"      : self.expired,
+            "evictions"    : self.evictions,
+            "secondsSaved" : self.getSecondsSaved()
+        }
+
+class DistanceMatrixClient(object):
+    """
+    Resolves driving distance/time for many pokemon at once.  Destinations are sent to google in batches
+    of distanceMatrixBatchSize over a pooled keep-alive session, and each result row is handed back to
+    its pokemon.
+    """
+    __slots__ = "session url batchSize cache requestCount elementCount deferredCount".split()
+
+    def __init__(self, url=None, batchSize=None, poolSize=None, cache=None):
+        self.url = url
+        self.cache = cache if cache is not None else DistanceCache()
+        self.batchSize = batchSize if batchSize is not None else distanceMatrixBatchSize
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolSize if poolSize is not None else googlePoolSize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.requestCount = 0
+        self.elementCount = 0
+        self.deferredCount = 0
+
+    def resolve(self, origin, pokemonList, limit=None):
+        """
+        Looks up every pokemon from origin, returns how many were resolved.  With a limit, only the first
+        limit cache misses are sent to google, so pass the list most important first.
+        """
+        resolved = 0
+        remote = []
+        for pm in pokemonList:
+            cached = self.cache.get(origin, pm.getCoords())
+            if cached is None:
+                remote.append(pm)
+            else:
+                DistanceMatrixClient.applyResult(pm, origin, cached[0], cached[1])
+                resolved = resolved + 1
+        if limit is not None and len(remote) > limit:
+            self.deferredCount = self.deferredCount + len(remote) - limit
+            remote = remote[:limit]
+        pokemonList = remote
+
+        originStr = "%f,%f" % ( origin[0], origin[1] )
+        for start in xrange(0, len(pokemonList), self.batchSize):
+            chunk = pokemonList[start:start + self.batchSize]
+            params = {
+                "origins"      : originStr,
+                "destinations" : "|".join([ pm.coordStr for pm in chunk ]),
+                "mode"         : "driving",
+                "units"        : "imperial",
+                "key"          : apiKey
+            }
+            try:
+                started = time.time()
+                resp = self.session.get(self.url or distanceMatrixUrl, params=params, timeout=googleTimeout)
+                self.requestCount = self.requestCount + 1
+                resp.raise_for_status()
+                resolved = resolved + self.handleDistanceResult(resp.text, origin, chunk)
+                self.cache.recordMissLatency(time.time() - started, len(chunk))
+                metricGoogle["distancematrix"].observe(time.time() - started)
+            except Exception as ex:
+                metricGoogleErrors["distancematrix"].inc()
+                traceback.print_exc()
+                print "Error processing JSON from google distance API! %s" % str(ex)
+        return resolved
+
+    def handleDistanceResult(self, jsonData, origin, pokemonList):
+        """ Fans a multi-destination response back out, column N belongs to pokemonList[N] """
+        jsonRes = json.loads(jsonData)
+        resolved = 0
+        for column, pm in enumerate(pokemonList):
+            try:
+                pm.handleDistanceResult(jsonRes, column)
+            except Exception as ex:
+                print "No distance result for %s: %s" % ( str(pm), str(ex) )
+                continue
+            self.cache.put(origin, pm.getCoords(), pm.getDistanceToTarget(), pm.getTimeToTarget())
+            DistanceMatrixClient.applyResult(pm, origin, pm.getDistanceToTarget(), pm.getTimeToTarget())
+            resolved = resolved + 1
+        self.elementCount = self.elementCount + resolved
+        return resolved
+
+    @staticmethod
+    def applyResult(pm, origin, distance, timeTo):
+        pm.distanceToTarget = distance
+        pm.timeToTarget = timeTo
+        pm.lastCoordCheck = list(origin)
+        pm.movedDistance = 0.0
+        pm.haversineOnly = False
+
+global distanceMatrix
+distanceMatrix = None
+
+def getDistanceMatrixClient():
+    """ The process wide client, so every lookup shares one connection pool """
+    global distanceMatrix
+    if distanceMatrix is None:
+        with singletonLock:
+            if distanceMatrix is None:
+                distanceMatrix = DistanceMatrixClient()
+    return distanceMatrix
+
+class StaticMapRenderer(threading.Thread):
+    """
+    Downloads static maps in the background and keeps the last staticMapCacheSize of them in memory, keyed
+    by url.  request() never blocks: a cached map is swapped in at once, otherwise the newest url asked
+    for is fetched next (anything requested in between is skipped).  Maps are served by their content hash.
+    """
+    def __init__(self, cacheSize=None):
+        threading.Thread.__init__(self, name="static-map")
+        self.setDaemon(True)
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict() # url -> ( etag, png ), least recently used first
+        self.cacheSize = cacheSize if cacheSize is not None else staticMapCacheSize
+        self.current = None # ( url, etag, png ) being served
+        self.wanted = None  # url the manager last asked for
+        self.pending = Queue.Queue()
+        self.stats = { "requests" : 0, "unchanged" : 0, "cacheHits" : 0, "downloads" : 0, "skipped" : 0, "errors" : 0 }
+
+    @staticmethod
+    def quantize(coord):
+        """ [ lat, long ] snapped to staticMapQuantization, as the "lat,long" string used in the url """
+        return "%.6f,%.6f" % ( round(coord[0] / staticMapQuantization) * staticMapQuantization, round(coord[1] / staticMapQuantization) * staticMapQuantization )
+
+    @staticmethod
+    def buildUrl(center, markers):
+        """ center is a quantized "lat,long", markers a list of ( label, "lat,long" ) with a label of None for the phone """
+        parts = [ "%s?size=640x640&center=%s&maptype=roadmap&key=%s" % ( staticMapUrl, center, staticMapApiKey ) ]
+        for label, coordStr in markers:
+            if label is None:
+                parts.append("&markers=color:black|%s" % coordStr)
+            else:
+                parts.append("&markers=label:%s|%s" % ( label, coordStr ))
+        return "".join(parts)
+
+    def request(self, url):
+        """ Makes url the map being served, as soon as we have it """
+        with self.lock:
+            self.stats["requests"] = self.stats["requests"] + 1
+            if self.wanted == url:
+                self.stats["unchanged"] = self.stats["unchanged"] + 1
+                return
+            self.wanted = url
+            cached = self.cache.get(url)
+            if cached is not None:
+                self.stats["cacheHits"] = self.stats["cacheHits"] + 1
+                del self.cache[url]
+                self.cache[url] = cached
+                self.current = ( url, cached[0], cached[1] )
+                return
+        self.pending.put(url)
+
+    def clear(self):
+        """ Stops serving a map, e.g. when location is turned off """
+        with self.lock:
+            self.wanted = None
+            self.current = None
+
+    def getCurrent(self):
+        """ ( etag, png ), or None """
+        current = self.current
+        return None if current is None else ( current[1], current[2] )
+
+    def run(self):
+        while True:
+            url = self.pending.get()
+            if url != self.wanted:
+                # asked for something newer since, that one is (or will be) in the queue
+                with self.lock:
+                    self.stats["skipped"] = self.stats["skipped"] + 1
+                continue
+            try:
+                with metricGoogle["staticmap"].time():
+                    resp = self.session.get(url, timeout=googleTimeout)
+                    resp.raise_for_status()
+                    png = resp.content
+            except Exception as ex:
+                metricGoogleErrors["staticmap"].inc()
+                print "Failed to download static map: %s" % str(ex)
+                with self.lock:
+                    self.stats["errors"] = self.stats["errors"] + 1
+                    if self.wanted == url:
+                        # not rendered, so the next request for it (the next refresh) tries again
+                        self.wanted = None
+                continue
+
+            etag = "\"%s\"" % hashlib.sha1(png).hexdigest()
+            with self.lock:
+                self.stats["downloads"] = self.stats["downloads"] + 1
+                self.cache[url] = ( etag, png )
+                while len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+                if url == self.wanted:
+                    self.current = ( url, etag, png )
+
+    def getStats(self):
+        with self.lock:
+            res = dict(self.stats)
+            res["cached"] = len(self.cache)
+        return res
+
+staticMapRenderer = None
+
+def getStaticMapRenderer():
+    """ The process wide renderer, started on first use """
+    global staticMapRenderer
+    if staticMapRenderer is None:
+        with singletonLock:
+            if staticMapRenderer is None:
+                renderer = StaticMapRenderer()
+                renderer.start()
+                staticMapRenderer = renderer
+    return staticMapRenderer
+
+class Wakeup(object):
+    """
+    Lets one thread sleep until a deadline or until another thread calls set().  This is a self-pipe and
+    select() rather than threading.Event, since python 2's Event.wait(timeout) polls every 50ms.
+    """
+    __slots__ = "readFd writeFd".split()
+
+    def __init__(self):
+        self.readFd, self.writeFd = os.pipe()
+        for fd in ( self.readFd, self.writeFd ):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def set(self):
+        try:
+            os.write(self.writeFd, "x")
+        except OSError:
+            pass # the pipe is full, a wakeup is already pending
+
+    def close(self):
+        os.close(self.readFd)
+        os.close(self.writeFd)
+
+    def wait(self, timeout=None):
+        """ Returns True if woken by set(), False on timeout """
+        ready = select.select([ self.readFd ], [], [], timeout)[0]
+        if not ready:
+            return False
+        try:
+            while os.read(self.readFd, 4096):
+                pass
+        except OSError:
+            pass
+        return True
+
+class WakeupQueue(Queue.Queue):
+    """ A Queue that sets its wakeup whenever something is put on it, so the consumer can sleep on the Wakeup """
+    def __init__(self, maxsize=0):
+        Queue.Queue.__init__(self, maxsize)
+        self.wakeup = None
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
 def uniqify(seq):
     seen = set()
     seen_add = seen.add
     return [x for x in seq if not (x in seen or seen_add(x))]
 
+# The static parts of /pokemon, built once
+dashboardHead = "\n".join([
+    "<head><style>",
+    "table, th, td {",
+    "   border: 1px solid black;",
+    "}",
+    "input {",
+    "   font-size: 24px",
+    "}",
+    "</style>",
+    "<meta http-equiv=\"refresh\" content=\"30\">",
+    "<script>",
+    "function getLocation() {",
+    "    if (navigator.geolocation) {",
+    "        navigator.geolocation.getCurrentPosition(showPosition);",
+    "    } else {",
+    "        x.innerHTML = \"Geolocation is not supported by this browser.\";",
+    "    }",
+    "}",
+    "function showPosition(position) {",
+    "    var x = document.getElementById('demo');",
+    "    x.innerHTML = \"Latitude: \" + position.coords.latitude + \"<br>Longitude: \" + position.coords.longitude;",
+    "}",
+    "</script>",
+    "</head>",
+    "<div id='demo'>DEMO</div>",
+    "<p><img src=\"/current.png\"></p>"
+])
+activeRowTemplate = SimpleTemplate("<tr{{!bgColor}}><td>{{label}}</td><td><a href='/remove/{{id}}'>Remove</a><td><b>{{name}}</b></td><td>{{timeTo}}</td><td>{{distanceTo}}</td><td>{{remaining}}</td><td>{{!mapLink}}</td><td>{{computed}}</td></tr>")
+nearbyRowTemplate = SimpleTemplate("<tr><td><a href='/remove/{{id}}'>Remove</a><td><b>{{name}}</b></td><td>{{distanceTo}}</td><td>{{remaining}}</td><td>{{!mapLink}}</td></tr>")
+
+def renderMapLink(link):
+    """ The slack link, <url|Open in Google Maps>, as an html anchor """
+    return link.replace("<", "<a href=\"").replace("|Open in Google Maps", "\" target=\"_blank\">Map</a").replace("\n", " ")
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """ A WSGIServer that hands accepted connections to a fixed pool of worker threads """
+    workers = webServerWorkers
+    request_queue_size = 128 # listen backlog, SocketServer's default of 5 has bursts of clients waiting on SYN retries
+
+    def server_activate(self):
+        WSGIServer.server_activate(self)
+        self.pending = Queue.Queue(self.workers * 4)
+        for idx in range(self.workers):
+            worker = threading.Thread(target=self.work, name="web-%d" % idx)
+            worker.setDaemon(True)
+            worker.start()
+
+    def process_request(self, req, clientAddress):
+        # blocks the accept loop once every worker is busy and the queue is full, the backlog absorbs the rest
+        self.pending.put(( req, clientAddress ))
+
+    def work(self):
+        while True:
+            req, clientAddress = self.pending.get()
+            try:
+                self.finish_request(req, clientAddress)
+            except Exception:
+                self.handle_error(req, clientAddress)
+            finally:
+                self.shutdown_request(req)
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kw):
+        pass
+
+class ConcurrentWSGIRefServer(bottle.ServerAdapter):
+    """ bottle's wsgiref server with a pool of worker threads ("threadpool") or a thread per request ("threaded") """
+    def run(self, app):
+        backend = self.options.get("backend", "threadpool")
+        if backend == "threaded":
+            class Server(SocketServer.ThreadingMixIn, WSGIServer):
+                daemon_threads = True
+                request_queue_size = ThreadPoolWSGIServer.request_queue_size
+        else:
+            class Server(ThreadPoolWSGIServer):
+                workers = self.options.get("workers", webServerWorkers)
+
+        handler = QuietRequestHandler if self.quiet else WSGIRequestHandler
+        self.srv = make_server(self.host, self.port, app, Server, handler)
+        self.srv.serve_forever()
+
+def makeWebServer(host, port, backend=None, workers=None):
+    """ A bottle ServerAdapter for the configured backend, keep hold of it to call srv.shutdown() later """
+    backend = webServerBackend if backend is None else backend
+    workers = webServerWorkers if workers is None else workers
+    if backend in ( "threadpool", "threaded" ):
+        return ConcurrentWSGIRefServer(host=host, port=port, backend=backend, workers=workers)
+    if backend not in bottle.server_names:
+        raise Exception("Unknown webServerBackend %s, expected threadpool, threaded or one of %s" % ( backend, sorted(bottle.server_names.keys()) ))
+    return bottle.server_names[backend](host=host, port=port)
+
+class BackgroundJobs(threading.Thread):
+    """
+    Runs slow web actions (slack, iCloud) off the request threads, one at a time.  Submitting a job that
+    is already waiting to run is a no-op, so hammering a button doesn't queue up a pile of repeats.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="web-jobs")
+        self.setDaemon(True)
+        self.pending = Queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.status = collections.OrderedDict() # job name -> ( state, time of the last state change )
+        self.generation = 0 # bumped on every state change, part of the dashboard cache key
+
+    def setStatus(self, name, state):
+        with self.lock:
+            self.status[name] = ( state, time.time() )
+            self.generation = self.generation + 1
+
+    def submit(self, name, func):
+        """ Queues func to run in the background, returns False if name is already waiting """
+        with self.lock:
+            if name in self.queued:
+                return False
+            self.queued.add(name)
+        self.setStatus(name, "queued")
+        self.pending.put(( name, func ))
+        return True
+
+    def run(self):
+        while True:
+            name, func = self.pending.get()
+            with self.lock:
+                self.queued.discard(name)
+            self.setStatus(name, "running")
+            try:
+                func()
+                self.setStatus(name, "done")
+            except Exception as ex:
+                print "Background job %s failed" % name
+                traceback.print_exc()
+                self.setStatus(name, "failed")
+
+    def stats(self):
+        with self.lock:
+            return self.status.items()
+
 class PokemonWebServer(threading.Thread):
     webToManagerQueue = None
     managerToWebQueue = None
     mgr = None
-
-    def __init__(self, manager, webToManagerQueue, managerToWebQueue):
+    pipeline = None
+    jobs = None
+    streamSlots = None # caps /api/stream clients when they would otherwise take every pool worker
+    renderLock = threading.Lock()
+    pageCache = None # ( key, body ) of the last rendered /pokemon, everything below the heading
+    apiCache = {}    # "active" / "nearby" -> ( generation, etag, body )
+    rowCache = {}    # ( template, PokemonView, minutes left ) -> rendered table row
+    rowsInUse = set()
+
+    def __init__(self, manager, webToManagerQueue, managerToWebQueue, pipeline=None, backend=None, workers=None):
         PokemonWebServer.mgr = manager
         PokemonWebServer.webToManagerQueue = webToManagerQueue
         PokemonWebServer.managerToWebQueue = managerToWebQueue
+        PokemonWebServer.pipeline = pipeline
+        PokemonWebServer.jobs = BackgroundJobs()
+        PokemonWebServer.jobs.start()
         threading.Thread.__init__(self)
+        self.backend = webServerBackend if backend is None else backend
+        self.workers = webServerWorkers if workers is None else workers
+        PokemonWebServer.streamSlots = None
+        if self.backend == "threadpool":
+            PokemonWebServer.streamSlots = threading.Semaphore(max(1, self.workers // 2))
+
+        metrics.gauge("watcher_pokemon", "Pokemon on the dashboard", lambda: len(PokemonWebServer.mgr.getSnapshot().active), list="active")
+        metrics.gauge("watcher_pokemon", "Pokemon on the dashboard", lambda: len(PokemonWebServer.mgr.getSnapshot().nearby), list="nearby")
+        metrics.gauge("watcher_tracked_pokemon", "Every pokemon the manager is tracking", lambda: len(PokemonWebServer.mgr.byId))
+        if pipeline is not None:
+            for stage in pipeline.stages:
+                metrics.gauge("watcher_ingest_queue_depth", "Items waiting for each ingest stage", stage.inbox.qsize, stage=stage.stageName)
 
     @route('/')
     def index():
@@ -181,70 +1639,98 @@ class PokemonWebServer(threading.Thread):
 
     @route('/current.png')
     def server_static():
-        return static_file("current.png", root='.')
+        current = getStaticMapRenderer().getCurrent()
+        if current is None:
+            return HTTPResponse(status=404, body="No map yet")
+        etag, png = current
+        # the browser keeps its copy and revalidates, a map that hasn't changed is a 304
+        headers = { "ETag" : etag, "Cache-Control" : "no-cache" }
+        if request.headers.get("If-None-Match") == etag:
+            return HTTPResponse(status=304, headers=headers)
+        headers["Content-Type"] = "image/png"
+        return HTTPResponse(body=png, headers=headers)
 
     # 1. Expose a way to send all hits to slackbot
     @route('/pokemon')
     def pokemon():
-        # 1. send request
-        # 2. block on response
-        dt = datetime.datetime.now()
-        ts = dt.strftime("%I:%M:%S%p")
+        etag, html = PokemonWebServer.renderDashboard()
+        if request.headers.get("If-None-Match") == etag:
+            return HTTPResponse(status=304, headers={ "ETag" : etag })
+        response.set_header("ETag", etag)
+        response.set_header("Cache-Control", "no-cache") # always revalidate, the ETag makes that cheap
+        return html
+
+    @staticmethod
+    def getDashboardKey(snap):
+        """ Everything the page depends on that is not in the snapshot """
+        jobsGeneration = PokemonWebServer.jobs.generation if PokemonWebServer.jobs is not None else 0
+        return ( snap.generation, Current.enableGoogleAndICloud, Current.enableTextMessages, Current.getIphoneCoordStr(), jobsGeneration, getRules().version )
+
+    @staticmethod
+    def renderDashboard():
+        """ Returns ( etag, html ), the tables are only re-rendered when the snapshot (or a toggle) has changed """
+        mgr = PokemonWebServer.mgr
+        snap = mgr.getSnapshot()
+        key = PokemonWebServer.getDashboardKey(snap)
+        with PokemonWebServer.renderLock:
+            cached = PokemonWebServer.pageCache
+            if cached is not None and cached[0] == key:
+                body = cached[1]
+            else:
+                body = PokemonWebServer.buildDashboard(snap)
+                PokemonWebServer.pageCache = ( key, body )
+
+        # the next refresh moves on every tick, even one that changed nothing in the snapshot
+        snapTime = datetime.datetime.fromtimestamp(snap.created).strftime("%I:%M:%S%p")
+        nextUpdate = datetime.datetime.fromtimestamp(mgr.lastUpdated + managerRefreshTime).strftime("%I:%M:%S%p")
+        html = "\n".join([ dashboardHead, "<h2>Active pokemon %s, next update at %s</h2>" % ( snapTime, nextUpdate ), body ])
+        etag = "\"%s\"" % hashlib.sha1(html.encode("utf-8") if isinstance(html, unicode) else html).hexdigest()
+        return etag, html
+
+    @staticmethod
+    def renderRow(tpl, mon, **values):
+        """ Rows are cached per PokemonView, so an unchanged pokemon is not rendered again """
+        remaining = int(mon.getTimeLeftToDespawn() / 60)
+        key = ( tpl, mon, remaining )
+        rowCache = PokemonWebServer.rowCache
+        row = rowCache.get(key)
+        if row is None:
+            row = tpl.render(remaining=remaining, **values)
+            rowCache[key] = row
+        PokemonWebServer.rowsInUse.add(key)
+        return row
+
+    @staticmethod
+    def buildDashboard(snap):
+        """ Everything below the heading """
         html = [
-            "<head><style>",
-            "table, th, td {",
-            "   border: 1px solid black;",
-            "}",
-            "input {",
-            "   font-size: 24px",
-            "}",
-            "</style>",
-            "<meta http-equiv=\"refresh\" content=\"30\">",
-            "<script>",
-            "function getLocation() {",
-            "    if (navigator.geolocation) {",
-            "        navigator.geolocation.getCurrentPosition(showPosition);",
-            "    } else {",
-            "        x.innerHTML = \"Geolocation is not supported by this browser.\";",
-            "    }",
-            "}",
-            "function showPosition(position) {",
-            "    var x = document.getElementById('demo');",
-            "    x.innerHTML = \"Latitude: \" + position.coords.latitude + \"<br>Longitude: \" + position.coords.longitude;",
-            "}",
-            "</script>",
-            "</head>",
-            "<div id='demo'>DEMO</div>",
-            "<p><img src=\"/current.png\"></p>",
-            "<h2>Active pokemon %s, update in %d</h2>" % ( str(ts), PokemonWebServer.mgr.getSecondsUntilNextUpdate() ),
             "<br/>",
             "<table>",
             "<tr><th>Map Label</th><th>Remove 'Mon</th><th>Name</th><th>Time To</th><th>Distance To</th><th>Time to Despawn</th><th>Map to 'Mon</th><th>Computed</th></tr>"
         ]
-        active = PokemonWebServer.mgr.buildSortedActive()
+        PokemonWebServer.rowsInUse = set()
         totalPct   = 0
         totalCount = 0
-        for mon in active:
-            totalCount = totalCount + 1
-            removeLink = "<a href='/remove/%s'>Remove</a>" % mon.getId()
-            mapLink = mon.getLink().replace("<", "<a href=\"").replace("|Open in Google Maps", "\" target=\"_blank\">Map</a").replace("\n", " ")
+        for mon in snap.active:
+            mapLink = renderMapLink(mon.getLink())
             bgColor = ""
+            pctValue = mon.iv
 
-            try:
-                mtch = re.match("^.*\(([0-9][0-9]\.?[0-9]?)%\)", mapLink)
-                pctValue = float(mtch.group(1))
+            # Only count the pokemon we have an IV for, or the average is dragged down
+            if pctValue is not None:
+                totalCount = totalCount + 1
                 totalPct = totalPct + pctValue
 
-                if mon.getCritical():
-                    bgColor = " bgcolor=\"yellow\""
-                elif pctValue > 95:
-                    bgColor = " bgcolor=\"lime\""
-                elif pctValue > 90:
-                    bgColor = " bgcolor=\"aqua\""
-                elif pctValue > 80:
-                    bgColor = " bgcolor=\"silver\""
-            except Exception as ex:
-                traceback.print_exc()
+            if mon.getCritical():
+                bgColor = " bgcolor=\"yellow\""
+            elif pctValue is None:
+                pass
+            elif pctValue > 95:
+                bgColor = " bgcolor=\"lime\""
+            elif pctValue > 90:
+                bgColor = " bgcolor=\"aqua\""
+            elif pctValue > 80:
+                bgColor = " bgcolor=\"silver\""
 
             computedBy = ""
             if mon.haversineOnly:
@@ -252,7 +1738,7 @@ class PokemonWebServer(threading.Thread):
             else:
                 computedBy = "google"
 
-            html.append(template("<tr%s><td>{{label}}</td><td>%s<td><b>{{name}}</b</td><td>{{timeTo}}</td><td>{{distanceTo}}</td><td>{{remaining}}</td><td>%s</td><td>{{computed}}</td></tr>" % ( bgColor, removeLink, mapLink ), label=mon.getLabel(), name=mon.getName(), timeTo=mon.getTimeToTarget(), distanceTo=mon.getDistanceToTarget(), remaining=int(mon.getTimeLeftToDespawn() / 60), computed=computedBy))
+            html.append(PokemonWebServer.renderRow(activeRowTemplate, mon, bgColor=bgColor, id=mon.getId(), mapLink=mapLink, label=mon.getLabel(), name=mon.getName(), timeTo=mon.getTimeToTarget(), distanceTo=mon.getDistanceToTarget(), computed=computedBy))
         html.append("</table>")
 
         if totalCount > 0:
@@ -262,31 +1748,53 @@ class PokemonWebServer(threading.Thread):
         html.append("<h2>Nearby Pokemon</h2>")
         html.append("<table style='border:1px solid black'>")
         html.append("<tr><th>Remove 'Mon</th><th>Name</th><th>Distance To</th><th>Time to Despawn</th><th>Map to 'Mon</th></tr>")
-        nearby = PokemonWebServer.mgr.buildSortedNearby()
-        for mon in nearby:
+        for mon in snap.nearby:
             try:
-                if Current.debug:
-                    print "Nearby: %s, %s" % ( str(mon), str(type(mon)) )
-
-                removeLink = "<a href='/remove/%s'>Remove</a>" % mon.getId()
-                mapLink = mon.getLink().replace("<", "<a href=\"").replace("|Open in Google Maps", "\" target=\"_blank\">Map</a")
-                html.append(template("<tr><td>%s<td><b>{{name}}</b></td><td>{{distanceTo}}</td><td>{{remaining}}</td><td>%s</td></tr>" % ( removeLink, mapLink ), remove=removeLink, name=mon.getName(), distanceTo="{0:.3f}".format(mon.getDistanceToTarget()), remaining=int(mon.getTimeLeftToDespawn() / 60)))
+                html.append(PokemonWebServer.renderRow(nearbyRowTemplate, mon, id=mon.getId(), mapLink=renderMapLink(mon.getLink()), name=mon.getName(), distanceTo="{0:.3f}".format(mon.getDistanceToTarget())))
             except Exception as ex:
                 print "Error processing nearby pokemon! mon=%s" % str(mon)
                 traceback.print_exc()
 
         html.append("</table>")
 
+        # Rows for pokemon that have changed or gone away are dropped
+        for key in PokemonWebServer.rowCache.keys():
+            if key not in PokemonWebServer.rowsInUse:
+                del PokemonWebServer.rowCache[key]
+
         html.append("<br/><br/>")
         html.append("<p><input type='button' onclick=\"location.href='/slack?tm=' + (new Date).getTime();\" value='Send to Slack' /></p>")
         html.append("<p><input type='button' onclick=\"location.href='/toggleLocation?tm' + (new Date).getTime();\" value='Toggle Google/iCloud, current=%s' />&nbsp;&nbsp;Current Coordinates: %s</p>" % ( str(Current.enableGoogleAndICloud), Current.getIphoneCoordStr() ) )
-        html.append("<p>Always text (at any time!) %s" % str(alwaysTextList))
-        html.append("<p>Always Text if Perfect: %s</p>" % str(alwaysTextIfPerfectList))
-        html.append("<p>Text if perfect only: %s</p>" % str(perfectTextList))
-        html.append("<p>Critical: %s</p>" % str(criticalList))
-        html.append("<p>No text list: %s</p>" % str(noTextList))
-        html.append("<p>Notify list: %s</p>" % str(notifyList))
-        html.append("<p>Texting Hours: %d to %d</p>" % ( textEarly, textLate ))
+        rules = getRules()
+        html.append("<p>Always text (at any time!) %s" % str(sorted(rules.lists["alwaysText"])))
+        html.append("<p>Always Text if Perfect: %s</p>" % str(sorted(rules.lists["alwaysTextIfPerfect"])))
+        html.append("<p>Text if perfect only: %s</p>" % str(sorted(rules.lists["perfectText"])))
+        html.append("<p>Critical: %s</p>" % str(sorted(rules.lists["critical"])))
+        html.append("<p>No text list: %s</p>" % str(sorted(rules.lists["noText"])))
+        html.append("<p>Notify list: %s</p>" % str(rules.getNotifyList()))
+        html.append("<p>Texting Hours: %d to %d</p>" % ( rules.textEarly, rules.textLate ))
+        html.append("<p>Rules version %d from %s</p>" % ( rules.version, rules.source or "watcher.py" ))
+        cacheStats = getDistanceMatrixClient().cache.stats()
+        html.append("<p>Distance cache: %d hits, %d misses, %d entries, ~%.1fs of google lookups saved</p>" % ( cacheStats["hits"], cacheStats["misses"], cacheStats["size"], cacheStats["secondsSaved"] ))
+        if notificationDispatcher is not None:
+            texts = notificationDispatcher.getStats()
+            html.append("<p>Texts: %d sent for %d alerts, %d duplicates skipped, %d queued, %d failed sends, %d smtp connections</p>" % ( texts["texts"], texts["alertsSent"], texts["duplicates"], texts["queued"], texts["failures"], texts["connections"] ))
+        sched = PokemonWebServer.mgr.schedulerStats
+        loc = PokemonWebServer.mgr.location.stats()
+        html.append("<p>Location: %d polls, %d errors, %s, next poll at %s</p>" % ( loc["polls"], loc["errors"], "stationary" if loc["stationary"] else ( "%.1f mph" % loc["mph"] if loc["mph"] is not None else "speed unknown" ), datetime.datetime.fromtimestamp(loc["nextPoll"]).strftime("%I:%M:%S%p") ))
+        html.append("<p>Manager: %d ticks, last %.3fs, max %.3fs, %d wakeups, %.1fs idle (%.2fs cpu while idle)</p>" % ( sched["ticks"], sched["lastTickSeconds"], sched["maxTickSeconds"], sched["wakeups"], sched["idleSeconds"], sched["idleCpuSeconds"] ))
+        maps = getStaticMapRenderer().getStats()
+        html.append("<p>Static map: %d requests, %d unchanged, %d from cache, %d downloads, %d skipped, %d errors</p>" % ( maps["requests"], maps["unchanged"], maps["cacheHits"], maps["downloads"], maps["skipped"], maps["errors"] ))
+        html.append("<p>Lookups: %d unreachable spawns dropped before asking google, %d lookups deferred to a later refresh</p>" % ( sched["unreachable"], getDistanceMatrixClient().deferredCount ))
+        subs = getSubscribers().stats()
+        if subs["subscribers"]:
+            html.append("<p>Subscribers: %d (%d located), %d spawns checked against %d nearby subscribers, %d texts</p>" % ( subs["subscribers"], subs["located"], subs["spawns"], subs["candidates"], subs["alerts"] ))
+        if PokemonWebServer.pipeline is not None:
+            for name, stats in PokemonWebServer.pipeline.stats():
+                html.append("<p>Ingest %s: %d processed, %d queued, %.2fs blocked</p>" % ( name, stats["processed"], stats["depth"], stats["blockedSeconds"] ))
+        if PokemonWebServer.jobs is not None:
+            for name, ( state, changed ) in PokemonWebServer.jobs.stats():
+                html.append("<p>Job %s: %s at %s</p>" % ( name, state, datetime.datetime.fromtimestamp(changed).strftime("%I:%M:%S%p") ))
         html.append("<br/>")
         html.append("<p><input type='button' onClick='getLocation();' value='Show Position'></p>")
         html.append("<br/>")
@@ -297,24 +1805,18 @@ class PokemonWebServer(threading.Thread):
     # 2. Expose a way to send to slackbot
     @route('/slack')
     def sendToSlack():
-        PokemonWebServer.mgr.reportAndSendToSlack()
+        # posting to slack can take seconds, don't hold the request (or a server thread) for it
+        PokemonWebServer.jobs.submit("slack", PokemonWebServer.mgr.reportAndSendToSlack)
         redirect('/pokemon?tm=' + str(time.time()))
 
     # 3. Expose a way to remove a Pokemon from the active list
     @route('/remove/:idVal')
     def remove(idVal):
         print "Looking to remove idVal = %s" % idVal
-        active = manager.getActive()
-        for idx, val in enumerate(active):
-            print "(Active) Checking: %d - %s" % ( idx, val )
-            if val.getId() == idVal:
-                del active[idx]
-
-        nearby = manager.getNearby()
-        for idx, val in enumerate(nearby):
-            print "(Nearby) Checking: %d - %s" % ( idx, val )
-            if val.getId() == idVal:
-                del nearby[idx]
+        done = threading.Event()
+        PokemonWebServer.webToManagerQueue.put(( "remove", idVal, done ))
+        # the manager does the removal, give it a moment so the page we redirect to reflects it
+        done.wait(1.0)
         redirect('/pokemon?tm=' + str(time.time()))
 
     # 4. Expose a way to toggle google location on and off services
@@ -323,33 +1825,190 @@ class PokemonWebServer(threading.Thread):
         Current.enableGoogleAndICloud = not Current.enableGoogleAndICloud
         print "Toggled enableGoogleAndICloud, new value=%s" % str(Current.enableGoogleAndICloud)
         if Current.enableGoogleAndICloud:
-            manager.connectIcloud()
+            PokemonWebServer.jobs.submit("icloud", PokemonWebServer.reconnectIcloud)
         redirect('/pokemon?tm=' + str(time.time()))
 
+    @staticmethod
+    def reconnectIcloud():
+        # it may have been toggled back off while this job was queued
+        if Current.enableGoogleAndICloud:
+            PokemonWebServer.mgr.connectIcloud()
+
+    # 5. Expose a way for a browser (or anything else) to tell the manager where the phone is, or with
+    # ?user=name where a subscriber is
+    @staticmethod
+    def queryNumber(name, convert, low, high, default=None):
+        """ A numeric query parameter between low and high (inclusive), default if it is missing, a 400 if it is anything else """
+        value = request.query.get(name)
+        if not value:
+            return default
+        try:
+            number = convert(value)
+        except ValueError:
+            number = None
+        if number is None or not low <= number <= high: # NaN fails the comparison too
+            raise HTTPResponse("%s must be a number from %s to %s" % ( name, low, high ), status=400)
+        return number
+
+    @route('/location')
+    def location():
+        lat = PokemonWebServer.queryNumber("lat", float, -90, 90)
+        lon = PokemonWebServer.queryNumber("long", float, -180, 180)
+        if lat is None or lon is None:
+            raise HTTPResponse("lat and long are required", status=400)
+        coord = [ lat, lon ]
+        if request.query.user:
+            if not getSubscribers().move(request.query.user, coord):
+                raise HTTPResponse("No such subscriber", status=404)
+            return "ok"
+        PokemonWebServer.webToManagerQueue.put(( "location", coord ))
+        return "ok"
+
+    # 6. JSON versions of the two tables, for anything that isn't a browser
+    @route('/api/active')
+    def apiActive():
+        return PokemonWebServer.apiSnapshot("active")
+
+    @route('/api/nearby')
+    def apiNearby():
+        return PokemonWebServer.apiSnapshot("nearby")
+
+    @staticmethod
+    def apiSnapshot(name):
+        snap = PokemonWebServer.mgr.getSnapshot()
+        cached = PokemonWebServer.apiCache.get(name)
+        if cached is None or cached[0] != snap.generation:
+            body = json.dumps(snapshotToDict(snap, ( name, )))
+            cached = ( snap.generation, "\"%s\"" % hashlib.sha1(body).hexdigest(), body )
+            PokemonWebServer.apiCache[name] = cached
+        generation, etag, body = cached
+        if request.headers.get("If-None-Match") == etag:
+            return HTTPResponse(status=304, headers={ "ETag" : etag })
+        response.content_type = "application/json"
+        response.set_header("ETag", etag)
+        return body
+
+    # 7. Server-sent events: a full "snapshot" event, then a "delta" event for every change after it
+    @route('/api/stream')
+    def apiStream():
+        response.content_type = "text/event-stream"
+        response.set_header("Cache-Control", "no-cache")
+        return PokemonWebServer.streamDeltas(PokemonWebServer.mgr)
+
+    @staticmethod
+    def sseEvent(event, generation, data):
+        return "event: %s\nid: %d\ndata: %s\n\n" % ( event, generation, json.dumps(data) )
+
+    @staticmethod
+    def streamDeltas(mgr):
+        # a stream holds its server thread for as long as it is open, leave the pool room for everything else
+        slots = PokemonWebServer.streamSlots
+        if slots is not None and not slots.acquire(False):
+            raise HTTPResponse(status=503, body="Too many streams open, try again later", headers={ "Retry-After" : "5" })
+        sub = mgr.deltas.subscribe() # subscribe before reading the snapshot, so nothing falls in between
+        try:
+            yield "retry: 5000\n\n"
+            snap = mgr.getSnapshot()
+            generation = snap.generation
+            yield PokemonWebServer.sseEvent("snapshot", generation, snapshotToDict(snap))
+            while True:
+                delta = sub.next(sseKeepAlive)
+                if delta is None:
+                    yield ": keepalive\n\n"
+                elif delta is DeltaSubscription.RESYNC:
+                    snap = mgr.getSnapshot()
+                    generation = snap.generation
+                    yield PokemonWebServer.sseEvent("snapshot", generation, snapshotToDict(snap))
+                elif delta["generation"] > generation:
+                    generation = delta["generation"]
+                    yield PokemonWebServer.sseEvent("delta", generation, delta)
+        finally:
+            mgr.deltas.unsubscribe(sub)
+            if slots is not None:
+                slots.release()
+
+    # 8. Spawn history, e.g. /api/analytics?species=dragonite&from=18&to=21
+    @route('/api/analytics')
+    def apiAnalytics():
+        species = request.query.species or None
+        fromHour = PokemonWebServer.queryNumber("from", int, 0, 23)
+        toHour = PokemonWebServer.queryNumber("to", int, 0, 24)
+        limit = PokemonWebServer.queryNumber("limit", int, 1, 1000, 10)
+        if ( fromHour is None ) != ( toHour is None ):
+            raise HTTPResponse("from and to go together", status=400)
+        if not os.path.exists(dbname):
+            # connecting would create an empty database where the ingest pipeline expects its own
+            raise HTTPResponse("No spawn history yet", status=503)
+        conn = sqlite3.connect(dbname) # sqlite connections can't be shared between the request threads
+        try:
+            conn.execute("pragma query_only = 1")
+            analytics = SpawnAnalytics(conn)
+            res = {
+                "topCells"   : [ { "lat" : lat, "long" : lon, "count" : count } for lat, lon, count in analytics.topCells(species, fromHour, toHour, limit) ],
+                "ivBuckets"  : analytics.ivDistribution(species)
+            }
+            if species is not None:
+                res["hourly"] = analytics.hourlyFrequency(species)
+            else:
+                res["topSpecies"] = analytics.topSpecies(fromHour, toHour, limit)
+        except sqlite3.OperationalError as ex:
+            # not migrated yet, or locked by a long write
+            raise HTTPResponse("Spawn history unavailable: %s" % str(ex), status=503)
+        finally:
+            conn.close()
+        response.content_type = "application/json"
+        return json.dumps(res)
+
     def run(self):
-        bottle.run(host="0.0.0.0", port=webserverPort)
+        # one slow client (or an open /api/stream) must not hold up everyone else, see webServerBackend
+        bottle.run(server=makeWebServer("0.0.0.0", webserverPort, self.backend, self.workers))
+
+    # 9. Counters and timers for prometheus (or curl)
+    @route('/metrics')
+    def getMetrics():
+        response.content_type = "text/plain; version=0.0.4"
+        return metrics.render()
 
     #@route('/sendText'):
 
     @route('/toggleText')
     def toggleText():
+        if request.query.user:
+            subscriber = getSubscribers().get(request.query.user)
+            if subscriber is None:
+                raise HTTPResponse("No such subscriber", status=404)
+            subscriber.enableTexts = not subscriber.enableTexts
+            print "Toggled texts for %s, new value=%s" % ( subscriber.name, str(subscriber.enableTexts) )
+            return "ok"
         Current.enableTextMessages = not Current.enableTextMessages
         print "Toggled enableTextMessages, new value=%s" % str(Current.enableTextMessages)
         redirect('/pokemon?tm=' + str(time.time()))
 
 class Pokemon(object):
-    __slots__ = "id timeReceived name link coords text coordStr lastCoordCheck distanceToTarget timeToTarget lastUpdated critical perfect notify noText label haversineOnly".split()
-    def __init__(self, timeReceived, name, coords, text, link):
+    __slots__ = "id timeReceived name link coords text coordStr iv mapUrl lastCoordCheck crowDistance movedDistance distanceToTarget timeToTarget lastUpdated critical perfect notify noText label haversineOnly".split()
+    def __init__(self, timeReceived, name, coords, text, link, attachment=None):
+        """ link is the slack attachment text, attachment is its ParsedAttachment if the caller already has it """
         self.id = str(uuid.uuid4())
         self.timeReceived = timeReceived
         self.name = name.lower()
         self.coords = coords
         self.text = text
         self.link = link
-        self.coordStr = "%f,%f" % ( coords[0], coords[1] )
+        if attachment is None:
+            attachment = parseAttachment(link, strict=False)
+        if attachment is not None:
+            self.coordStr = attachment.coordStr
+            self.iv = attachment.iv
+            self.mapUrl = attachment.mapUrl
+        else:
+            self.coordStr = "%f,%f" % ( coords[0], coords[1] )
+            self.iv = None
+            self.mapUrl = None
         self.timeToTarget = None
         self.distanceToTarget = None
         self.lastCoordCheck = None
+        self.crowDistance = None  # haversine distance to the phone, filled in by DistanceBatch
+        self.movedDistance = None # phone distance from lastCoordCheck, filled in by DistanceBatch
         self.lastUpdated = time.time()
         self.haversineOnly = False
         self.label = ""
@@ -357,23 +2016,14 @@ class Pokemon(object):
         self.computeStatus()
 
     def computeStatus(self):
-        self.perfect = False
-        self.critical = False
-        self.noText = False
-        self.notify = False
-
-        if "100%" in self.getLink() or re.match("^.*\(9[0-9].[0-9]%.*$", self.getLink()):
-            print "%s - critical? %s" % ( self.getName(), self.getLink() )
-            self.setPerfect(True)
-
-        if self.name in criticalList:
-            self.setCritical(True)
-
-        if self.name in noTextList:
-            self.setNoText(True)
-
-        if self.name in notifyList:
-            self.setNotify(True)
+        rules = getRules()
+        rule = rules.lookup(self.name)
+        self.perfect = rules.isPerfect(self.iv)
+        self.critical = rule.critical
+        self.noText = rule.noText
+        self.notify = rule.notify
+        if self.perfect and Current.debug:
+            print "%s - perfect, iv=%s" % ( self.getName(), str(self.iv) )
 
     def setName(self, name):
         self.name = name.lower()
@@ -429,12 +2079,43 @@ class Pokemon(object):
     def setLabel(self, label):
         self.label = label
 
+    def getDespawnTime(self):
+        return self.timeReceived + despawnSeconds
+
     def getTimeLeftToDespawn(self):
-        return ( self.timeReceived + 900 ) - time.time()
+        return self.getDespawnTime() - time.time()
+
+    def getExpiryTime(self):
+        """ When isStillValid will turn false, assuming timeToTarget does not change """
+        despawn = self.getDespawnTime()
+        if self.timeToTarget is None:
+            return despawn
+        return min(despawn, despawn - self.timeToTarget * 60)
 
     def getCoords(self):
         return self.coords
 
+    def getSpawnKey(self):
+        """ Two reports with the same key are the same spawn """
+        return ( self.name, round(self.coords[0], 5), round(self.coords[1], 5) )
+
+    def getMinimumTimeToTarget(self):
+        """ Minutes to get there at reachSpeed as the crow flies, a lower bound on timeToTarget.  None without a distance """
+        if self.crowDistance is None:
+            return None
+        return self.crowDistance / reachSpeed * 60
+
+    def isReachable(self, now=None):
+        """ False only if we couldn't get there before it despawns even at reachSpeed, this needs no google lookup """
+        minimum = self.getMinimumTimeToTarget()
+        if minimum is None:
+            return True
+        return minimum * 60 <= self.getDespawnTime() - ( time.time() if now is None else now )
+
+    def getLookupPriority(self, now):
+        """ Sort key for remote lookups, critical and perfect first, then whatever despawns soonest """
+        return ( not ( self.critical or self.perfect ), self.getDespawnTime() - now )
+
     def isStillValid(self):
         secondsLeft = self.getTimeLeftToDespawn()
         if secondsLeft <= 0:
@@ -460,7 +2141,10 @@ class Pokemon(object):
                 print "(ShouldUpdateDistance) Current phone coord is none, returning!"
             return
 
-        distance = haversine(Current.phoneCoord[0], self.lastCoordCheck[0], Current.phoneCoord[1], self.lastCoordCheck[1])
+        if self.movedDistance is not None:
+            distance = self.movedDistance
+        else:
+            distance = haversine(Current.phoneCoord[0], self.lastCoordCheck[0], Current.phoneCoord[1], self.lastCoordCheck[1])
         if Current.debug:
             print "(%s) phone distance from last check.  distance=%f" % ( self.name, distance )
         # 2. If distance is greater than a mile (or if the only computation we have done is haversine based), re-compute distance
@@ -474,14 +2158,20 @@ class Pokemon(object):
             if Current.debug:
                 print "(updateHaversine) phoneCoord is none"
             return
-        self.distanceToTarget = haversine(Current.phoneCoord[0], self.coords[0], Current.phoneCoord[1], self.coords[1])
+        return self.setHaversineDistance(haversine(Current.phoneCoord[0], self.coords[0], Current.phoneCoord[1], self.coords[1]))
+
+    def setHaversineDistance(self, distance):
+        self.distanceToTarget = distance
         self.haversineOnly = True
         self.label = ""
         return self.distanceToTarget
 
     def updateDistanceBetweenPoints(self):
         if not Current.enableGoogleAndICloud:
-            self.updateDistanceUsingHaversine()
+            if self.crowDistance is not None:
+                self.setHaversineDistance(self.crowDistance)
+            else:
+                self.updateDistanceUsingHaversine()
             self.timeToTarget = self.distanceToTarget * 3
             return
 
@@ -489,25 +2179,18 @@ class Pokemon(object):
             if Current.debug:
                 print "phoneCoord is none, returning!"
             return
-        originStr = Current.getIphoneCoordStr()
-
-        url = "https://maps.googleapis.com/maps/api/distancematrix/json?origins=%s&destinations=%s&mode=driving&units=imperial&key=%s" % ( originStr, self.coordStr, apiKey )
-        try:
-            jsonRes = urllib.urlopen(url).read()
-            self.handleDistanceResult(jsonRes)
-            self.lastCoordCheck = list(Current.phoneCoord)
-            self.haversineOnly = False
-        except Exception as ex:
-            traceback.print_exc()
-            print "Error processing JSON from google distance API! %s" % str(ex)
+        getDistanceMatrixClient().resolve(Current.phoneCoord, [ self ])
 
     def getFormattedCoordStr(self):
         return "%s,%s" % ( "{0:.6f}".format(self.coords[0]), "{0:.6f}".format(self.coords[1]) )
 
-    def handleDistanceResult(self, jsonData):
-        jsonRes = json.loads(jsonData)
-        self.distanceToTarget = float(jsonRes["rows"][0]["elements"][0]["distance"]["text"].strip(string.ascii_letters).strip(" "))
-        self.timeToTarget     = float(jsonRes["rows"][0]["elements"][0]["duration"]["text"].strip(string.ascii_letters).strip(" "))
+    def handleDistanceResult(self, jsonData, column=0):
+        jsonRes = json.loads(jsonData) if isinstance(jsonData, basestring) else jsonData
+        element = jsonRes["rows"][0]["elements"][column]
+        distanceToTarget = float(element["distance"]["text"].strip(string.ascii_letters).strip(" "))
+        timeToTarget     = float(element["duration"]["text"].strip(string.ascii_letters).strip(" "))
+        self.distanceToTarget = distanceToTarget
+        self.timeToTarget     = timeToTarget
 
         if Current.debug:
             print "%s : distance=%s timeToTarget=%s" % ( self.name, self.distanceToTarget, self.timeToTarget )
@@ -518,22 +2201,384 @@ class Pokemon(object):
     def getTimeToTarget(self):
         return self.timeToTarget
 
+    def snapshot(self):
+        return PokemonView(self.id, self.name, self.text, self.link, tuple(self.coords), self.iv, self.mapUrl, self.label, self.timeToTarget, self.distanceToTarget, self.getDespawnTime(), self.critical, self.perfect, self.haversineOnly)
+
     def __str__(self):
         return "(%s) coordStr=%s, d=%s, t=%s, id=%s" % ( str(self.name), str(self.coordStr), str(self.distanceToTarget), str(self.timeToTarget), self.getId() )
 
+class PokemonView(collections.namedtuple("PokemonView", "id name text link coords iv mapUrl label timeToTarget distanceToTarget despawnTime critical perfect haversineOnly")):
+    """ An immutable copy of a Pokemon, what the web server and reports see, with the same getters """
+    __slots__ = ()
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getText(self):
+        return self.text
+
+    def getLink(self):
+        return self.link
+
+    def getCoords(self):
+        return self.coords
+
+    def getLabel(self):
+        return self.label
+
+    def getTimeToTarget(self):
+        return self.timeToTarget
+
+    def getDistanceToTarget(self):
+        return self.distanceToTarget
+
+    def getTimeLeftToDespawn(self):
+        return self.despawnTime - time.time()
+
+    def getCritical(self):
+        return self.critical
+
+    def getPerfect(self):
+        return self.perfect
+
+    def generateDistanceMessage(self):
+        return "`%s` time=%s(min) distance=%s(mi)\n%s" % ( self.text, self.timeToTarget, self.distanceToTarget, self.link  )
+
+    def toDict(self):
+        return {
+            "id"               : self.id,
+            "name"             : self.name,
+            "link"             : self.link,
+            "coords"           : list(self.coords),
+            "iv"               : self.iv,
+            "mapUrl"           : self.mapUrl,
+            "label"            : self.label,
+            "timeToTarget"     : self.timeToTarget,
+            "distanceToTarget" : self.distanceToTarget,
+            "despawnTime"      : self.despawnTime,
+            "critical"         : self.critical,
+            "perfect"          : self.perfect,
+            "computed"         : "haversine" if self.haversineOnly else "google"
+        }
+
+    def __str__(self):
+        return "(%s) d=%s, t=%s, id=%s" % ( str(self.name), str(self.distanceToTarget), str(self.timeToTarget), self.id )
+
+# What the Manager publishes after every change, active and nearby are pre-sorted tuples of PokemonView
+ManagerSnapshot = collections.namedtuple("ManagerSnapshot", "generation created lastUpdated active nearby")
+
+def snapshotToDict(snap, lists=( "active", "nearby" )):
+    res = { "generation" : snap.generation, "created" : snap.created, "lastUpdated" : snap.lastUpdated }
+    for name in lists:
+        res[name] = [ view.toDict() for view in getattr(snap, name) ]
+    return res
+
+def snapshotDelta(old, new):
+    """ What changed between two snapshots, or None if nothing did """
+    before = {}
+    for name in ( "active", "nearby" ):
+        for view in getattr(old, name):
+            before[view.id] = view
+
+    added = []
+    updated = []
+    seen = set()
+    for name in ( "active", "nearby" ):
+        for view in getattr(new, name):
+            seen.add(view.id)
+            previous = before.get(view.id)
+            if previous is None:
+                entry = view.toDict()
+                entry["list"] = name
+                added.append(entry)
+            elif previous != view:
+                updated.append({ "id" : view.id, "list" : name, "label" : view.label, "distanceToTarget" : view.distanceToTarget, "timeToTarget" : view.timeToTarget })
+    expired = [ idVal for idVal in before if idVal not in seen ]
+
+    if not added and not updated and not expired:
+        return None
+    return { "generation" : new.generation, "created" : new.created, "added" : added, "updated" : updated, "expired" : expired }
+
+class DeltaSubscription(object):
+    """ One stream client's pending deltas, RESYNC is queued instead once it falls sseBacklog behind """
+    RESYNC = "resync"
+    __slots__ = "pending wakeup".split()
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.wakeup = Wakeup()
+
+    def push(self, delta):
+        if len(self.pending) >= sseBacklog:
+            self.pending.clear()
+            delta = DeltaSubscription.RESYNC
+        self.pending.append(delta)
+        self.wakeup.set()
+
+    def next(self, timeout):
+        """ The next delta (or RESYNC), None if nothing arrived within timeout """
+        if not self.pending:
+            self.wakeup.wait(timeout)
+        try:
+            return self.pending.popleft()
+        except IndexError:
+            return None
+
+class DeltaBroadcaster(object):
+    """ Fans manager snapshot deltas out to every connected stream """
+    __slots__ = "lock subscribers".split()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self):
+        sub = DeltaSubscription()
+        with self.lock:
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+        sub.wakeup.close()
+
+    def publish(self, delta):
+        with self.lock:
+            for sub in self.subscribers:
+                sub.push(delta)
+
+class LocationProvider(object):
+    """ Somewhere to get the phone's location from, getLocation() returns [ lat, long ] or raises """
+    def connect(self):
+        pass
+
+    def reset(self):
+        """ Called after a failed fix, drop any session so the next attempt starts fresh """
+        pass
+
+    def getLocation(self):
+        raise NotImplementedError()
+
+    def playSound(self):
+        pass
+
+class ICloudLocationProvider(LocationProvider):
+    """ Find My iPhone, the session is (re)authenticated on demand """
+    def __init__(self, user=None, password=None, device=None):
+        self.user = user if user is not None else icloudUser
+        self.password = password if password is not None else icloudPassword
+        self.device = device if device is not None else icloudDevice
+        self.service = None
+
+    def connect(self):
+        """ Connects to iCloud, or throws an exception """
+        print "Connecting to iCloud"
+        service = PyiCloudService(self.user, self.password)
+        if self.device not in service.devices.keys():
+            raise Exception("Could not find device in iCloud! %s" % str(service.devices.keys()) )
+        print "iCloud is connected"
+        self.service = service
+
+    def reset(self):
+        self.service = None
+
+    def getLocation(self):
+        if self.service is None:
+            self.connect()
+        res = self.service.devices[self.device].location()
+        if res is None:
+            raise Exception("iCloud has no location for %s" % self.device)
+        return [ res["latitude"], res["longitude"] ]
+
+    def playSound(self):
+        if self.service is None:
+            self.connect()
+        self.service.devices[self.device].play_sound()
+
+class TraceLocationProvider(LocationProvider):
+    """
+    Replays a recorded (or made up) GPS trace: a list of ( seconds, lat, long ), where seconds counts from
+    the first getLocation().  A row with lat None is a failed fix.  clock can be swapped for simulated time.
+    """
+    def __init__(self, fixes, speedup=1.0, clock=time.time):
+        self.fixes = sorted(fixes)
+        self.times = [ fix[0] for fix in self.fixes ]
+        self.speedup = speedup
+        self.clock = clock
+        self.started = None
+
+    @staticmethod
+    def load(path, **kw):
+        """ One fix per line, seconds,lat,long.  Blank lines and # comments are skipped, a - for lat is a failed fix """
+        fixes = []
+        with open(path) as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if not line:
+                    continue
+                seconds, lat, lon = [ elem.strip() for elem in line.split(",") ]
+                if lat == "-":
+                    fixes.append(( float(seconds), None, None ))
+                else:
+                    fixes.append(( float(seconds), float(lat), float(lon) ))
+        return TraceLocationProvider(fixes, **kw)
+
+    def getLocation(self):
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        idx = bisect.bisect_right(self.times, ( now - self.started ) * self.speedup) - 1
+        fix = self.fixes[max(0, idx)]
+        if fix[1] is None:
+            raise Exception("No fix in the trace at %.1fs" % fix[0])
+        return [ fix[1], fix[2] ]
+
+def makeLocationProvider():
+    if locationTraceFile is not None:
+        return TraceLocationProvider.load(locationTraceFile)
+    return ICloudLocationProvider()
+
+class AdaptiveLocationPoller(object):
+    """
+    Decides when to ask the provider for the phone's location: every locationFastSeconds when moving quickly
+    or when something critical is active, rarely once the last few fixes are all in the same spot, and
+    backing off exponentially when fixes fail.  When moving, the interval is about the time it takes to
+    cover locationRefreshMiles.
+    """
+    __slots__ = "provider history nextPoll failures polls errors".split()
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.history = collections.deque(maxlen=locationHistory) # ( time, [ lat, long ] ), oldest first
+        self.nextPoll = 0
+        self.failures = 0 # in a row
+        self.polls = 0
+        self.errors = 0
+
+    def recordFix(self, coord, now):
+        self.history.append(( now, list(coord) ))
+
+    def getSpeed(self):
+        """ Miles per second between the last two fixes, None with fewer than two """
+        if len(self.history) < 2:
+            return None
+        ( first, start ), ( last, end ) = self.history[-2], self.history[-1]
+        if last <= first:
+            return None
+        return haversine(start[0], end[0], start[1], end[1]) / ( last - first )
+
+    def isStationary(self):
+        if len(self.history) < self.history.maxlen:
+            return False
+        latest = self.history[-1][1]
+        return all([ haversine(latest[0], coord[0], latest[1], coord[1]) < locationStationaryMiles for _, coord in self.history ])
+
+    def getInterval(self, criticalActive=False):
+        if self.failures:
+            return min(locationMaxBackoff, locationRetrySeconds * 2 ** ( self.failures - 1 ))
+        if criticalActive:
+            return locationFastSeconds
+        if self.isStationary():
+            return locationSlowSeconds
+        speed = self.getSpeed()
+        if speed:
+            return max(locationFastSeconds, min(locationNormalSeconds, locationRefreshMiles / speed))
+        return locationNormalSeconds
+
+    def poll(self, now, criticalActive=False):
+        """ Returns a fresh [ lat, long ] if a fix was due and succeeded, otherwise None """
+        if now < self.nextPoll:
+            return None
+        self.polls = self.polls + 1
+        try:
+            with metricLocation.time():
+                coord = self.provider.getLocation()
+        except Exception as ex:
+            metricLocationErrors.inc()
+            self.errors = self.errors + 1
+            self.failures = self.failures + 1
+            print "Failed to get the phone location (%d in a row): %s" % ( self.failures, str(ex) )
+            if Current.debug:
+                traceback.print_exc()
+            self.provider.reset()
+            self.nextPoll = now + self.getInterval(criticalActive)
+            return None
+        self.failures = 0
+        self.recordFix(coord, now)
+        self.nextPoll = now + self.getInterval(criticalActive)
+        return coord
+
+    def reschedule(self, now, criticalActive=False):
+        """ Pulls the next poll in if it is now due sooner, e.g. a critical pokemon just showed up """
+        self.nextPoll = min(self.nextPoll, ( self.history[-1][0] if self.history else now ) + self.getInterval(criticalActive))
+
+    def stats(self):
+        speed = self.getSpeed()
+        return {
+            "polls"      : self.polls,
+            "errors"     : self.errors,
+            "failures"   : self.failures,
+            "stationary" : self.isStationary(),
+            "mph"        : speed * 3600 if speed is not None else None,
+            "nextPoll"   : self.nextPoll
+        }
+
 class Manager(threading.Thread):
-    __slots__ = "active nearby iCloud slack userId userName lastUpdated previousURL webToManagerQueue managerToWebQueue slackToManagerQueue".split()
+    __slots__ = "active nearby byId bySpawn duplicateCount index distances expiry snapshot published deltas handled wakeup pollInterval refreshRequested running schedulerStats location refreshCoord slack userId userName lastUpdated webToManagerQueue managerToWebQueue slackToManagerQueue".split()
 
-    def __init__(self, slack, webToManagerQueue, managerToWebQueue, slackToManagerQueue):
+    def __init__(self, slack, webToManagerQueue, managerToWebQueue, slackToManagerQueue, locationProvider=None):
         threading.Thread.__init__(self)
         self.slack = slack
         self.webToManagerQueue = webToManagerQueue
         self.managerToWebQueue = managerToWebQueue
         self.slackToManagerQueue = slackToManagerQueue
-        self.active = []
-        self.nearby = []
+        self.active = collections.OrderedDict() # id -> Pokemon, in the order they arrived
+        self.nearby = collections.OrderedDict() # id -> Pokemon
+        self.byId = {} # id -> Pokemon, for everything tracked (active, nearby, or too far away for now)
+        self.bySpawn = {} # Pokemon.getSpawnKey() -> Pokemon, to spot duplicate reports of the same spawn
+        self.duplicateCount = 0
+        self.index = SpatialIndex() # every pokemon we are tracking, active or not, by location
+        self.distances = DistanceBatch() # active pokemon coordinates, for the per tick distance refresh
+        self.expiry = ExpiryHeap() # every tracked pokemon, ordered by when it despawns (or becomes unreachable)
         self.lastUpdated = 0
-        self.previousURL = ""
+        self.location = AdaptiveLocationPoller(locationProvider if locationProvider is not None else makeLocationProvider())
+        self.refreshCoord = None # where the phone was for the last refresh
+
+        # Only the manager thread touches the lists above, everyone else reads the latest snapshot
+        self.snapshot = ManagerSnapshot(0, time.time(), 0, (), ())
+        self.published = threading.Condition()
+        self.deltas = DeltaBroadcaster() # /api/stream clients
+        self.handled = [] # threading.Event of each command handled this pass, set once its result is published
+
+        # The run loop sleeps until the next refresh or despawn, or until something lands on one of our queues
+        self.wakeup = Wakeup()
+        self.pollInterval = None
+        self.refreshRequested = False
+        self.running = True
+        for queue in ( webToManagerQueue, slackToManagerQueue ):
+            if isinstance(queue, WakeupQueue):
+                queue.wakeup = self.wakeup
+            elif queue is not None:
+                self.pollInterval = .1 # a plain Queue can't wake us up, fall back to polling it
+        self.schedulerStats = {
+            "ticks"            : 0,
+            "lastTickSeconds"  : 0.0,
+            "maxTickSeconds"   : 0.0,
+            "totalTickSeconds" : 0.0,
+            "lastTickLateness" : 0.0, # how long after its deadline the last refresh started
+            "wakeups"          : 0,
+            "unreachable"      : 0,   # active pokemon dropped by cullUnreachable
+            "idleSeconds"      : 0.0, # wall time spent asleep
+            "idleCpuSeconds"   : 0.0  # process cpu time used while this thread was asleep
+        }
+
         if Current.enableGoogleAndICloud:
             self.connectIcloud()
 
@@ -543,6 +2588,30 @@ class Manager(threading.Thread):
             if not Current.getTesting():
                 print "Messaging disabled"
 
+    def publish(self):
+        """ Builds a new immutable snapshot of active/nearby, call from the manager thread after any change
+            Returns the current snapshot unchanged (same generation) if nothing the pages show has changed """
+        now = time.time()
+        active = tuple([ pm.snapshot() for pm in self.buildSortedActive() ])
+        nearby = tuple([ pm.snapshot() for pm in self.buildSortedNearby() ])
+        previous = self.snapshot
+        # the dashboard shows minutes to despawn, so a new minute is a change even when the pokemon aren't
+        if previous.generation and active == previous.active and nearby == previous.nearby and int(now / 60) == int(previous.created / 60):
+            return previous
+        snap = ManagerSnapshot(previous.generation + 1, now, self.lastUpdated, active, nearby)
+        with self.published:
+            self.snapshot = snap
+            self.published.notifyAll()
+
+        if len(self.deltas):
+            delta = snapshotDelta(previous, snap)
+            if delta is not None:
+                self.deltas.publish(delta)
+        return snap
+
+    def getSnapshot(self):
+        return self.snapshot
+
     def getSecondsUntilNextUpdate(self):
         return ( self.lastUpdated + managerRefreshTime ) - time.time()
 
@@ -552,14 +2621,63 @@ class Manager(threading.Thread):
         self.userName = userInfo["user"]
         print "Got username from slack: userName=%s, userId=%s" % ( str(self.userName), str(self.userId) )
 
-    def addActivePokemon(self, pokemon):
+    def track(self, pokemon):
+        self.byId[pokemon.getId()] = pokemon
+        self.bySpawn[pokemon.getSpawnKey()] = pokemon
+        self.index.add(pokemon)
+
+    def untrack(self, pokemon):
+        """ Forgets a pokemon everywhere it is kept """
+        idVal = pokemon.getId()
+        self.byId.pop(idVal, None)
+        if self.bySpawn.get(pokemon.getSpawnKey()) is pokemon:
+            del self.bySpawn[pokemon.getSpawnKey()]
+        self.active.pop(idVal, None)
+        self.nearby.pop(idVal, None)
+        self.index.remove(pokemon)
+        self.distances.remove(pokemon)
+        self.expiry.discard(pokemon)
+
+    def getPokemonById(self, idVal):
+        return self.byId.get(idVal)
+
+    def findDuplicate(self, pokemon):
+        """ The tracked pokemon reported with the same name and coordinates, if it has not despawned yet """
+        existing = self.bySpawn.get(pokemon.getSpawnKey())
+        if existing is not None and pokemon.timeReceived < existing.getDespawnTime():
+            return existing
+        return None
+
+    def mergeDuplicate(self, existing, pokemon):
+        if Current.debug:
+            print "Merging duplicate report: %s into %s" % ( str(pokemon), str(existing) )
+        self.duplicateCount = self.duplicateCount + 1
+        if existing.getText() is None:
+            # reloaded from the database, keep the live report's message
+            existing.text = pokemon.getText()
+        return existing
+
+    def addActivePokemon(self, pokemon, resolveNow=True):
         if Current.debug:
             print "Adding ACTIVE pokemon: %s" % str(pokemon)
-        self.active.append(pokemon)
-        self.potentiallySendTextForPokemon(pokemon)
-
-        if pokemon.getTimeToTarget() is None:
+        self.active[pokemon.getId()] = pokemon
+        self.track(pokemon)
+        self.distances.add(pokemon)
+
+        if Current.phoneCoord is not None and pokemon.crowDistance is None:
+            pokemon.crowDistance = haversine(Current.phoneCoord[0], pokemon.coords[0], Current.phoneCoord[1], pokemon.coords[1])
+        if pokemon.isReachable():
+            self.potentiallySendTextForPokemon(pokemon)
+            if pokemon.getCritical():
+                # poll the location more often while there is something worth chasing
+                self.location.reschedule(time.time(), True)
+        else:
+            # too far to ever make it, no text, and it is culled on the next refresh without a google lookup
+            resolveNow = False
+        if resolveNow and pokemon.getTimeToTarget() is None:
             pokemon.updateDistanceBetweenPoints()
+            self.distances.markChecked(pokemon)
+        self.expiry.push(pokemon)
 
     def potentiallySendTextForPokemon(self, pm):
         if not Current.enableTextMessages:
@@ -569,60 +2687,100 @@ class Manager(threading.Thread):
             return
 
         if shouldSendText(pm, pm.getDistanceToTarget()):
-            sendTextMessageViaEmail(pm.getName(), pm.getText(), pm.getLink())
+            sendTextMessageViaEmail(pm.getName(), pm.getText(), pm.getLink(), NotificationDispatcher.spawnKey(pm.getName(), pm.getCoords()))
 
     def addNearbyPokemon(self, pokemon):
         if Current.debug:
             print "Adding NEARBY pokemon: %s" % str(pokemon)
-        self.nearby.append(pokemon)
+        self.nearby[pokemon.getId()] = pokemon
+        self.track(pokemon)
+        self.expiry.push(pokemon)
+
+    def addCandidatePokemon(self, pokemon):
+        """ Tracks a pokemon that is too far away to be nearby (for now), it will show up once we get close enough """
+        self.track(pokemon)
+        self.expiry.push(pokemon)
 
     def getActiveCount(self):
         return len(self.active)
 
+    def cullUnreachable(self, now):
+        """ Drops active pokemon we can't reach in time even at reachSpeed, before anything is spent looking them up """
+        culled = [ elem for elem in self.active.itervalues() if not elem.isReachable(now) ]
+        for elem in culled:
+            if Current.debug:
+                print "Unreachable, removing: %s" % str(elem)
+            self.untrack(elem)
+        self.schedulerStats["unreachable"] = self.schedulerStats["unreachable"] + len(culled)
+        return culled
+
     def updateAllDistances(self):
         # Iterate over each active record, update distance if needed
-        updateCount = 0
-        for elem in self.active:
-            if elem.shouldUpdateDistance():
-                elem.updateDistanceBetweenPoints()
-                updateCount = updateCount + 1
-
-        for elem in self.nearby:
-            elem.updateDistanceUsingHaversine()
+        self.distances.refresh(Current.phoneCoord)
+        now = time.time()
+        self.cullUnreachable(now)
+        pending = [ elem for elem in self.active.itervalues() if elem.shouldUpdateDistance() ]
+        if pending:
+            if Current.enableGoogleAndICloud and Current.phoneCoord is not None:
+                # one request per distanceMatrixBatchSize pokemon, instead of one each, most important first
+                pending.sort(key=methodcaller("getLookupPriority", now))
+                getDistanceMatrixClient().resolve(Current.phoneCoord, pending, distanceMatrixMaxPerRefresh)
+            else:
+                for elem in pending:
+                    elem.updateDistanceBetweenPoints()
+
+            for elem in pending:
+                self.distances.markChecked(elem)
+                self.expiry.push(elem) # timeToTarget may have moved the deadline
+        updateCount = len(pending)
+
+        if Current.phoneCoord is not None:
+            # Only the cells around the phone are visited, anything further out keeps its old distance
+            nearby = collections.OrderedDict()
+            for elem, distance in self.getPokemonWithin(NEARBY_LIMIT):
+                if not elem.shouldAddToActive():
+                    elem.setHaversineDistance(distance)
+                    nearby[elem.getId()] = elem
+            self.nearby = nearby
 
         return updateCount
 
-    def removeInvalidPokemon(self):
-        # Remove any element that needs to be removed
-        tmp = []
-        for elem in self.active:
-            if elem.isStillValid():
-                tmp.append(elem)
-        self.active = tmp
-
-        tmp = []
-        for elem in self.nearby:
-            if elem.isStillValid():
-                tmp.append(elem)
-        self.nearby = tmp
+    def getPokemonWithin(self, radius):
+        """ Returns ( pokemon, distance ) for every tracked pokemon within radius miles of the phone """
+        return self.index.within(Current.phoneCoord, radius)
+
+    def removeInvalidPokemon(self, now=None):
+        # Only the pokemon whose deadline has passed are looked at
+        expired = self.expiry.popExpired(time.time() if now is None else now)
+        for elem in expired:
+            self.untrack(elem)
+        return expired
+
+    def removePokemonById(self, idVal):
+        """ Forgets a pokemon entirely, it will not come back as nearby on the next update """
+        pm = self.byId.get(idVal)
+        if pm is None:
+            return False
+        self.untrack(pm)
+        return True
 
     def getActive(self):
-        return self.active
+        return self.active.values()
 
     def getNearby(self):
-        return self.nearby
+        return self.nearby.values()
 
     def buildSortedActive(self):
         # Sort by distance
-        return sorted(self.active, key=methodcaller('getTimeToTarget'))
+        return sorted(self.active.itervalues(), key=methodcaller('getTimeToTarget'))
 
     def buildSortedNearby(self):
         # Sort by distance
-        return sorted(self.nearby, key=methodcaller('getDistanceToTarget'))
+        return sorted(self.nearby.itervalues(), key=methodcaller('getDistanceToTarget'))
 
     def report(self):
         # 1. Get the sorted active list
-        sortedActive = self.buildSortedActive()
+        sortedActive = self.getSnapshot().active
 
         # 2. Build outbound string
         outbound = []
@@ -646,65 +2804,62 @@ class Manager(threading.Thread):
             return val + 1
 
     def generateStaticMap(self, execute=True):
+        """ Labels the active pokemon and asks for a map of them, returns the map url (or None) """
         if Current.phoneCoord is None:
             return
 
         if not Current.enableGoogleAndICloud:
-            if os.path.exists("current.png"): # delete the image if location is not enabled
-                os.remove("current.png")
+            if execute: # stop showing the map if location is not enabled
+                getStaticMapRenderer().clear()
             return
 
-        markers = [ "&markers=color:black|%s" % Current.getIphoneCoordStr() ]
+        # the phone is snapped to a grid, so GPS jitter alone doesn't redraw the map
+        center = StaticMapRenderer.quantize(Current.phoneCoord)
+        markers = [ ( None, center ) ]
         pos = 'A'
         for mon in self.buildSortedActive():
             mon.setLabel(pos)
             pos = Manager.getNextStringOrNumber(pos)
-            markers.append("&markers=label:%s|%s" % ( mon.getLabel(), mon.getFormattedCoordStr() ))
+            markers.append(( mon.getLabel(), mon.getFormattedCoordStr() ))
 
         if len(markers) > 1:
-            url = "https://maps.googleapis.com/maps/api/staticmap?size=640x640&center=%s&maptype=roadmap&key=%s%s" % ( Current.getIphoneCoordStr(), staticMapApiKey, "".join(markers) )
+            url = StaticMapRenderer.buildUrl(center, markers)
             if Current.debug:
                 print "Generating static map: url=%s" % url
             if execute:
-                if self.previousURL == url:
-                    return url
-                urllib.urlretrieve(url, "new.png")
-                os.rename("new.png", "current.png")
-                previousURL = url
+                # a no-op if it is the map we already have, never waits on the download
+                getStaticMapRenderer().request(url)
             return url
         return None
 
     def connectIcloud(self):
-        """ Connects to iCloud, or throws an exception """
-        print "Connecting to iCloud"
-        self.iCloud = PyiCloudService(icloudUser, icloudPassword)
-        if icloudDevice in self.iCloud.devices.keys():
-            print "iCloud is connected"
-        else:
-            raise Exception("Could not find device in iCloud! %s" % str(self.iCloud.devices.keys()) )
+        """ Connects to iCloud (or whatever provides the location), or throws an exception """
+        self.location.provider.connect()
 
-    def updateIphoneLocation(self):
-        """ Retrieves the location from iCloud for your phone """
-        if not Current.enableGoogleAndICloud:
-            return
+    def isCriticalActive(self):
+        for pokemon in self.active.itervalues():
+            if pokemon.getCritical():
+                return True
+        return False
 
-        res = None
-        try:
-            res = self.iCloud.devices[icloudDevice].location()
-            Current.phoneCoord = [ res["latitude"], res["longitude"] ]
-            if Current.debug:
-                print "Got iPhone result! %s" % str(Current.phoneCoord)
-            return Current.phoneCoord
-        except Exception as ex:
-            print "Res = %s" % str(res)
-            traceback.print_exc()
-            print "Reconnect to iCloud!"
-            self.connectIcloud()
+    def pollLocation(self, now):
+        """ Asks for the phone location if the poller says it is due, returns True if we moved enough to refresh early """
+        if not Current.enableGoogleAndICloud:
+            return False
+        coord = self.location.poll(now, self.isCriticalActive())
+        if coord is None:
+            return False
+        Current.phoneCoord = coord
+        if Current.debug:
+            print "Got iPhone result! %s" % str(Current.phoneCoord)
+        if self.refreshCoord is None:
+            return True
+        return haversine(self.refreshCoord[0], coord[0], self.refreshCoord[1], coord[1]) >= locationRefreshMiles
 
     def playIphoneSound(self):
         """ Plays a sound on your phone, as slack isn't terribly reliable :( """
         if Current.enableGoogleAndICloud:
-            self.iCloud.devices[icloudDevice].play_sound()
+            self.location.provider.playSound()
 
     def sendToSlack(self, msg):
         if not Current.enableSlack:
@@ -716,15 +2871,14 @@ class Manager(threading.Thread):
         )
 
     def updateAll(self):
-        print "Updating iphoneLocation"
-        self.updateIphoneLocation()
-        print "iPhoneLocation updated, coords = %s" % Current.getIphoneCoordStr()
-        updateCount = self.updateAllDistances()
-        print "Updated all distances"
-        self.removeInvalidPokemon()
-        print "Removed all invalid pokemon"
-        self.generateStaticMap()
-        print "Generated static map"
+        # the location is polled on its own schedule by the run loop, this works from the latest fix
+        self.refreshCoord = Current.phoneCoord
+        with metricUpdatePhases["distances"].time():
+            self.updateAllDistances()
+        with metricUpdatePhases["expire"].time():
+            self.removeInvalidPokemon()
+        with metricUpdatePhases["staticmap"].time():
+            self.generateStaticMap()
 
     def reportAndSendToSlack(self):
         outbound = self.report()
@@ -732,38 +2886,180 @@ class Manager(threading.Thread):
             self.sendToSlack(outbound)
 
     def repopulateDB(self, conn):
+        """ Reloads every spawn that has not despawned yet, using the event time index """
         cur = conn.cursor()
-        cur.execute("select time, type, lat, long, link, notes from event order by time desc limit 50")
-        elems = cur.fetchall()
-        for elem in elems:
-            if time.time() < elem[0] + 700:
+        cur.execute("select time, type, lat, long, link, notes from event where time > ? order by time", ( int(time.time() - despawnSeconds), ))
+        count = 0
+        for elem in cur: # streamed, not fetchall()
+            if Current.debug:
                 print "Reloading: %s" % str(elem)
-                pm = Pokemon(elem[0], elem[1], [ elem[2], elem[3] ], None, elem[4])
-                self.potentiallyAddPokemonToManager(pm)
-
-    def potentiallyAddPokemonToManager(self, pm):
+            pm = Pokemon(elem[0], elem[1], [ elem[2], elem[3] ], None, elem[4])
+            # distances are resolved in one batch on the first update
+            self.potentiallyAddPokemonToManager(pm, resolveNow=False)
+            count = count + 1
+        print "Reloaded %d pokemon from the database" % count
+        return count
+
+    def potentiallyAddPokemonToManager(self, pm, resolveNow=True):
+        existing = self.findDuplicate(pm)
+        if existing is not None:
+            return self.mergeDuplicate(existing, pm)
+        return self.route(pm, resolveNow)
+
+    def route(self, pm, resolveNow=True):
+        """ Starts tracking pm as active, nearby or a candidate, depending on how it is classified """
         if pm.shouldAddToActive():
-            self.addActivePokemon(pm)
+            self.addActivePokemon(pm, resolveNow)
         elif pm.isNearby():
             self.addNearbyPokemon(pm)
-
-    def run(self):
-        """ The manager thread main loop.  This will loop over our pokemon, update their distances, and then produce a message to send to slackbot """
+        else:
+            self.addCandidatePokemon(pm)
+        return pm
+
+    def reclassify(self):
+        """ Re-rates everything tracked against the current rules, and re-routes whatever moved in or out of active """
+        moved = 0
+        for pokemon in self.byId.values():
+            wasActive = pokemon.getId() in self.active
+            pokemon.computeStatus()
+            if pokemon.shouldAddToActive() != wasActive:
+                self.untrack(pokemon)
+                self.route(pokemon, resolveNow=False)
+                moved = moved + 1
+        return moved
+
+    def processIncoming(self):
+        """ Adds everything the ingest pipeline has classified since the last call """
+        count = 0
+        if self.slackToManagerQueue is None:
+            return count
+        while True:
+            try:
+                pm = self.slackToManagerQueue.get_nowait()
+            except Queue.Empty:
+                return count
+            if pm is IngestStage.STOP: # passed along by IngestPipeline.stop()
+                continue
+            self.potentiallyAddPokemonToManager(pm)
+            count = count + 1
+
+    def processCommands(self):
+        """ Handles everything the web server has sent since the last call """
+        count = 0
+        if self.webToManagerQueue is None:
+            return count
         while True:
             try:
-                if time.time() - self.lastUpdated > managerRefreshTime:
-                    self.updateAll()
-                    self.lastUpdated = time.time()
+                command = self.webToManagerQueue.get_nowait()
+            except Queue.Empty:
+                return count
+            try:
+                self.handleCommand(command)
+            except Exception as ex:
+                print "Error handling manager command! %s" % str(command)
+                traceback.print_exc()
+            if len(command) > 2 and command[2] is not None:
+                self.handled.append(command[2])
+            count = count + 1
+
+    def answerCommands(self):
+        """ Lets the senders of the commands handled this pass know, after any change they made is published """
+        for done in self.handled:
+            done.set()
+        self.handled = []
+
+    def handleCommand(self, command):
+        name = command[0]
+        if name == "location":
+            Current.phoneCoord = list(command[1])
+            self.location.recordFix(Current.phoneCoord, time.time())
+            self.refreshRequested = True
+        elif name == "remove":
+            if not self.removePokemonById(command[1]):
+                print "Could not find idVal = %s" % command[1]
+        else:
+            print "Unknown manager command: %s" % str(command)
+
+    def tick(self):
+        """ One full refresh, timed for schedulerStats """
+        stats = self.schedulerStats
+        started = time.time()
+        if self.refreshRequested or self.lastUpdated == 0:
+            stats["lastTickLateness"] = 0.0
+        else:
+            stats["lastTickLateness"] = max(0.0, started - ( self.lastUpdated + managerRefreshTime ))
+        self.refreshRequested = False
 
-                    if Current.debug:
-                        for pokemon in self.active:
-                            print "Active: %s" % str(pokemon)
-                        print "-=-=-=-=-=-=-=-"
+        try:
+            if reloadRulesIfChanged():
+                # new spawns pick up the rules as they arrive, reclassify everything already tracked
+                self.reclassify()
+
+            self.updateAll()
+        finally:
+            # a refresh that failed still waits managerRefreshTime for the next, or the run loop retries it without sleeping
+            self.lastUpdated = time.time()
+
+        elapsed = self.lastUpdated - started
+        stats["ticks"] = stats["ticks"] + 1
+        stats["lastTickSeconds"] = elapsed
+        stats["maxTickSeconds"] = max(stats["maxTickSeconds"], elapsed)
+        stats["totalTickSeconds"] = stats["totalTickSeconds"] + elapsed
+        metricTick.observe(elapsed)
+
+    def getNextWakeup(self):
+        """ The earliest of the next refresh, the next despawn and the next location poll """
+        deadline = self.lastUpdated + managerRefreshTime
+        nextExpiry = self.expiry.nextDeadline()
+        if nextExpiry is not None and nextExpiry < deadline:
+            deadline = nextExpiry
+        if Current.enableGoogleAndICloud and self.location.nextPoll < deadline:
+            deadline = self.location.nextPoll
+        return deadline
+
+    def sleepUntilNextWakeup(self):
+        timeout = max(0.0, self.getNextWakeup() - time.time())
+        if self.refreshRequested:
+            timeout = 0.0
+        if self.pollInterval is not None:
+            timeout = min(timeout, self.pollInterval)
+
+        stats = self.schedulerStats
+        started = time.time()
+        cpuStarted = sum(os.times()[:2])
+        self.wakeup.wait(timeout)
+        stats["wakeups"] = stats["wakeups"] + 1
+        stats["idleSeconds"] = stats["idleSeconds"] + ( time.time() - started )
+        stats["idleCpuSeconds"] = stats["idleCpuSeconds"] + ( sum(os.times()[:2]) - cpuStarted )
+
+    def stop(self):
+        """ Ends the run loop after the current pass """
+        self.running = False
+        self.wakeup.set()
 
+    def run(self):
+        """ The manager thread main loop.  This will loop over our pokemon, update their distances, and then produce a message to send to slackbot """
+        while self.running:
+            try:
+                changed = self.processCommands() + self.processIncoming()
+                now = time.time()
+                if self.pollLocation(now):
+                    self.refreshRequested = True
+                if self.refreshRequested or now - self.lastUpdated > managerRefreshTime:
+                    self.tick()
+                    changed = True
+                elif self.removeInvalidPokemon(now):
+                    # woken early, something despawned since the last tick
+                    changed = True
+                if changed:
+                    self.publish()
             except Exception as ex:
                 print "Error in Manager loop!"
                 traceback.print_exc()
-            time.sleep(.1)
+                time.sleep(managerErrorDelay)
+            finally:
+                self.answerCommands()
+            self.sleepUntilNextWakeup()
 
 ##########################################################################
 
@@ -781,7 +3077,58 @@ sqlStatement = "insert into event ( time, type, link, lat, long, notes ) values
 userId   = None
 userName = None
 
+# Slack attachment text, as posted by the pokemon bot:
+#   Snorlax (95.6%) until 04:12:33PM
+#   <http://maps.google.com/maps?q=40.758000,-73.985500|Open in Google Maps>
+# everything we need comes out of one match, the IV is optional
+attachmentPattern = re.compile(r"^(?P<species>[^\n(<]*)(?:\((?P<iv>[0-9]{1,3}(?:\.[0-9]+)?)%\))?[^<]*<(?P<url>[^|>]*[?&]q=(?P<coords>(?P<lat>-?[0-9.]+),(?P<lon>-?[0-9.]+))[^|>]*)")
+
+# for bot posts laid out differently, e.g. the IV after the link or on a line of its own
+ivPattern = re.compile(r"\((?P<iv>[0-9]{1,3}(?:\.[0-9]+)?)%\)")
+linkPattern = re.compile(r"<[^>]*>")
+
+ParsedAttachment = collections.namedtuple("ParsedAttachment", "species iv coords coordStr mapUrl")
+
+def parseOutsideLink(text):
+    """ ( species, IV ) from anywhere in the text except the <url|...> link, either may be None """
+    outside = linkPattern.sub("\n", text)
+    mtch = ivPattern.search(outside)
+    species = None
+    for line in outside.split("\n"):
+        name = line.split("(")[0].split(" until ")[0].strip().lower()
+        if name:
+            species = name
+            break
+    return species, float(mtch.group("iv")) if mtch is not None else None
+
+def parseAttachment(text, strict=True):
+    """
+    Species, IV (a float, or None), [ lat, long ], the "lat,long" string and the map url from an attachment.
+    Text the pattern doesn't recognize goes through parseCoordinates, if that fails too an exception is raised,
+    or None returned when strict is False.
+    """
+    mtch = attachmentPattern.match(text)
+    if mtch is not None:
+        iv = mtch.group("iv")
+        iv = float(iv) if iv is not None else None
+        species = mtch.group("species").split(" until ")[0].strip().lower() or None
+        if iv is None or species is None:
+            # not the usual "Species (IV%) until ..." ahead of the link, look at the rest of the text
+            otherSpecies, otherIv = parseOutsideLink(text)
+            species = species or otherSpecies
+            iv = iv if iv is not None else otherIv
+        return ParsedAttachment(species, iv, [ float(mtch.group("lat")), float(mtch.group("lon")) ], mtch.group("coords"), mtch.group("url"))
+    try:
+        coords = parseCoordinates(text)
+    except Exception as ex:
+        if strict:
+            raise
+        return None
+    species, iv = parseOutsideLink(text)
+    return ParsedAttachment(species, iv, coords, "%f,%f" % ( coords[0], coords[1] ), None)
+
 def parseCoordinates(val):
+    """ The old, general purpose, way to get coordinates out of an attachment """
     parsed    = urlparse(val)
     elems     = parsed[4].split("|")
     coordObj  = parse_qs(elems[0])
@@ -790,37 +3137,154 @@ def parseCoordinates(val):
     longitude = float(coords[1])
     return [ latitude, longitude ]
 
+def migrateDatabase(conn):
+    """ Brings the schema up to date, the version is tracked in sqlite's user_version """
+    version = conn.execute("pragma user_version").fetchone()[0]
+    for migration, statement in schemaMigrations:
+        if migration > version:
+            print "Migrating database to version %d" % migration
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.execute(statement)
+            conn.execute("pragma user_version = %d" % migration)
+            conn.commit()
+    return conn
+
 def connectDatabase():
     print "Connecting to database"
-    createDB = False
-    # If the database does not exist, mark that we should create the schema
-    if not os.path.isfile(dbname):
-        createDB = True
-
     conn = sqlite3.connect(dbname) # make our connection to the database "file"
+    for pragma in dbPragmas:
+        conn.execute("pragma %s" % pragma)
 
-    if createDB:
-        # Get a cursor, and create our single table
-        cur = conn.cursor()
-        cur.execute("create table event ( time integer, type text, lat real, long real, link text, notes text )")
-        conn.commit()
+    # creates the event table for a new database, and adds any indexes an old one is missing
+    migrateDatabase(conn)
     print "Connected to database"
     return conn
 
-def writeToDatabase(conn, item, coords):
-    cur = conn.cursor()
-    cur.execute(
-        sqlStatement,
-        (
-            int(float(item["ts"])),
-            item["username"],
-            item["attachments"][0]['text'],
-            coords[0],
-            coords[1],
-            item["text"]
-        )
+def spawnSpecies(item, attachment):
+    """ The bot posts as the species, older posts only name it in the attachment """
+    return item.get("username") or attachment.species
+
+def eventRow(item, attachment):
+    """ The values for sqlStatement """
+    return (
+        int(float(item["ts"])),
+        spawnSpecies(item, attachment),
+        item["attachments"][0]['text'],
+        attachment.coords[0],
+        attachment.coords[1],
+        item["text"]
     )
-    conn.commit()
+
+def writeToDatabase(conn, item, attachment):
+    row = eventRow(item, attachment)
+    try:
+        conn.execute(sqlStatement, row)
+        SpawnAnalytics.apply(conn, [ row ]) # one transaction, a failure leaves neither the event nor its counts
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+class SpawnAnalytics(object):
+    """
+    Aggregates over the event table: spawns per species and hour of the day, per species, grid cell and
+    hour, and an IV histogram per species.  They are updated with each batch of inserts (apply()), so the
+    queries below read a few small rows instead of scanning every event.  Rows are in sqlStatement order.
+    """
+    __slots__ = "conn".split()
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def cellFor(lat, lon):
+        return ( int(floor(lat / analyticsCellSize)), int(floor(lon / analyticsCellSize)) )
+
+    @staticmethod
+    def count(rows):
+        """ The increments for rows, as three dicts of key -> count """
+        hourly = collections.defaultdict(int)
+        cells = collections.defaultdict(int)
+        ivs = collections.defaultdict(int)
+        for eventTime, name, link, lat, lon, notes in rows:
+            species = name.lower()
+            hour = time.localtime(eventTime).tm_hour
+            hourly[( species, hour )] += 1
+            cellLat, cellLong = SpawnAnalytics.cellFor(lat, lon)
+            cells[( species, cellLat, cellLong, hour )] += 1
+            attachment = parseAttachment(link, strict=False) if link else None
+            if attachment is not None and attachment.iv is not None:
+                ivs[( species, int(attachment.iv // analyticsIvBucket) * analyticsIvBucket )] += 1
+        return hourly, cells, ivs
+
+    @staticmethod
+    def apply(conn, rows):
+        """ Adds rows to the aggregates, the caller commits """
+        hourly, cells, ivs = SpawnAnalytics.count(rows)
+        for table, columns, counts in (
+                ( "species_hourly", ( "species", "hour" ), hourly ),
+                ( "cell_density", ( "species", "cellLat", "cellLong", "hour" ), cells ),
+                ( "iv_histogram", ( "species", "bucket" ), ivs ) ):
+            keys = counts.keys()
+            conn.executemany("insert or ignore into %s ( %s, count ) values ( %s, 0 )" % ( table, ", ".join(columns), ", ".join([ "?" ] * len(columns)) ), keys)
+            conn.executemany("update %s set count = count + ? where %s" % ( table, " and ".join([ "%s = ?" % column for column in columns ]) ), [ ( counts[key], ) + key for key in keys ])
+
+    @staticmethod
+    def rebuild(conn, chunkSize=5000):
+        """ Recomputes every aggregate from the event table """
+        for table in ( "species_hourly", "cell_density", "iv_histogram" ):
+            conn.execute("delete from %s" % table)
+        cur = conn.execute("select time, type, link, lat, long, notes from event")
+        total = 0
+        while True:
+            rows = cur.fetchmany(chunkSize)
+            if not rows:
+                break
+            SpawnAnalytics.apply(conn, rows)
+            total = total + len(rows)
+        conn.commit()
+        print "Rebuilt spawn analytics from %d events" % total
+        return total
+
+    @staticmethod
+    def hourClause(fromHour, toHour):
+        """ SQL for fromHour <= hour < toHour, wrapping past midnight when toHour <= fromHour """
+        if fromHour is None:
+            return "1", ()
+        if fromHour < toHour:
+            return "hour >= ? and hour < ?", ( fromHour, toHour )
+        return "( hour >= ? or hour < ? )", ( fromHour, toHour )
+
+    def hourlyFrequency(self, species):
+        """ 24 counts, one per hour of the day """
+        res = [ 0 ] * 24
+        for hour, count in self.conn.execute("select hour, count from species_hourly where species = ?", ( species.lower(), )):
+            res[hour] = count
+        return res
+
+    def topCells(self, species=None, fromHour=None, toHour=None, limit=10):
+        """ [ ( center lat, center long, count ) ] busiest cells first, for one species (or all) between the hours """
+        clause, params = SpawnAnalytics.hourClause(fromHour, toHour)
+        if species is not None:
+            clause = "species = ? and " + clause
+            params = ( species.lower(), ) + params
+        rows = self.conn.execute("select cellLat, cellLong, sum(count) as total from cell_density where %s group by cellLat, cellLong order by total desc limit ?" % clause, params + ( limit, ))
+        return [ ( ( cellLat + .5 ) * analyticsCellSize, ( cellLong + .5 ) * analyticsCellSize, total ) for cellLat, cellLong, total in rows ]
+
+    def ivDistribution(self, species=None):
+        """ [ ( bucket start, count ) ] for one species, or all of them """
+        if species is None:
+            rows = self.conn.execute("select bucket, sum(count) from iv_histogram group by bucket order by bucket")
+        else:
+            rows = self.conn.execute("select bucket, count from iv_histogram where species = ? order by bucket", ( species.lower(), ))
+        return [ ( bucket, count ) for bucket, count in rows ]
+
+    def topSpecies(self, fromHour=None, toHour=None, limit=10):
+        clause, params = SpawnAnalytics.hourClause(fromHour, toHour)
+        rows = self.conn.execute("select species, sum(count) as total from species_hourly where %s group by species order by total desc limit ?" % clause, params + ( limit, ))
+        return [ ( species, total ) for species, total in rows ]
 
 def connectSlack():
     print "Connecting to slack"
@@ -830,19 +3294,241 @@ def connectSlack():
         raise Exception("Failed to connect to slack, invalid token? token=%s" % token)
     return slack
 
-def mainLoop(manager, slack, conn, slackToManagerQueue):
-    while True:
-        dataRead = slack.rtm_read()
-        for item in dataRead:
-            if 'bot_id' and 'subtype' and 'attachments' not in item:
+def parseSlackItem(item):
+    return item, parseAttachment(item["attachments"][0]['text'])
+
+def buildPokemon(parsed):
+    item, attachment = parsed
+    return Pokemon(float(item["ts"]), spawnSpecies(item, attachment), attachment.coords, item["text"], item["attachments"][0]["text"], attachment)
+
+class DatabaseWriter(object):
+    """
+    Persist stage handler.  Rows are buffered and written with a single executemany + commit once there are
+    commitRows of them, or the oldest has waited commitSeconds.  The connection is opened lazily so it
+    belongs to the stage thread, close() flushes whatever is left.  A batch that fails is rolled back and
+    retried once, then written a row at a time so a bad row is logged and skipped.  Items are always
+    passed on, a spawn still reaches the manager when its row could not be saved.
+    """
+    __slots__ = "conn pending firstPending commitRows pollInterval rowsWritten rowsDropped commits".split()
+
+    def __init__(self, conn=None, commitRows=None, commitSeconds=None):
+        self.conn = conn
+        self.pending = []
+        self.firstPending = None
+        self.commitRows = commitRows if commitRows is not None else dbCommitRows
+        self.pollInterval = commitSeconds if commitSeconds is not None else dbCommitSeconds
+        self.rowsWritten = 0
+        self.rowsDropped = 0
+        self.commits = 0
+
+    def __call__(self, parsed):
+        try:
+            self.add(eventRow(parsed[0], parsed[1]))
+        except Exception as ex:
+            print "Error saving event! %s" % str(ex)
+            traceback.print_exc()
+        return parsed
+
+    def add(self, row):
+        if not self.pending:
+            self.firstPending = time.time()
+        self.pending.append(row)
+        if len(self.pending) >= self.commitRows:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        """ Commits if the oldest pending row has waited long enough, the stage calls this when idle """
+        if self.pending and time.time() - self.firstPending >= self.pollInterval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        if self.conn is None:
+            self.conn = connectDatabase()
+        rows = self.pending
+        self.pending = []
+        self.firstPending = None
+        try:
+            return self.write(rows)
+        except Exception as ex:
+            print "Error writing %d events, retrying: %s" % ( len(rows), str(ex) )
+        try:
+            return self.write(rows)
+        except Exception as ex:
+            print "Error writing %d events again, writing them one at a time: %s" % ( len(rows), str(ex) )
+        written = 0
+        for row in rows:
+            try:
+                written = written + self.write([ row ])
+            except Exception as ex:
+                self.rowsDropped = self.rowsDropped + 1
+                print "Dropping event that can't be written! row=%s" % str(row)
+                traceback.print_exc()
+        return written
+
+    def write(self, rows):
+        """ Inserts rows as one transaction, rolled back (leaving nothing behind to be written twice) if it fails """
+        try:
+            self.conn.executemany(sqlStatement, rows)
+            SpawnAnalytics.apply(self.conn, rows) # same transaction, the aggregates never disagree with the events
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.rowsWritten = self.rowsWritten + len(rows)
+        self.commits = self.commits + 1
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class IngestStage(threading.Thread):
+    """
+    One step of the ingest pipeline.  Takes items off its inbox, runs handler on them and puts the result
+    on its outbox.  A handler returning None drops the item, an exception is logged and the item dropped.
+    Time spent waiting on a full outbox is counted as backpressure.
+    """
+    STOP = object()
+
+    def __init__(self, name, handler, inbox, outbox):
+        threading.Thread.__init__(self, name="ingest-%s" % name)
+        self.setDaemon(True)
+        self.stageName = name
+        self.handler = handler
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.errors = 0
+        self.maxDepth = 0
+        self.handleSeconds = 0.0
+        self.blockedSeconds = 0.0
+
+    def run(self):
+        # handlers that buffer (DatabaseWriter) get poll() called when nothing arrives for pollInterval
+        pollInterval = getattr(self.handler, "pollInterval", None)
+        while True:
+            try:
+                item = self.inbox.get(True, pollInterval)
+            except Queue.Empty:
+                self.pollHandler()
+                continue
+
+            if item is IngestStage.STOP:
+                if self.outbox is not None:
+                    self.outbox.put(item)
+                break
+            self.maxDepth = max(self.maxDepth, self.inbox.qsize() + 1)
+
+            started = time.time()
+            try:
+                res = self.handler(item)
+            except Exception as ex:
+                self.errors = self.errors + 1
+                print "Error in ingest stage %s! item=%s" % ( self.stageName, str(item) )
+                traceback.print_exc()
                 continue
-            coords = parseCoordinates(item["attachments"][0]['text'])
+            finally:
+                self.handleSeconds = self.handleSeconds + ( time.time() - started )
+            self.processed = self.processed + 1
 
-            if populateDB:
-                writeToDatabase(conn, item, coords)
+            if res is not None and self.outbox is not None:
+                started = time.time()
+                self.outbox.put(res)
+                self.blockedSeconds = self.blockedSeconds + ( time.time() - started )
 
-            pm = Pokemon(float(item["ts"]), item["username"], coords, item["text"], item["attachments"][0]["text"])
-            manager.potentiallyAddPokemonToManager(pm)
+        if hasattr(self.handler, "close"):
+            self.handler.close()
+
+    def pollHandler(self):
+        try:
+            self.handler.poll()
+        except Exception as ex:
+            self.errors = self.errors + 1
+            print "Error polling ingest stage %s!" % self.stageName
+            traceback.print_exc()
+
+    def stats(self):
+        return {
+            "processed"      : self.processed,
+            "errors"         : self.errors,
+            "depth"          : self.inbox.qsize(),
+            "maxDepth"       : self.maxDepth,
+            "handleSeconds"  : self.handleSeconds,
+            "blockedSeconds" : self.blockedSeconds
+        }
+
+class IngestPipeline(object):
+    """
+    reader -> parse -> persist -> classify -> subscribers, each stage on its own thread with bounded queues in between.
+    The classified Pokemon are fanned out to any subscribers and end up on managerQueue, and the Manager
+    thread adds them, so nothing slow (sqlite, google) ever runs on the thread reading from slack.
+    """
+    __slots__ = "stages inbox submitted submitBlockedSeconds".split()
+
+    def __init__(self, managerQueue, persist=None, queueSize=None, subscribers=None):
+        queueSize = queueSize if queueSize is not None else ingestQueueSize
+        persist = persist if persist is not None else populateDB
+        subscribers = subscribers if subscribers is not None else getSubscribers()
+
+        handlers = [ ( "parse", parseSlackItem ) ]
+        if persist:
+            handlers.append(( "persist", DatabaseWriter() ))
+        handlers.append(( "classify", buildPokemon ))
+        if len(subscribers):
+            handlers.append(( "subscribers", subscribers ))
+
+        self.inbox = Queue.Queue(queueSize)
+        self.stages = []
+        inbox = self.inbox
+        for idx, ( name, handler ) in enumerate(handlers):
+            outbox = managerQueue if idx == len(handlers) - 1 else Queue.Queue(queueSize)
+            self.stages.append(IngestStage(name, handler, inbox, outbox))
+            inbox = outbox
+        self.submitted = 0
+        self.submitBlockedSeconds = 0.0
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def submit(self, item):
+        started = time.time()
+        self.inbox.put(item)
+        self.submitBlockedSeconds = self.submitBlockedSeconds + ( time.time() - started )
+        self.submitted = self.submitted + 1
+
+    def stop(self, timeout=None):
+        """ Lets every stage drain what it has, then shuts them down """
+        self.inbox.put(IngestStage.STOP)
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def stats(self):
+        res = [ ( "reader", { "processed" : self.submitted, "depth" : self.inbox.qsize(), "blockedSeconds" : self.submitBlockedSeconds } ) ]
+        for stage in self.stages:
+            res.append(( stage.stageName, stage.stats() ))
+        return res
+
+def mainLoop(pipeline, slack):
+    while True:
+        dataRead = slack.rtm_read()
+        if not dataRead:
+            time.sleep(.05)
+            continue
+        with metricSlackBatch.time():
+            for item in dataRead:
+                if 'bot_id' and 'subtype' and 'attachments' not in item:
+                    metricSlackSkipped.inc()
+                    continue
+                pipeline.submit(item)
+                metricSlackMessages.inc()
 
 if __name__ == "__main__":
     if token is None:
@@ -854,9 +3540,9 @@ if __name__ == "__main__":
 
     slack = connectSlack()
 
-    webToManagerQueue = Queue.Queue() # web requests to manager
+    webToManagerQueue = WakeupQueue() # web requests to manager
     managerToWebQueue = Queue.Queue() # manager responses to web
-    slackToManagerQueue = Queue.Queue() # slack to manager (adding pokemon)
+    slackToManagerQueue = WakeupQueue(ingestQueueSize) # slack to manager (adding pokemon)
 
     print "Starting manager thread"
     manager = Manager(slack, webToManagerQueue, managerToWebQueue, slackToManagerQueue)
@@ -867,21 +3553,30 @@ if __name__ == "__main__":
 
     # XXX query db, re-load manager
 
+    print "Starting ingest pipeline"
+    pipeline = IngestPipeline(slackToManagerQueue).start()
+
     print "Starting http server"
-    websvr = PokemonWebServer(manager, webToManagerQueue, managerToWebQueue)
+    websvr = PokemonWebServer(manager, webToManagerQueue, managerToWebQueue, pipeline)
     websvr.setDaemon(True)
     websvr.start()
     print "Started http server"
 
     failureCount = 0
     print "Begin main loop: %s" % datetime.datetime.now()
-    while True:
-        if failureCount > 5:
-            print "Too many errors, shutting down!"
-        try:
-            mainLoop(manager, slack, conn, slackToManagerQueue)
-        except Exception as ex:
-            failureCount = failureCount + 1
-            traceback.print_exc()
-            print "Reconnecting to slack!"
-            slack = connectSlack()
+    try:
+        while True:
+            if failureCount > 5:
+                print "Too many errors, shutting down!"
+            try:
+                mainLoop(pipeline, slack)
+            except Exception as ex:
+                failureCount = failureCount + 1
+                traceback.print_exc()
+                print "Reconnecting to slack!"
+                slack = connectSlack()
+    except KeyboardInterrupt:
+        print "Shutting down, flushing the ingest pipeline"
+        pipeline.stop(10)
+        if notificationDispatcher is not None:
+            notificationDispatcher.stop(10)
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+"""
+Columnar archives of the event table, and a replay tool
+
+A season of spawns is millions of event rows.  Closed time ranges (whole days) can be exported into one
+archive file and, optionally, deleted from the database.  An archive is read through mmap, the columns
+are numpy arrays straight over the file, so looking at a range of it reads only that range.
+
+Usage:
+    python watcher_archive.py export season1.pkarch [--from 2016-08-01] [--to 2016-09-01] [--db poke_events.db] [--delete]
+    python watcher_archive.py info season1.pkarch
+    python watcher_archive.py replay season1.pkarch [--from 2016-08-06] [--to 2016-08-07] [--speed 60] [--at lat,long] [--web]
+
+--to defaults to midnight today, so only whole days are exported.  replay feeds the events, in order, to a
+Manager (no slack, google, iCloud or texting) --speed times faster than they happened, despawns included.
+Distances are haversine from --at, by default the middle of the replayed spawns.
+
+File layout, everything little endian:
+    "PKARCH1\\n"
+    columns, each starting on a 64 byte boundary:
+        time       int64, sorted
+        lat, long  float64
+        species    uint16, an index into the footer's species list
+        linkEnd    int64, end offset of each link in the links blob (a link starts where the previous ends)
+        notesEnd   int64, the same for notes
+        links      utf-8 blob
+        notes      utf-8 blob
+    footer, JSON: { "version", "rows", "start", "end", "species", "columns" : { name : [ dtype, offset, count ] } }
+    footer length, int64
+    "PKARCH1\\n"
+"""
+
+import json
+import mmap
+import os
+import Queue
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+import watcher
+from watcher import Current, Manager, Pokemon, TraceLocationProvider, WakeupQueue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = "PKARCH1\n"
+ALIGN = 64
+FIXED_COLUMNS = [ ( "time", "<i8" ), ( "lat", "<f8" ), ( "long", "<f8" ), ( "species", "<u2" ), ( "linkEnd", "<i8" ), ( "notesEnd", "<i8" ) ]
+
+def requireNumpy():
+    if numpy is None:
+        raise Exception("numpy is required for event archives")
+
+def aligned(offset):
+    return ( offset + ALIGN - 1 ) // ALIGN * ALIGN
+
+def parseDay(value):
+    """ YYYY-MM-DD as a local midnight timestamp """
+    return int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+
+def todayMidnight():
+    return parseDay(time.strftime("%Y-%m-%d"))
+
+def exportArchive(conn, path, start, end, chunkSize=10000):
+    """
+    Writes every event with start <= time < end to path, returns the row count.  Rows are streamed, the
+    fixed width columns are written through a memmap of the file and the text straight after them.
+    """
+    requireNumpy()
+    rows = conn.execute("select count(*) from event where time >= ? and time < ?", ( start, end )).fetchone()[0]
+
+    columns = {}
+    offset = aligned(len(MAGIC))
+    for name, dtype in FIXED_COLUMNS:
+        count = rows + 1 if name in ( "linkEnd", "notesEnd" ) else rows
+        columns[name] = [ dtype, offset, count ]
+        offset = aligned(offset + count * numpy.dtype(dtype).itemsize)
+    fixedEnd = offset
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.truncate(fixedEnd)
+
+    arrays = {}
+    if rows:
+        for name, ( dtype, offset, count ) in columns.items():
+            arrays[name] = numpy.memmap(path, dtype=dtype, mode="r+", offset=offset, shape=( count, ))
+        arrays["linkEnd"][0] = 0
+        arrays["notesEnd"][0] = 0
+
+    species = {}
+    links = []
+    notes = []
+    linkSize = 0
+    notesSize = 0
+    idx = 0
+    cur = conn.execute("select time, type, lat, long, link, notes from event where time >= ? and time < ? order by time", ( start, end ))
+    while True:
+        chunk = cur.fetchmany(chunkSize)
+        if not chunk:
+            break
+        for eventTime, name, lat, lon, link, note in chunk:
+            name = name.lower()
+            code = species.get(name)
+            if code is None:
+                code = species[name] = len(species)
+            link = ( link or u"" ).encode("utf-8")
+            note = ( note or u"" ).encode("utf-8")
+            linkSize = linkSize + len(link)
+            notesSize = notesSize + len(note)
+            links.append(link)
+            notes.append(note)
+            arrays["time"][idx] = eventTime
+            arrays["lat"][idx] = lat
+            arrays["long"][idx] = lon
+            arrays["species"][idx] = code
+            arrays["linkEnd"][idx + 1] = linkSize
+            arrays["notesEnd"][idx + 1] = notesSize
+            idx = idx + 1
+    if len(species) > 65535:
+        raise Exception("Too many species for a uint16 column: %d" % len(species))
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    with open(path, "r+b") as f:
+        f.seek(fixedEnd)
+        columns["links"] = [ "|S1", fixedEnd, linkSize ]
+        f.write("".join(links))
+        columns["notes"] = [ "|S1", fixedEnd + linkSize, notesSize ]
+        f.write("".join(notes))
+        footer = json.dumps({
+            "version" : 1,
+            "rows"    : rows,
+            "start"   : start,
+            "end"     : end,
+            "species" : [ name for name, _ in sorted(species.items(), key=lambda item: item[1]) ],
+            "columns" : columns
+        })
+        f.write(footer)
+        f.write(struct.pack("<q", len(footer)))
+        f.write(MAGIC)
+    return rows
+
+class EventArchive(object):
+    """
+    A read only, memory mapped archive.  time, lat, long and species are numpy arrays over the file, rows
+    are only decoded when asked for.
+    """
+    def __init__(self, path):
+        requireNumpy()
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC or self.map[-len(MAGIC):] != MAGIC:
+            raise Exception("%s is not an event archive" % path)
+        footerSize = struct.unpack("<q", self.map[-len(MAGIC) - 8:-len(MAGIC)])[0]
+        footerStart = len(self.map) - len(MAGIC) - 8 - footerSize
+        self.footer = json.loads(self.map[footerStart:footerStart + footerSize])
+        if self.footer["version"] != 1:
+            raise Exception("Unsupported archive version %s" % self.footer["version"])
+        self.rows = self.footer["rows"]
+        self.start = self.footer["start"]
+        self.end = self.footer["end"]
+        self.speciesNames = self.footer["species"]
+        self.speciesCodes = dict([ ( name, code ) for code, name in enumerate(self.speciesNames) ])
+
+        columns = self.footer["columns"]
+        self.time = self.column(columns["time"])
+        self.lat = self.column(columns["lat"])
+        self.long = self.column(columns["long"])
+        self.species = self.column(columns["species"])
+        self.linkEnd = self.column(columns["linkEnd"])
+        self.notesEnd = self.column(columns["notesEnd"])
+        self.linksStart = columns["links"][1]
+        self.notesStart = columns["notes"][1]
+
+    def column(self, spec):
+        dtype, offset, count = spec
+        if count == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.frombuffer(self.map, dtype=dtype, count=count, offset=offset)
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        # the numpy views must be gone before the map can be closed
+        self.time = self.lat = self.long = self.species = self.linkEnd = self.notesEnd = None
+        self.map.close()
+        self.file.close()
+
+    def indexRange(self, start=None, end=None):
+        """ ( lo, hi ), the rows with start <= time < end """
+        lo = 0 if start is None else int(numpy.searchsorted(self.time, start, "left"))
+        hi = self.rows if end is None else int(numpy.searchsorted(self.time, end, "left"))
+        return lo, hi
+
+    def speciesMask(self, name, lo=0, hi=None):
+        """ Boolean array over rows lo:hi, True where the species is name """
+        code = self.speciesCodes.get(name.lower())
+        species = self.species[lo:hi]
+        if code is None:
+            return numpy.zeros(len(species), dtype=bool)
+        return species == code
+
+    def getLink(self, idx):
+        return self.map[self.linksStart + int(self.linkEnd[idx]):self.linksStart + int(self.linkEnd[idx + 1])].decode("utf-8")
+
+    def getNotes(self, idx):
+        return self.map[self.notesStart + int(self.notesEnd[idx]):self.notesStart + int(self.notesEnd[idx + 1])].decode("utf-8")
+
+    def iterRows(self, start=None, end=None):
+        """ ( time, type, lat, long, link, notes ) in time order, the same columns repopulateDB selects """
+        lo, hi = self.indexRange(start, end)
+        for idx in xrange(lo, hi):
+            yield ( int(self.time[idx]), self.speciesNames[self.species[idx]], float(self.lat[idx]), float(self.long[idx]), self.getLink(idx), self.getNotes(idx) )
+
+def deleteExported(conn, start, end, rows):
+    """ Drops the archived range from the event table, if it still holds exactly what was exported """
+    current = conn.execute("select count(*) from event where time >= ? and time < ?", ( start, end )).fetchone()[0]
+    if current != rows:
+        raise Exception("The range now holds %d events, %d were archived, not deleting" % ( current, rows ))
+    conn.execute("delete from event where time >= ? and time < ?", ( start, end ))
+    conn.commit()
+
+def replayArchive(archive, queue, start=None, end=None, speed=60.0, clock=time.time, sleep=time.sleep):
+    """
+    Puts a Pokemon on queue for every archived event between start and end, speed times faster than they
+    happened.  Spawn times are shifted so the first one is now, the caller scales despawnSeconds to match.
+    Returns how many were queued.
+    """
+    lo, hi = archive.indexRange(start, end)
+    if lo == hi:
+        return 0
+    first = int(archive.time[lo])
+    began = clock()
+    count = 0
+    for eventTime, name, lat, lon, link, notes in archive.iterRows(start, end):
+        due = began + ( eventTime - first ) / speed
+        delay = due - clock()
+        if delay > 0:
+            sleep(delay)
+        # text is not saved in the DB (and so not archived) as the notes, the same as repopulateDB
+        queue.put(Pokemon(due, name, [ lat, lon ], None, link))
+        count = count + 1
+    return count
+
+def runReplay(path, start=None, end=None, speed=60.0, web=False, at=None):
+    """ Replays the archive into a fresh Manager, with the phone fixed at at (default the middle of the replayed spawns) """
+    Current.enableSlack = False
+    Current.enableGoogleAndICloud = False
+    Current.enableTextMessages = False
+    Current.debug = False
+    watcher.despawnSeconds = watcher.despawnSeconds / speed
+    watcher.managerRefreshTime = max(1, watcher.managerRefreshTime / speed)
+
+    archive = EventArchive(path)
+    lo, hi = archive.indexRange(start, end)
+    if at is None and hi > lo:
+        at = [ float(numpy.median(archive.lat[lo:hi])), float(numpy.median(archive.long[lo:hi])) ]
+    Current.phoneCoord = at
+    incoming = WakeupQueue()
+    webQueue = WakeupQueue()
+    managerToWebQueue = Queue.Queue()
+    manager = Manager(None, webQueue, managerToWebQueue, incoming, TraceLocationProvider([ ( 0, at[0], at[1] ) ] if at else []))
+    manager.setDaemon(True)
+    manager.start()
+    if web:
+        websvr = watcher.PokemonWebServer(manager, webQueue, managerToWebQueue)
+        websvr.setDaemon(True)
+        websvr.start()
+
+    print "Replaying %d events at %gx" % ( hi - lo, speed )
+    started = time.time()
+    count = replayArchive(archive, incoming, start, end, speed)
+    while not incoming.empty():
+        time.sleep(.05)
+    elapsed = time.time() - started
+    snap = manager.getSnapshot()
+    print "Replayed %d events in %.1fs, %d active, %d nearby, %d duplicates merged, %d unreachable dropped" % (
+        count, elapsed, len(snap.active), len(snap.nearby), manager.duplicateCount, manager.schedulerStats["unreachable"] )
+    archive.close()
+    return count
+
+def printInfo(path):
+    archive = EventArchive(path)
+    print "%s: %d events from %s to %s, %d species, %.1f MB" % ( path, len(archive), time.ctime(archive.start), time.ctime(archive.end), len(archive.speciesNames), os.path.getsize(path) / 1e6 )
+    if len(archive):
+        counts = numpy.bincount(archive.species, minlength=len(archive.speciesNames))
+        for code in numpy.argsort(counts)[::-1][:10]:
+            print "    %-16s %d" % ( archive.speciesNames[code].encode("utf-8"), counts[code] )
+    archive.close()
+
+def popOption(args, name, default=None):
+    if name in args:
+        idx = args.index(name)
+        value = args[idx + 1]
+        del args[idx:idx + 2]
+        return value
+    return default
+
+def popFlag(args, name):
+    if name in args:
+        args.remove(name)
+        return True
+    return False
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    db = popOption(args, "--db", watcher.dbname)
+    start = popOption(args, "--from")
+    end = popOption(args, "--to")
+    speed = float(popOption(args, "--speed", 60))
+    delete = popFlag(args, "--delete")
+    web = popFlag(args, "--web")
+    at = popOption(args, "--at")
+    if len(args) != 2 or args[0] not in ( "export", "info", "replay" ):
+        print __doc__
+        sys.exit(1)
+    command, path = args
+
+    if command == "export":
+        conn = sqlite3.connect(db)
+        start = parseDay(start) if start else ( conn.execute("select min(time) from event").fetchone()[0] or 0 )
+        end = parseDay(end) if end else todayMidnight()
+        rows = exportArchive(conn, path, start, end)
+        print "Archived %d events to %s" % ( rows, path )
+        if delete and rows:
+            deleteExported(conn, start, end, rows)
+            print "Deleted them from %s" % db
+        conn.close()
+    elif command == "info":
+        printInfo(path)
+    else:
+        at = [ float(elem) for elem in at.split(",") ] if at else None
+        runReplay(path, parseDay(start) if start else None, parseDay(end) if end else None, speed, web, at)
@@ -0,0 +1,1015 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the hot paths in watcher.py
+
+Nothing here talks to Slack, Google or iCloud, everything is generated locally: FakeSlackClient for slack,
+StandInGoogle for the distance matrix and static maps, TraceLocationProvider over generateTrace() for the phone.
+
+Usage:
+    python watcher_bench.py             # run everything
+    python watcher_bench.py haversine   # run only the named benchmarks
+    python watcher_bench.py --messages recorded.json ingest   # replay recorded slack messages (a JSON list)
+    python watcher_bench.py --clients 1,16,64 webserver      # dashboard load test at these concurrency levels
+    python watcher_bench.py --rates 0,100,500 endtoend        # slack -> pipeline -> manager -> dashboard at these msgs/sec
+"""
+
+import asyncore
+import BaseHTTPServer
+import httplib
+import json
+import os
+import Queue
+import random
+import re
+import shutil
+import smtpd
+import smtplib
+import socket
+import SocketServer
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from math import cos, radians
+from urlparse import parse_qs, urlparse
+
+import bottle
+import watcher
+from watcher_archive import EventArchive, exportArchive
+from watcher import SpawnAnalytics, StaticMapRenderer, AdaptiveLocationPoller, Current, DatabaseWriter, NotificationDispatcher, TraceLocationProvider, SmtpSession, DistanceBatch, DistanceCache, DistanceMatrixClient, IngestPipeline, Manager, Subscriber, SubscriberRegistry, Pokemon, PokemonWebServer, WakeupQueue, buildPokemon, getStaticMapRenderer, haversine, mainLoop, makeWebServer, parseAttachment, parseCoordinates, parseSlackItem, renderMapLink, writeToDatabase
+
+CENTER = [ 40.7580, -73.9855 ]
+SPECIES = [ "pidgey", "rattata", "zubat", "weedle", "spearow", "drowzee", "eevee", "dratini", "snorlax", "dragonite", "lapras", "muk" ]
+
+# Set from --messages, a JSON list of slack RTM message dicts
+recordedMessages = None
+
+# Concurrent dashboard clients for the webserver benchmark, set from --clients
+webClients = ( 1, 8, 32 )
+
+# Slack messages per second for the endtoend benchmark, 0 for as fast as they can be read, set from --rates
+feedRates = ( 0, 250 )
+
+def quiet():
+    Current.debug = False
+    Current.testing = True
+    Current.enableSlack = False
+    Current.enableGoogleAndICloud = False
+    Current.enableTextMessages = False
+
+def timed(func, repeat=3):
+    """ Best of N wall clock, in seconds """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+class StandInGoogleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers distance matrix requests with crow flies distances, 3 minutes a mile """
+    protocol_version = "HTTP/1.1" # keep-alive
+    wbufsize = -1 # headers and body go out in one write, or delayed ACKs stall every keep-alive request
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connectionCount = self.server.connectionCount + 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        self.server.requestCount = self.server.requestCount + 1
+        if parsed.path.endswith("/distancematrix/json"):
+            self.server.distanceRequests = self.server.distanceRequests + 1
+            body = json.dumps(StandInGoogleHandler.distanceMatrix(query["origins"][0], query["destinations"][0].split("|")))
+            self.reply(200, "application/json", body)
+        elif parsed.path.endswith("/staticmap"):
+            self.server.staticMapRequests = self.server.staticMapRequests + 1
+            time.sleep(self.server.staticMapDelay) # rendering a map is the slow google call
+            body = "\x89PNG stand-in " + parsed.query # the same map for the same query
+            self.reply(200, "image/png", body)
+        else:
+            self.reply(404, "text/plain", "not found")
+
+    def reply(self, code, contentType, body):
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def distanceMatrix(origin, destinations):
+        lat, lon = [ float(x) for x in origin.split(",") ]
+        elements = []
+        for dest in destinations:
+            dlat, dlon = [ float(x) for x in dest.split(",") ]
+            miles = haversine(lat, dlat, lon, dlon)
+            elements.append({
+                "status"   : "OK",
+                "distance" : { "text" : "%.1f mi" % miles, "value" : int(miles * 1609.344) },
+                "duration" : { "text" : "%d mins" % max(1, int(miles * 3)), "value" : int(miles * 180) }
+            })
+        return { "status" : "OK", "rows" : [ { "elements" : elements } ] }
+
+class StandInGoogle(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local stand-in for the google endpoints, run with start() and point watcher at baseUrl() """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ( "127.0.0.1", 0 ), StandInGoogleHandler)
+        self.requestCount = 0
+        self.connectionCount = 0
+        self.distanceRequests = 0
+        self.staticMapRequests = 0
+        self.staticMapDelay = .05
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def baseUrl(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def reset(self):
+        self.requestCount = 0
+        self.connectionCount = 0
+        self.distanceRequests = 0
+        self.staticMapRequests = 0
+
+class FeedFinished(Exception):
+    pass
+
+class FakeSlackClient(object):
+    """
+    Stands in for SlackClient: rtm_read() hands out messages at rate per second (None for as fast as they
+    are read), restamped with the time they are delivered, and then raises FeedFinished once finish() is
+    called.  api_call() is answered locally and remembered in calls.
+    """
+    def __init__(self, messages, rate=None, batchSize=50, clock=time.time):
+        self.messages = messages
+        self.rate = rate
+        self.batchSize = batchSize
+        self.clock = clock
+        self.started = None
+        self.delivered = 0
+        self.reads = 0
+        self.calls = []
+        self.drained = threading.Event()
+        self.finished = False
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        if self.finished:
+            raise FeedFinished()
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        self.reads = self.reads + 1
+        due = len(self.messages) if self.rate is None else int(( now - self.started ) * self.rate) + 1
+        end = min(len(self.messages), due, self.delivered + self.batchSize)
+        res = []
+        for item in self.messages[self.delivered:end]:
+            item = dict(item)
+            item["ts"] = "%.6f" % now
+            res.append(item)
+        self.delivered = end
+        if self.delivered == len(self.messages):
+            self.drained.set()
+        return res
+
+    def finish(self):
+        self.finished = True
+
+    def api_call(self, method, **kw):
+        self.calls.append(( method, kw ))
+        if method == "auth.test":
+            return { "ok" : True, "user_id" : "U0BENCH", "user" : "bench" }
+        return { "ok" : True }
+
+class StandInSmtp(smtpd.SMTPServer):
+    """ A local SMTP server that keeps what it is sent in messages, no TLS or auth, run with start() """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ( "127.0.0.1", 0 ), None)
+        self.messages = []
+        self.connectionCount = 0
+
+    def handle_accept(self):
+        self.connectionCount = self.connectionCount + 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop, kwargs={ "timeout" : .05 })
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def reset(self):
+        self.messages = []
+        self.connectionCount = 0
+
+def percentile(values, pct):
+    """ values must be sorted """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(( "127.0.0.1", 0 ))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def generatePokemon(count, spread=.2, seed=1):
+    rnd = random.Random(seed)
+    res = []
+    now = time.time()
+    for _ in xrange(count):
+        coords = [ CENTER[0] + rnd.uniform(-spread, spread), CENTER[1] + rnd.uniform(-spread, spread) ]
+        pm = Pokemon(now, "pidgey", coords, None, "<http://maps.google.com/maps?q=%f,%f|Open in Google Maps>" % ( coords[0], coords[1] ))
+        if rnd.random() < .8:
+            pm.lastCoordCheck = [ CENTER[0] + rnd.uniform(-.01, .01), CENTER[1] + rnd.uniform(-.01, .01) ]
+        res.append(pm)
+    return res
+
+def generateTrace(seed=1):
+    """
+    A GPS trace with a fix every second, ( seconds, lat, long ): 20 minutes standing still (with jitter),
+    10 walking north at 3 mph, 10 driving east at 30 mph with a 2 minute outage, then 20 standing still
+    """
+    rnd = random.Random(seed)
+    milesPerDegree = 69.0
+    lat, lon = CENTER
+    res = []
+    for second in xrange(3600):
+        if 1200 <= second < 1800:
+            lat = lat + 3 / 3600.0 / milesPerDegree
+        elif 1800 <= second < 2400:
+            lon = lon + 30 / 3600.0 / ( milesPerDegree * cos(radians(lat)) )
+        if 2000 <= second < 2120:
+            res.append(( second, None, None ))
+        else:
+            res.append(( second, lat + rnd.uniform(-.0001, .0001), lon + rnd.uniform(-.0001, .0001) ))
+    return res
+
+def generateMessages(count, spread=.2, seed=1, start=None):
+    """ Slack RTM messages shaped like the ones the pokemon bot posted, one second apart """
+    if recordedMessages is not None:
+        return [ recordedMessages[idx % len(recordedMessages)] for idx in xrange(count) ]
+
+    rnd = random.Random(seed)
+    start = time.time() if start is None else start
+    res = []
+    for idx in xrange(count):
+        name = rnd.choice(SPECIES).capitalize()
+        lat = CENTER[0] + rnd.uniform(-spread, spread)
+        lon = CENTER[1] + rnd.uniform(-spread, spread)
+        iv = rnd.choice([ 100.0, round(rnd.uniform(20, 99.9), 1) ])
+        res.append({
+            "type"        : "message",
+            "subtype"     : "bot_message",
+            "bot_id"      : "B0PKMN",
+            "username"    : name,
+            "ts"          : "%.6f" % ( start + idx ),
+            "text"        : "%s (%s%%)" % ( name, iv ),
+            "attachments" : [ { "text" : "%s (%s%%) until %s\n<http://maps.google.com/maps?q=%f,%f|Open in Google Maps>" % ( name, iv, time.strftime("%I:%M:%S%p", time.localtime(start + idx + 900)), lat, lon ) } ]
+        })
+    return res
+
+def benchHaversine(sizes=( 1000, 10000, 100000 )):
+    """ Scalar haversine per pokemon vs one DistanceBatch.refresh() """
+    if watcher.numpy is None:
+        print "numpy is not installed, DistanceBatch will use the scalar fallback"
+
+    phone = [ CENTER[0] + .003, CENTER[1] - .002 ]
+    print "%-8s %12s %12s %8s" % ( "spawns", "scalar(ms)", "batch(ms)", "speedup" )
+    for size in sizes:
+        mons = generatePokemon(size)
+        batch = DistanceBatch()
+        for pm in mons:
+            batch.add(pm)
+
+        def scalar():
+            for pm in mons:
+                pm.crowDistance = haversine(phone[0], pm.coords[0], phone[1], pm.coords[1])
+                check = pm.lastCoordCheck
+                pm.movedDistance = None if check is None else haversine(phone[0], check[0], phone[1], check[1])
+
+        scalarTime = timed(scalar)
+        expected = [ ( pm.crowDistance, pm.movedDistance ) for pm in mons ]
+        batchTime = timed(lambda: batch.refresh(phone))
+
+        for pm, ( crow, moved ) in zip(mons, expected):
+            assert abs(pm.crowDistance - crow) < 1e-6, "crow distance mismatch for %s" % str(pm)
+            assert ( moved is None and pm.movedDistance is None ) or abs(pm.movedDistance - moved) < 1e-6, "moved distance mismatch for %s" % str(pm)
+
+        print "%-8d %12.2f %12.2f %7.1fx" % ( size, scalarTime * 1000, batchTime * 1000, scalarTime / batchTime )
+
+def benchDistanceMatrix(sizes=( 25, 100, 500 )):
+    """ One urlopen per pokemon (the old path) vs batched requests over a pooled session """
+    google = StandInGoogle().start()
+    url = google.baseUrl() + "/maps/api/distancematrix/json"
+    phone = [ CENTER[0] + .003, CENTER[1] - .002 ]
+    print "%-8s %10s %10s %10s | %10s %10s %10s" % ( "spawns", "old(ms)", "requests", "conns", "batch(ms)", "requests", "conns" )
+    for size in sizes:
+        mons = generatePokemon(size)
+
+        google.reset()
+        start = time.time()
+        for pm in mons:
+            old = "%s?origins=%f,%f&destinations=%s&mode=driving&units=imperial&key=" % ( url, phone[0], phone[1], pm.coordStr )
+            pm.handleDistanceResult(urllib.urlopen(old).read())
+        oldTime = time.time() - start
+        oldCounts = ( google.requestCount, google.connectionCount )
+        expected = [ ( pm.distanceToTarget, pm.timeToTarget ) for pm in mons ]
+
+        google.reset()
+        client = DistanceMatrixClient(url=url)
+        start = time.time()
+        resolved = client.resolve(phone, mons)
+        batchTime = time.time() - start
+        assert resolved == size, "only resolved %d of %d" % ( resolved, size )
+        assert expected == [ ( pm.distanceToTarget, pm.timeToTarget ) for pm in mons ], "batched results differ"
+
+        client.session.close()
+
+        print "%-8d %10.1f %10d %10d | %10.1f %10d %10d" % ( size, oldTime * 1000, oldCounts[0], oldCounts[1], batchTime * 1000, google.requestCount, google.connectionCount )
+    google.shutdown()
+    google.server_close()
+
+def benchDistanceCache(size=200, ticks=20):
+    """ A jittering phone re-resolving the same spawns each tick, with and without the result cache """
+    google = StandInGoogle().start()
+    url = google.baseUrl() + "/maps/api/distancematrix/json"
+    mons = generatePokemon(size)
+    rnd = random.Random(3)
+    phones = [ [ CENTER[0] + rnd.uniform(-.0005, .0005), CENTER[1] + rnd.uniform(-.0005, .0005) ] for _ in range(ticks) ]
+
+    print "%-10s %10s %10s %8s %8s %12s" % ( "cache", "time(ms)", "requests", "hits", "misses", "saved(ms)" )
+    for label, cache in ( ( "none", DistanceCache(maxSize=0) ), ( "default", DistanceCache() ) ):
+        google.reset()
+        client = DistanceMatrixClient(url=url, cache=cache)
+        start = time.time()
+        for phone in phones:
+            client.resolve(phone, mons)
+        elapsed = time.time() - start
+        client.session.close()
+        stats = cache.stats()
+        print "%-10s %10.1f %10d %8d %8d %12.1f" % ( label, elapsed * 1000, google.requestCount, stats["hits"], stats["misses"], stats["secondsSaved"] * 1000 )
+    google.shutdown()
+    google.server_close()
+
+def benchParse(count=20000):
+    """ Attachment text to coordinates, IV and perfect: the old urlparse/parse_qs/regex chain vs parseAttachment """
+    texts = [ item["attachments"][0]["text"] for item in generateMessages(count) ]
+    oldIvPattern = re.compile("^.*\\(([0-9][0-9]\\.?[0-9]?)%\\)")
+    oldPerfectPattern = "^.*\\(9[0-9].[0-9]%.*$"
+
+    def old():
+        res = []
+        for text in texts:
+            coords = parseCoordinates(text)
+            coordStr = "%f,%f" % ( coords[0], coords[1] )
+            perfect = "100%" in text or re.match(oldPerfectPattern, text) is not None
+            mtch = oldIvPattern.match(renderMapLink(text)) # the dashboard did this on every render
+            res.append(( coords, float(mtch.group(1)) if mtch else None, perfect ))
+        return res
+
+    def new():
+        return [ parseAttachment(text) for text in texts ]
+
+    oldTime = timed(old)
+    newTime = timed(new)
+
+    # the old patterns missed "(100.0%)", both for the IV and for perfect, so only compare what they found
+    rules = watcher.getRules()
+    missed = 0
+    for ( coords, iv, perfect ), parsed in zip(old(), new()):
+        assert coords == parsed.coords, "coordinates differ %s vs %s" % ( coords, parsed.coords )
+        assert iv is None or iv == parsed.iv, "iv differs %s vs %s" % ( iv, parsed.iv )
+        assert not perfect or rules.isPerfect(parsed.iv), "perfect differs for iv %s" % parsed.iv
+        if perfect != rules.isPerfect(parsed.iv):
+            missed = missed + 1
+
+    print "%-8s %12s %12s %12s %8s %14s" % ( "texts", "old(ms)", "new(ms)", "new(us/msg)", "speedup", "old missed" )
+    print "%-8d %12.1f %12.1f %12.2f %7.1fx %14d" % ( count, oldTime * 1000, newTime * 1000, newTime * 1e6 / count, oldTime / newTime, missed )
+
+def benchAnalytics(count=50000, days=30):
+    """ "Top cells for dragonite 18:00-21:00": scanning the event table vs the SpawnAnalytics aggregates """
+    rnd = random.Random(11)
+    start = time.time() - days * 86400
+    messages = generateMessages(count, spread=.1)
+    for item in messages:
+        item["ts"] = "%.6f" % ( start + rnd.uniform(0, days * 86400) )
+    tmpDir = tempfile.mkdtemp()
+    try:
+        watcher.dbname = os.path.join(tmpDir, "analytics.db")
+        writer = DatabaseWriter()
+        begin = time.time()
+        for item in messages:
+            writer(parseSlackItem(item))
+        writer.close()
+        ingestTime = time.time() - begin
+
+        conn = sqlite3.connect(watcher.dbname)
+        analytics = SpawnAnalytics(conn)
+
+        def scan():
+            totals = {}
+            for eventTime, lat, lon in conn.execute("select time, lat, long from event where lower(type) = 'dragonite'"):
+                if 18 <= time.localtime(eventTime).tm_hour < 21:
+                    cell = SpawnAnalytics.cellFor(lat, lon)
+                    totals[cell] = totals.get(cell, 0) + 1
+            return sorted(totals.values(), reverse=True)[:10]
+
+        expected = scan()
+        found = [ total for _, _, total in analytics.topCells("dragonite", 18, 21, 10) ]
+        assert found == expected, "aggregates disagree with a scan: %s vs %s" % ( found, expected )
+
+        scanTime = timed(scan)
+        queryTime = timed(lambda: analytics.topCells("dragonite", 18, 21, 10))
+        conn.close()
+
+        print "%-8s %14s %10s %12s %8s" % ( "events", "ingest(r/s)", "scan(ms)", "query(ms)", "speedup" )
+        print "%-8d %14.0f %10.2f %12.3f %7.0fx" % ( count, count / ingestTime, scanTime * 1000, queryTime * 1000, scanTime / queryTime )
+    finally:
+        shutil.rmtree(tmpDir)
+
+def benchArchive(count=200000, days=30):
+    """ A day of spawns by species: fetchall() from the event table vs a memory mapped archive """
+    rnd = random.Random(13)
+    names = [ "Pidgey", "Rattata", "Dragonite", "Snorlax", "Lapras", "Eevee" ]
+    start = int(time.time()) - days * 86400
+    end = start + days * 86400
+    rows = [ ( start + rnd.randint(0, days * 86400 - 1), rnd.choice(names), "<http://maps.google.com/maps?q=%d|Open in Google Maps>" % i,
+               37.7 + rnd.random() * .1, -122.5 + rnd.random() * .1, None ) for i in xrange(count) ]
+    tmpDir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(os.path.join(tmpDir, "archive.db"))
+        watcher.migrateDatabase(conn)
+        conn.executemany(watcher.sqlStatement, rows)
+        conn.commit()
+        path = os.path.join(tmpDir, "events.pkarch")
+        begin = time.time()
+        exportArchive(conn, path, start, end)
+        exportTime = time.time() - begin
+        archive = EventArchive(path)
+        dayStart = start + ( days // 2 ) * 86400
+        dayEnd = dayStart + 86400
+
+        def query():
+            totals = {}
+            for eventTime, name, lat, lon, link, notes in conn.execute("select time, type, lat, long, link, notes from event where time >= ? and time < ?", ( dayStart, dayEnd )).fetchall():
+                totals[name.lower()] = totals.get(name.lower(), 0) + 1
+            return totals
+
+        def mapped():
+            lo, hi = archive.indexRange(dayStart, dayEnd)
+            counts = watcher.numpy.bincount(archive.species[lo:hi], minlength=len(archive.speciesNames))
+            return dict([ ( name, int(total) ) for name, total in zip(archive.speciesNames, counts) if total ])
+
+        assert query() == mapped(), "archive disagrees with the event table"
+        queryTime = timed(query)
+        mappedTime = timed(mapped)
+        archive.close()
+        conn.close()
+
+        print "%-8s %12s %10s %10s %12s %8s" % ( "events", "export(r/s)", "db(MB)", "file(MB)", "query(ms)", "mmap(ms)" )
+        print "%-8d %12.0f %10.1f %10.1f %12.2f %8.3f" % ( count, count / exportTime, os.path.getsize(os.path.join(tmpDir, "archive.db")) / 1e6,
+                                                         os.path.getsize(path) / 1e6, queryTime * 1000, mappedTime * 1000 )
+    finally:
+        shutil.rmtree(tmpDir)
+
+def benchNotify(bursts=10, perBurst=5):
+    """ Texts for bursts of spawns: a new SMTP connection per text on the caller's thread vs the dispatcher """
+    smtp = StandInSmtp().start()
+    alerts = []
+    for burst in xrange(bursts):
+        for idx in xrange(perBurst):
+            spot = idx % ( perBurst - 1 ) # the last one in each burst repeats the first
+            name = SPECIES[( burst + spot ) % len(SPECIES)]
+            coords = [ CENTER[0] + burst * .01, CENTER[1] + spot * .01 ]
+            alerts.append(( burst, name, coords, "<http://maps.google.com/maps?q=%f,%f|Open in Google Maps>" % ( coords[0], coords[1] ) ))
+
+    print "%-12s %14s %8s %8s %8s %10s" % ( "path", "caller(ms)", "alerts", "texts", "conns", "total(ms)" )
+
+    # old path, connect, send, quit for every alert
+    smtp.reset()
+    start = time.time()
+    for burst, name, coords, link in alerts:
+        server = smtplib.SMTP("127.0.0.1", smtp.port())
+        server.sendmail("from@example.com", "to@example.com", "Subject: %s\n\n%s\n" % ( name, link ))
+        server.quit()
+    oldTime = time.time() - start
+    while len(smtp.messages) < len(alerts):
+        time.sleep(.01)
+    print "%-12s %14.1f %8d %8d %8d %10.1f" % ( "per-text", oldTime * 1000, len(alerts), len(smtp.messages), smtp.connectionCount, oldTime * 1000 )
+
+    smtp.reset()
+    dispatcher = NotificationDispatcher(SmtpSession("127.0.0.1", smtp.port(), startTls=False, user=""), coalesceSeconds=.05, minInterval=0)
+    dispatcher.start()
+    callerTime = 0.0
+    start = time.time()
+    for burst in xrange(bursts):
+        for _, name, coords, link in [ alert for alert in alerts if alert[0] == burst ]:
+            submitted = time.time()
+            dispatcher.submit(name, "%s (100%%)" % name, link, NotificationDispatcher.spawnKey(name, coords))
+            callerTime = callerTime + time.time() - submitted
+        time.sleep(.1) # bursts are further apart than the coalesce window
+    dispatcher.stop(10)
+    elapsed = time.time() - start
+    stats = dispatcher.getStats()
+    assert stats["texts"] == bursts, "expected a text per burst, got %d" % stats["texts"]
+    assert stats["duplicates"] == bursts, "expected a duplicate per burst, got %d" % stats["duplicates"]
+    print "%-12s %14.1f %8d %8d %8d %10.1f" % ( "dispatcher", callerTime * 1000, stats["alertsSent"], len(smtp.messages), smtp.connectionCount, elapsed * 1000 )
+    smtp.close()
+
+def benchLocation():
+    """ A fix every managerRefreshTime seconds vs AdaptiveLocationPoller, replaying generateTrace() in simulated time """
+    trace = generateTrace()
+    clock = [ 0.0 ]
+
+    def truth(second):
+        fix = trace[int(second)]
+        return fix if fix[1] is not None else None
+
+    print "%-10s %8s %8s %14s %14s" % ( "policy", "polls", "errors", "mean lag(mi)", "max lag(mi)" )
+    for label in ( "fixed", "adaptive" ):
+        provider = TraceLocationProvider(trace, clock=lambda: clock[0])
+        poller = AdaptiveLocationPoller(provider)
+        polls = 0
+        errors = 0
+        lastFix = None
+        nextFixed = 0
+        lags = []
+        for second in xrange(len(trace)):
+            clock[0] = float(second)
+            if label == "fixed":
+                if second >= nextFixed:
+                    nextFixed = second + watcher.managerRefreshTime
+                    polls = polls + 1
+                    try:
+                        lastFix = provider.getLocation()
+                    except Exception:
+                        errors = errors + 1
+            else:
+                coord = poller.poll(clock[0])
+                if coord is not None:
+                    lastFix = coord
+            actual = truth(second)
+            if actual is not None and lastFix is not None:
+                lags.append(haversine(actual[1], lastFix[0], actual[2], lastFix[1]))
+        if label == "adaptive":
+            polls, errors = poller.polls, poller.errors
+        print "%-10s %8d %8d %14.3f %14.3f" % ( label, polls, errors, sum(lags) / len(lags), max(lags) )
+
+def benchReachability(size=300):
+    """ Google lookups for a spread of active spawns, all of them vs dropping the unreachable ones first """
+    google = StandInGoogle().start()
+    url = google.baseUrl() + "/maps/api/distancematrix/json"
+    phone = list(CENTER)
+    rnd = random.Random(5)
+    now = time.time()
+    mons = []
+    for pm in generatePokemon(size, spread=.1):
+        pm.timeReceived = now - rnd.uniform(0, watcher.despawnSeconds - 60)
+        pm.lastCoordCheck = None
+        pm.crowDistance = haversine(phone[0], pm.coords[0], phone[1], pm.coords[1])
+        mons.append(pm)
+
+    print "%-10s %10s %10s %10s %12s" % ( "path", "lookups", "requests", "time(ms)", "unreachable" )
+
+    google.reset()
+    client = DistanceMatrixClient(url=url, cache=DistanceCache(maxSize=0))
+    start = time.time()
+    client.resolve(phone, mons)
+    oldTime = time.time() - start
+    invalid = set([ pm.getId() for pm in mons if not pm.isStillValid() ])
+    print "%-10s %10d %10d %10.1f %12d" % ( "all", len(mons), google.requestCount, oldTime * 1000, len(invalid) )
+    client.session.close()
+
+    for pm in mons:
+        pm.timeToTarget = pm.distanceToTarget = None
+
+    google.reset()
+    client = DistanceMatrixClient(url=url, cache=DistanceCache(maxSize=0))
+    start = time.time()
+    reachable = [ pm for pm in mons if pm.isReachable(now) ]
+    reachable.sort(key=lambda pm: pm.getLookupPriority(now))
+    client.resolve(phone, reachable)
+    newTime = time.time() - start
+    culled = set([ pm.getId() for pm in mons ]) - set([ pm.getId() for pm in reachable ])
+    assert culled <= invalid, "culled %d spawns google says we could reach" % len(culled - invalid)
+    print "%-10s %10d %10d %10.1f %12d" % ( "prefilter", len(reachable), google.requestCount, newTime * 1000, len(culled) )
+    client.session.close()
+    google.shutdown()
+    google.server_close()
+
+def benchStaticMap(ticks=60):
+    """ A map per refresh with a jittering phone: the old blocking urlretrieve vs StaticMapRenderer """
+    google = StandInGoogle().start()
+    watcher.staticMapUrl = google.baseUrl() + "/maps/api/staticmap"
+    rnd = random.Random(7)
+    mons = generatePokemon(10, spread=.01)
+    phones = [ [ CENTER[0] + rnd.uniform(-.0001, .0001), CENTER[1] + rnd.uniform(-.0001, .0001) ] for _ in xrange(ticks) ]
+    tmpDir = tempfile.mkdtemp()
+
+    def markersFor(tick):
+        # a pokemon despawns every 10 ticks
+        return [ ( chr(ord('A') + idx), pm.getFormattedCoordStr() ) for idx, pm in enumerate(mons[tick // 10:]) ]
+
+    print "%-10s %14s %10s %12s" % ( "path", "tick max(ms)", "downloads", "total(ms)" )
+    try:
+        google.reset()
+        previousURL = None
+        worst = 0.0
+        start = time.time()
+        for tick, phone in enumerate(phones):
+            started = time.time()
+            center = "%f,%f" % ( phone[0], phone[1] )
+            url = StaticMapRenderer.buildUrl(center, [ ( None, center ) ] + markersFor(tick))
+            if previousURL != url: # the old code never set previousURL, this is what it meant to do
+                urllib.urlretrieve(url, os.path.join(tmpDir, "new.png"))
+                os.rename(os.path.join(tmpDir, "new.png"), os.path.join(tmpDir, "current.png"))
+                previousURL = url
+            worst = max(worst, time.time() - started)
+        print "%-10s %14.1f %10d %12.1f" % ( "blocking", worst * 1000, google.requestCount, ( time.time() - start ) * 1000 )
+
+        google.reset()
+        renderer = StaticMapRenderer()
+        renderer.start()
+        worst = 0.0
+        start = time.time()
+        for tick, phone in enumerate(phones):
+            started = time.time()
+            center = StaticMapRenderer.quantize(phone)
+            url = StaticMapRenderer.buildUrl(center, [ ( None, center ) ] + markersFor(tick))
+            renderer.request(url)
+            worst = max(worst, time.time() - started)
+            time.sleep(.01) # refreshes are further apart than this, give the download thread a chance
+        while renderer.pending.qsize() or renderer.getCurrent() is None:
+            time.sleep(.01)
+        stats = renderer.getStats()
+        print "%-10s %14.1f %10d %12.1f" % ( "renderer", worst * 1000, stats["downloads"], ( time.time() - start ) * 1000 )
+        renderer.session.close()
+    finally:
+        shutil.rmtree(tmpDir)
+        google.shutdown()
+        google.server_close()
+
+def benchIngest(count=5000):
+    """ Event table inserts: commit per row (the old path) vs the group commit DatabaseWriter """
+    messages = generateMessages(count)
+    parsed = [ parseSlackItem(item) for item in messages ]
+    tmpDir = tempfile.mkdtemp()
+    try:
+        # old path, default journal and a commit for every message
+        conn = sqlite3.connect(os.path.join(tmpDir, "old.db"))
+        watcher.migrateDatabase(conn)
+        start = time.time()
+        for item, attachment in parsed:
+            writeToDatabase(conn, item, attachment)
+        oldTime = time.time() - start
+        conn.close()
+
+        watcher.dbname = os.path.join(tmpDir, "new.db")
+        writer = DatabaseWriter()
+        start = time.time()
+        for item, attachment in parsed:
+            writer(( item, attachment ))
+        writer.close()
+        newTime = time.time() - start
+
+        rows = sqlite3.connect(watcher.dbname).execute("select count(*) from event").fetchone()[0]
+        assert rows == count, "group commit wrote %d of %d rows" % ( rows, count )
+
+        print "%-14s %10s %12s %8s" % ( "path", "time(s)", "rows/sec", "commits" )
+        print "%-14s %10.2f %12.0f %8d" % ( "commit-per-row", oldTime, count / oldTime, count )
+        print "%-14s %10.2f %12.0f %8d" % ( "group-commit", newTime, count / newTime, writer.commits )
+    finally:
+        shutil.rmtree(tmpDir)
+
+def benchWebServer(requestsPerClient=30, spawns=100):
+    """ p50/p99 /pokemon latency for N concurrent clients on each server backend, with and without one slow client """
+    mgr = Manager(None, None, Queue.Queue(), None)
+    Current.phoneCoord = list(CENTER)
+    for item in generateMessages(spawns, spread=.01):
+        mgr.potentiallyAddPokemonToManager(buildPokemon(parseSlackItem(item)), resolveNow=False)
+    mgr.updateAllDistances()
+    mgr.publish()
+    PokemonWebServer(mgr, Queue.Queue(), Queue.Queue())
+
+    def fetch(port, path):
+        conn = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request("GET", path)
+        res = conn.getresponse()
+        res.read()
+        conn.close()
+        assert res.status == 200, "GET %s returned %d" % ( path, res.status )
+
+    def slowClient(port, done):
+        # dribbles its request out a byte at a time, like a phone on a bad connection
+        while not done.is_set():
+            sock = socket.create_connection(( "127.0.0.1", port ))
+            for char in "GET / HTTP/1.0\r\n\r\n":
+                sock.sendall(char)
+                time.sleep(.02)
+            sock.recv(4096)
+            sock.close()
+
+    print "%-11s %-5s %8s %10s %10s %10s %10s %7s" % ( "backend", "slow", "clients", "req/s", "p50(ms)", "p99(ms)", "max(ms)", "errors" )
+    for backend in ( "wsgiref", "threaded", "threadpool" ):
+        for slow in ( False, True ):
+            for count in webClients:
+                port = freePort()
+                server = makeWebServer("127.0.0.1", port, backend)
+                thread = threading.Thread(target=bottle.run, kwargs={ "server" : server, "quiet" : True })
+                thread.setDaemon(True)
+                thread.start()
+                while getattr(server, "srv", None) is None:
+                    time.sleep(.01)
+
+                latencies = []
+                lock = threading.Lock()
+                done = threading.Event()
+
+                errors = []
+
+                def client():
+                    mine = []
+                    for _ in xrange(requestsPerClient):
+                        start = time.time()
+                        try:
+                            fetch(port, "/pokemon")
+                        except Exception as ex: # timeouts, when a backend can't keep up
+                            errors.append(ex)
+                            continue
+                        mine.append(time.time() - start)
+                    with lock:
+                        latencies.extend(mine)
+
+                if slow:
+                    slowThread = threading.Thread(target=slowClient, args=( port, done ))
+                    slowThread.setDaemon(True)
+                    slowThread.start()
+                    time.sleep(.05) # let it get a connection in first
+
+                workers = [ threading.Thread(target=client) for _ in xrange(count) ]
+                start = time.time()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.time() - start
+                done.set()
+                if slow:
+                    slowThread.join()
+                server.srv.shutdown()
+                server.srv.server_close()
+
+                latencies.sort()
+                maxLatency = latencies[-1] if latencies else 0.0
+                print "%-11s %-5s %8d %10.0f %10.1f %10.1f %10.1f %7d" % ( backend, slow, count, len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, maxLatency * 1000, len(errors) )
+
+def benchEndToEnd(count=1500, dashboardClients=4):
+    """
+    The whole process offline: a FakeSlackClient through mainLoop, the ingest pipeline (persisting to a temp
+    DB), the Manager polling a generateTrace() phone, StandInGoogle for distances and maps, and clients on
+    the dashboard the whole time.  Once per feedRates entry.
+    """
+    google = StandInGoogle().start()
+    google.staticMapDelay = .01
+    saved = ( watcher.distanceMatrixUrl, watcher.staticMapUrl, watcher.managerRefreshTime, watcher.dbname )
+    watcher.distanceMatrixUrl = google.baseUrl() + "/maps/api/distancematrix/json"
+    watcher.staticMapUrl = google.baseUrl() + "/maps/api/staticmap"
+    watcher.managerRefreshTime = 2 # so a short run still has a few full refreshes to time
+    Current.enableGoogleAndICloud = True
+    Current.enableSlack = True
+    messages = generateMessages(count, spread=.02)
+    tmpDir = tempfile.mkdtemp()
+
+    print "%-8s %8s %10s %9s %11s %11s %7s %9s %7s %10s %10s" % ( "rate", "msgs", "ingest/s", "ticks", "tick(ms)", "maxTick(ms)",
+        "polls", "distance", "maps", "dash p50", "dash p99" )
+    try:
+        for rate in feedRates:
+            watcher.dbname = os.path.join(tmpDir, "endtoend-%s.db" % rate)
+            watcher.distanceMatrix = None # a cold cache for each run
+            getStaticMapRenderer().clear()
+            google.reset()
+            Current.phoneCoord = None
+
+            slack = FakeSlackClient(messages, rate or None)
+            incoming = WakeupQueue(watcher.ingestQueueSize)
+            webToManagerQueue = WakeupQueue()
+            managerToWebQueue = Queue.Queue()
+            manager = Manager(slack, webToManagerQueue, managerToWebQueue, incoming, TraceLocationProvider(generateTrace(), speedup=60))
+            manager.setDaemon(True)
+            manager.start()
+            pipeline = IngestPipeline(incoming, persist=True).start()
+
+            PokemonWebServer(manager, webToManagerQueue, managerToWebQueue, pipeline)
+            port = freePort()
+            server = makeWebServer("127.0.0.1", port)
+            serverThread = threading.Thread(target=bottle.run, kwargs={ "server" : server, "quiet" : True })
+            serverThread.setDaemon(True)
+            serverThread.start()
+            while getattr(server, "srv", None) is None:
+                time.sleep(.01)
+
+            latencies = []
+            lock = threading.Lock()
+            done = threading.Event()
+
+            def dashboard():
+                mine = []
+                while not done.is_set():
+                    conn = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+                    started = time.time()
+                    conn.request("GET", "/pokemon")
+                    res = conn.getresponse()
+                    res.read()
+                    conn.close()
+                    mine.append(time.time() - started)
+                    time.sleep(.02)
+                with lock:
+                    latencies.extend(mine)
+
+            def feed():
+                try:
+                    mainLoop(pipeline, slack)
+                except FeedFinished:
+                    pass
+
+            clients = [ threading.Thread(target=dashboard) for _ in xrange(dashboardClients) ]
+            for client in clients:
+                client.start()
+            feeder = threading.Thread(target=feed)
+            started = time.time()
+            feeder.start()
+            slack.drained.wait()
+            classify = pipeline.stages[-1]
+            while classify.processed < count or not incoming.empty():
+                time.sleep(.005)
+            elapsed = time.time() - started
+            time.sleep(watcher.managerRefreshTime) # one more full refresh with everything in it
+
+            slack.finish()
+            feeder.join()
+            done.set()
+            for client in clients:
+                client.join()
+            pipeline.stop()
+            manager.stop()
+            manager.join()
+            server.srv.shutdown()
+            server.srv.server_close()
+
+            stats = manager.schedulerStats
+            rows = sqlite3.connect(watcher.dbname).execute("select count(*) from event").fetchone()[0]
+            assert rows == count, "persisted %d of %d messages" % ( rows, count )
+            latencies.sort()
+            print "%-8s %8d %10.0f %9d %11.1f %11.1f %7d %9d %7d %10.1f %10.1f" % ( rate or "max", count, count / elapsed, stats["ticks"],
+                stats["totalTickSeconds"] / max(1, stats["ticks"]) * 1000, stats["maxTickSeconds"] * 1000, manager.location.polls,
+                google.distanceRequests, google.staticMapRequests, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000 )
+    finally:
+        watcher.distanceMatrixUrl, watcher.staticMapUrl, watcher.managerRefreshTime, watcher.dbname = saved
+        quiet()
+        google.shutdown()
+        google.server_close()
+        shutil.rmtree(tmpDir)
+
+def benchSubscribers(sizes=( 100, 1000, 10000 ), spawns=500, spread=.5):
+    """ Subscribers to text about each spawn: checking everyone vs SubscriberRegistry's index """
+    rnd = random.Random(17)
+    sharedRules = watcher.getRules()
+    mons = [ buildPokemon(parseSlackItem(item)) for item in generateMessages(spawns, spread=spread) ]
+    hr = 12
+
+    print "%-8s %12s %12s %14s %12s %8s" % ( "subs", "scan(us)", "index(us)", "candidates", "matches", "speedup" )
+    for size in sizes:
+        people = [ Subscriber("sub%d" % idx, sharedRules, "%d@example.com" % idx,
+                              [ CENTER[0] + rnd.uniform(-spread, spread), CENTER[1] + rnd.uniform(-spread, spread) ]) for idx in xrange(size) ]
+        registry = SubscriberRegistry(people)
+
+        def scan():
+            res = 0
+            for pm in mons:
+                for person in people:
+                    if sharedRules.shouldAlert(pm, haversine(person.coords[0], pm.coords[0], person.coords[1], pm.coords[1]), hr):
+                        res = res + 1
+            return res
+
+        def indexed():
+            return sum([ len(registry.match(pm, hr)) for pm in mons ])
+
+        expected = scan()
+        assert indexed() == expected, "the index found a different set of subscribers"
+        registry.spawns = registry.candidates = 0
+        scanTime = timed(scan, 1)
+        indexTime = timed(indexed, 1)
+        print "%-8d %12.1f %12.1f %14.1f %12.1f %7.0fx" % ( size, scanTime / spawns * 1e6, indexTime / spawns * 1e6,
+                                                         registry.candidates / float(registry.spawns), expected / float(spawns), scanTime / indexTime )
+
+def benchMetrics(ops=200000, spawns=300, ticks=20):
+    """ What the metrics cost: per update with metricsEnabled on and off, and a full manager refresh either way """
+    counter = watcher.metrics.counter("watcher_bench_ops_total", "Benchmark updates")
+    histogram = watcher.metrics.histogram("watcher_bench_seconds", "Benchmark timings")
+
+    def incs():
+        for _ in xrange(ops):
+            counter.inc()
+
+    def timers():
+        for _ in xrange(ops):
+            with histogram.time():
+                pass
+
+    def bare():
+        for _ in xrange(ops):
+            pass
+
+    mgr = Manager(None, None, Queue.Queue(), None)
+    Current.phoneCoord = list(CENTER)
+    for item in generateMessages(spawns, spread=.01):
+        mgr.potentiallyAddPokemonToManager(buildPokemon(parseSlackItem(item)), resolveNow=False)
+    watcher.getStaticMapRenderer().clear()
+
+    def refreshes():
+        for _ in xrange(ticks):
+            mgr.tick()
+
+    saved = watcher.metricsEnabled
+    loop = timed(bare)
+    print "%-9s %12s %12s %14s" % ( "metrics", "inc(ns)", "timer(ns)", "tick(ms)" )
+    try:
+        for enabled in ( False, True ):
+            watcher.metricsEnabled = enabled
+            incTime = timed(incs) - loop
+            timerTime = timed(timers) - loop
+            tickTime = timed(refreshes) / ticks
+            print "%-9s %12.0f %12.0f %14.3f" % ( "on" if enabled else "off", incTime / ops * 1e9, timerTime / ops * 1e9, tickTime * 1000 )
+    finally:
+        watcher.metricsEnabled = saved
+    lines = watcher.metrics.render().splitlines()
+    assert "watcher_bench_ops_total %s" % repr(float(ops * 3)) in lines, "counter did not render"
+    print "/metrics: %d lines" % len(lines)
+
+BENCHMARKS = [
+    ( "haversine", benchHaversine ),
+    ( "distancematrix", benchDistanceMatrix ),
+    ( "distancecache", benchDistanceCache ),
+    ( "reachability", benchReachability ),
+    ( "staticmap", benchStaticMap ),
+    ( "parse", benchParse ),
+    ( "ingest", benchIngest ),
+    ( "analytics", benchAnalytics ),
+    ( "archive", benchArchive ),
+    ( "notify", benchNotify ),
+    ( "location", benchLocation ),
+    ( "webserver", benchWebServer ),
+    ( "subscribers", benchSubscribers ),
+    ( "metrics", benchMetrics ),
+    ( "endtoend", benchEndToEnd ),
+]
+
+if __name__ == "__main__":
+    quiet()
+    args = sys.argv[1:]
+    if "--messages" in args:
+        idx = args.index("--messages")
+        recordedMessages = json.load(open(args[idx + 1]))
+        del args[idx:idx + 2]
+    if "--clients" in args:
+        idx = args.index("--clients")
+        webClients = [ int(x) for x in args[idx + 1].split(",") ]
+        del args[idx:idx + 2]
+    if "--rates" in args:
+        idx = args.index("--rates")
+        feedRates = [ int(x) for x in args[idx + 1].split(",") ]
+        del args[idx:idx + 2]
+    wanted = args or [ name for name, _ in BENCHMARKS ]
+    for name, func in BENCHMARKS:
+        if name in wanted:
+            print "== %s ==" % name
+            func()
+            print